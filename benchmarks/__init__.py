@@ -0,0 +1 @@
+"""Benchmarks for hoymiles-mqtt."""
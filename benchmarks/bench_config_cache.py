@@ -0,0 +1,85 @@
+"""Benchmark of config payloads generation (`HassMqtt.get_configs`).
+
+Compares the cost of building discovery config payloads for a device for the first time (cold cache)
+with the cost of republishing them (warm cache).
+
+Usage::
+
+    python -m benchmarks.bench_config_cache [--inverters 100] [--repeat 20]
+
+"""
+
+import argparse
+import timeit
+from typing import List
+
+from hoymiles_modbus.datatypes import InverterData, PlantData
+
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES
+from hoymiles_mqtt.ha import HassMqtt
+
+
+def synthetic_plant_data(inverters: int, ports: int = 4) -> PlantData:
+    """Create PlantData with given number of inverters, each with given number of ports."""
+    rows = []
+    for inverter in range(inverters):
+        for port in range(1, ports + 1):
+            rows.append(
+                InverterData(
+                    data_type=0,
+                    serial_number=f'1021{inverter:08d}',
+                    port_number=port,
+                    pv_voltage=30.1,
+                    pv_current=2.34,
+                    grid_voltage=230.1,
+                    grid_frequency=50.01,
+                    pv_power=70.5,
+                    today_production=431 + port,
+                    total_production=8844 + port,
+                    temperature=20.4,
+                    operating_status=3,
+                    alarm_code=0,
+                    alarm_count=0,
+                    link_status=1,
+                    reserved=[],
+                )
+            )
+    return PlantData('dtu_serial', inverters=rows)
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inverters', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    plant_data = synthetic_plant_data(args.inverters)
+
+    builders: List[HassMqtt] = []
+
+    def new_builder():
+        builders.append(HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES))
+
+    def cold():
+        # the builder is created in the (not timed) setup
+        list(builders[-1].get_configs(plant_data))
+
+    warm_builder = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES)
+    list(warm_builder.get_configs(plant_data))
+
+    def warm():
+        # republish: all devices are configured again, payloads are taken from the cache
+        warm_builder.clear_configs()
+        list(warm_builder.get_configs(plant_data))
+
+    cold_time = min(timeit.repeat(cold, setup=new_builder, number=1, repeat=args.repeat))
+    warm_time = min(timeit.repeat(warm, number=1, repeat=args.repeat))
+    warm_builder.clear_configs()
+    print(f'inverters: {args.inverters}, config messages: {sum(1 for _ in warm_builder.get_configs(plant_data))}')
+    print(f'cold cache: {cold_time * 1e3:8.3f} ms per cycle, {cold_time / args.inverters * 1e6:8.1f} us per inverter')
+    print(f'warm cache: {warm_time * 1e3:8.3f} ms per cycle, {warm_time / args.inverters * 1e6:8.1f} us per inverter')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Microbenchmark of JSON encoding of MQTT payloads.
+
+Builds states and configs of synthetic plant data (500 microinverter ports by default) with each installed
+encoder (`hoymiles_mqtt.encoding`) and with the previous approach - `json.dumps` to `str`, encoded to `bytes`
+when published::
+
+    python -m benchmarks.bench_encoding --ports 500
+
+"""
+
+import argparse
+import json
+import statistics
+import time
+from typing import Callable, Dict, List
+
+from hoymiles_modbus.datatypes import InverterData, PlantData
+
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES
+from hoymiles_mqtt.encoding import available_encoders, get_encoder
+from hoymiles_mqtt.ha import HassMqtt
+
+PORTS_PER_INVERTER = 4
+
+
+def _legacy_encoder(obj) -> bytes:
+    return json.dumps(obj).encode()
+
+
+def make_plant_data(ports: int) -> PlantData:
+    """Synthetic plant data with the given number of microinverter ports."""
+    inverters = []
+    for index in range(ports):
+        inverter, port = divmod(index, PORTS_PER_INVERTER)
+        inverters.append(
+            InverterData(
+                data_type=0,
+                serial_number=f'1021628{inverter:05d}',
+                port_number=port + 1,
+                pv_voltage=30.1 + index % 7,
+                pv_current=3.45,
+                grid_voltage=230.1,
+                grid_frequency=50.01,
+                pv_power=103.8 + index % 11,
+                today_production=1200 + index,
+                total_production=1000000 + index,
+                temperature=35.2,
+                operating_status=3,
+                alarm_code=0,
+                alarm_count=0,
+                link_status=1,
+                reserved=[],
+            )
+        )
+    return PlantData('415012345678', inverters=inverters)
+
+
+def _measure(function: Callable[[], None], repeat: int) -> List[float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def run(ports: int, repeat: int) -> Dict[str, Dict[str, float]]:
+    """Run the benchmark.
+
+    Arguments:
+        ports: number of microinverter ports
+        repeat: number of measured builds
+
+    Returns:
+        median time [ms] of building states and configs, by encoder names
+
+    """
+    plant_data = make_plant_data(ports)
+    encoders: Dict[str, Callable] = {'json.dumps+encode': _legacy_encoder}
+    encoders.update({name: get_encoder(name) for name in available_encoders()})
+    results = {}
+    for name, encoder in encoders.items():
+        builder = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES, encoder=encoder)
+
+        def build_configs() -> None:
+            # configs are cached, measure building them from scratch
+            builder.expire_after = builder.expire_after + 1
+            builder.clear_configs()
+            list(builder.get_configs(plant_data))
+
+        results[name] = {
+            'states_ms': statistics.median(_measure(lambda: list(builder.get_states(plant_data)), repeat)) * 1e3,
+            'configs_ms': statistics.median(_measure(build_configs, repeat)) * 1e3,
+        }
+    return results
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ports', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    for name, result in run(args.ports, args.repeat).items():
+        print(f'{name:18s} states {result["states_ms"]:8.3f} ms  configs {result["configs_ms"]:8.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
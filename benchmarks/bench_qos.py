@@ -0,0 +1,81 @@
+"""Benchmark of publishing with QoS 1 - throughput by size of the in-flight window.
+
+Publishes batches of messages through the long-lived connection to a local MQTT broker stand-in, which delays
+acknowledgements to simulate the round-trip time. With the window of 1 message, each message waits for
+the acknowledgement of the previous one::
+
+    python -m benchmarks.bench_qos [--messages 200] [--rtt-ms 20] [--windows 1 5 20 50]
+
+"""
+
+import argparse
+import time
+from typing import Dict, List
+
+from benchmarks.mqtt_broker import MqttBrokerStandIn
+from hoymiles_mqtt import DEFAULT_MAX_INFLIGHT
+from hoymiles_mqtt.mqtt import MqttPublisher
+
+DEFAULT_WINDOWS = [1, 5, DEFAULT_MAX_INFLIGHT, 50]
+
+
+def run_case(broker: MqttBrokerStandIn, qos: int, max_inflight: int, messages: int, batches: int) -> Dict[str, float]:
+    """Publish batches of messages and measure the time.
+
+    Arguments:
+        broker: running broker stand-in
+        qos: QoS of messages
+        max_inflight: maximum number of messages waiting for acknowledgement
+        messages: number of messages in each batch
+        batches: number of batches
+
+    Returns:
+        the best time of a batch (in seconds), throughput (messages per second), mean and max latency of
+        acknowledgements (in seconds) and delivery ratio
+
+    """
+    publisher = MqttPublisher(mqtt_broker=broker.host, mqtt_port=broker.port, qos=qos, max_inflight=max_inflight)
+    payload = b'{"pv_power": 123.4, "pv_voltage": 31.2, "pv_current": 3.95}'
+    times: List[float] = []
+    try:
+        for _ in range(batches):
+            start = time.perf_counter()
+            with publisher.schedule_publish() as queue:
+                for index in range(messages):
+                    queue.add(f'homeassistant/hoymiles_mqtt/{index}/state', payload)
+            times.append(time.perf_counter() - start)
+    finally:
+        publisher.close()
+    stats = publisher.delivery_stats
+    best = min(times)
+    return {
+        'batch_s': best,
+        'messages_per_s': messages / best,
+        'mean_latency_s': stats.mean_latency,
+        'max_latency_s': stats.latency_max,
+        'delivery_ratio': stats.delivery_ratio,
+    }
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--batches', type=int, default=3)
+    parser.add_argument('--rtt-ms', type=float, default=20)
+    parser.add_argument('--windows', type=int, nargs='+', default=DEFAULT_WINDOWS)
+    args = parser.parse_args()
+
+    with MqttBrokerStandIn(ack_delay=args.rtt_ms / 1000) as broker:
+        cases = [('QoS 0', 0, DEFAULT_MAX_INFLIGHT)] + [(f'QoS 1, window {n}', 1, n) for n in args.windows]
+        for name, qos, max_inflight in cases:
+            result = run_case(broker, qos, max_inflight, args.messages, args.batches)
+            print(
+                f'{name:18} {result["batch_s"] * 1000:9.1f} ms/batch  {result["messages_per_s"]:9.0f} msg/s  '
+                f'latency {result["mean_latency_s"] * 1000:6.1f} ms (max {result["max_latency_s"] * 1000:6.1f} ms)  '
+                f'delivered {result["delivery_ratio"]:.3f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""End-to-end benchmark of a query cycle (`HoymilesQueryJob.execute`).
+
+Drives the real job against the simulated DTU (`hoymiles_mqtt.simulator`) and a local MQTT broker stand-in,
+both running in this process. For each number of inverters and entity selection it reports:
+
+- latency percentiles of the stages: Modbus read, building of states and configs, MQTT publish, whole cycle
+- peak memory allocated during a cycle (tracemalloc, includes the in-process DTU and broker)
+- bytes on the wire per cycle (Modbus and MQTT)
+
+Configs are generated only for new devices, so their building is measured in the first cycle only.
+
+Results can be stored as a baseline and later compared with it, to catch regressions::
+
+    python -m benchmarks.bench_query_cycle --save-baseline benchmarks/baseline_query_cycle.json
+    python -m benchmarks.bench_query_cycle --compare benchmarks/baseline_query_cycle.json
+
+Each inverter has one port by default (`--ports`), so the number of inverters is also the number of
+inverter records read from DTU.
+
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Tuple
+
+from hoymiles_modbus.client import HoymilesModbusTCP
+
+from benchmarks.mqtt_broker import MqttBrokerStandIn
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES
+from hoymiles_mqtt.ha import HassMqtt
+from hoymiles_mqtt.mqtt import MqttPublisher
+from hoymiles_mqtt.runners import HoymilesQueryJob
+from hoymiles_mqtt.simulator import DtuSimulator, SimulatorThread
+
+ENTITY_SELECTIONS = {
+    'all': (MI_ENTITIES, PORT_ENTITIES),
+    'minimal': (['grid_voltage'], ['pv_power', 'today_production']),
+}
+STAGES = ['modbus_read', 'build_states', 'build_configs', 'publish', 'cycle']
+PERCENTILES = [50, 90, 99]
+DEFAULT_TOLERANCE = 0.5
+DEFAULT_MIN_DELTA_MS = 1.0
+
+
+class _Recorder:
+    """Collects durations of stages within the current cycle."""
+
+    def __init__(self) -> None:
+        self.cycle: Dict[str, float] = {}
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.cycle[stage] = self.cycle.get(stage, 0.0) + time.perf_counter() - start
+
+
+class _TimedModbusTCP(HoymilesModbusTCP):
+    """Allows more than 100 inverter records and measures reading of plant data."""
+
+    _MAX_INVERTER_COUNT = 10000
+
+    def __init__(self, recorder: _Recorder, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._recorder = recorder
+
+    @property
+    def plant_data(self):
+        with self._recorder.measure('modbus_read'):
+            return super().plant_data
+
+
+class _TimedHassMqtt(HassMqtt):
+    """Measures building of messages (generators are consumed within the measurement)."""
+
+    def __init__(self, recorder: _Recorder, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._recorder = recorder
+
+    def get_states(self, plant_data) -> Iterable[Tuple[str, bytes]]:
+        with self._recorder.measure('build_states'):
+            return list(super().get_states(plant_data))
+
+    def get_configs(self, plant_data) -> Iterable[Tuple[str, bytes]]:
+        with self._recorder.measure('build_configs'):
+            return list(super().get_configs(plant_data))
+
+
+class _TimedMqttPublisher(MqttPublisher):
+    """Measures sending of messages (at exit of a publishing session)."""
+
+    def __init__(self, recorder: _Recorder, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._recorder = recorder
+        self.messages_sent = 0
+
+    @contextmanager
+    def schedule_publish(self):
+        with super().schedule_publish() as queue:
+            yield queue
+            start = time.perf_counter()
+        self._recorder.cycle['publish'] = self._recorder.cycle.get('publish', 0.0) + time.perf_counter() - start
+        self.messages_sent += len(queue._buffer)
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    if len(samples) == 1:
+        return {f'p{p}': samples[0] * 1e3 for p in PERCENTILES}
+    quantiles = statistics.quantiles(samples, n=100, method='inclusive')
+    return {f'p{p}': quantiles[p - 1] * 1e3 for p in PERCENTILES}
+
+
+def run_case(inverters: int, ports: int, entities: str, cycles: int) -> Dict[str, Any]:
+    """Run the benchmark for one case.
+
+    Arguments:
+        inverters: number of inverters
+        ports: number of ports of each inverter
+        entities: name of entity selection, see `ENTITY_SELECTIONS`
+        cycles: number of measured cycles
+
+    Returns:
+        results: latency percentiles [ms] of stages, peak memory [KiB] and bytes per cycle
+
+    """
+    recorder = _Recorder()
+    samples: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    mi_entities, port_entities = ENTITY_SELECTIONS[entities]
+    simulator = DtuSimulator(inverters=inverters, ports=ports, seed=0)
+    with SimulatorThread(simulator) as dtu, MqttBrokerStandIn() as broker:
+        publisher = _TimedMqttPublisher(recorder, mqtt_broker=broker.host, mqtt_port=broker.port)
+        builder = _TimedHassMqtt(recorder, mi_entities=mi_entities, port_entities=port_entities)
+        modbus_client = _TimedModbusTCP(recorder, host=dtu.host, port=dtu.port)
+        job = HoymilesQueryJob(mqtt_builder=builder, mqtt_publisher=publisher, modbus_client=modbus_client)
+        try:
+            modbus_bytes = 0
+            mqtt_bytes = 0
+            for cycle in range(cycles + 1):
+                recorder.cycle = {}
+                modbus_start = simulator.bytes_received + simulator.bytes_sent
+                mqtt_start = broker.bytes_received
+                with recorder.measure('cycle'):
+                    job.execute()
+                # messages are sent when they are written into the socket, wait until the broker gets them
+                while broker.messages_received < publisher.messages_sent:
+                    time.sleep(0.001)
+                if cycle == 0:
+                    # connection to the broker is established and configs are built in the first cycle
+                    samples['build_configs'].append(recorder.cycle['build_configs'])
+                    continue
+                for stage in ('modbus_read', 'build_states', 'publish', 'cycle'):
+                    samples[stage].append(recorder.cycle[stage])
+                modbus_bytes = simulator.bytes_received + simulator.bytes_sent - modbus_start
+                mqtt_bytes = broker.bytes_received - mqtt_start
+
+            tracemalloc.start()
+            peaks = []
+            for _ in range(3):
+                tracemalloc.reset_peak()
+                current = tracemalloc.get_traced_memory()[0]
+                job.execute()
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+            tracemalloc.stop()
+        finally:
+            publisher.close()
+    return {
+        'latency_ms': {stage: _percentiles(values) for stage, values in samples.items()},
+        'peak_memory_kib': statistics.median(peaks) / 1024,
+        'modbus_bytes': modbus_bytes,
+        'mqtt_bytes': mqtt_bytes,
+    }
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, min_delta_ms: float = DEFAULT_MIN_DELTA_MS
+) -> List[str]:
+    """Compare results with the baseline.
+
+    Bytes on the wire are deterministic, so any increase is reported.
+
+    Arguments:
+        results: results by case names
+        baseline: baseline results by case names
+        tolerance: allowed relative increase of median latencies and peak memory
+        min_delta_ms: increase of median latency below this value is not reported (timing noise of short stages)
+
+    Returns:
+        descriptions of regressions
+
+    """
+    regressions = []
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        base = baseline[case]
+        for stage, latency in result['latency_ms'].items():
+            base_p50 = base['latency_ms'][stage]['p50']
+            if latency['p50'] > base_p50 * (1 + tolerance) and latency['p50'] - base_p50 > min_delta_ms:
+                regressions.append(f'{case} {stage}: p50 {latency["p50"]:.3f} ms, baseline {base_p50:.3f} ms')
+        if result['peak_memory_kib'] > base['peak_memory_kib'] * (1 + tolerance):
+            regressions.append(
+                f'{case} peak memory: {result["peak_memory_kib"]:.1f} KiB, baseline {base["peak_memory_kib"]:.1f} KiB'
+            )
+        for counter in ('modbus_bytes', 'mqtt_bytes'):
+            if result[counter] > base[counter]:
+                regressions.append(f'{case} {counter}: {result[counter]}, baseline {base[counter]}')
+    return regressions
+
+
+def _print_result(case: str, result: Dict[str, Any]) -> None:
+    print(
+        f'{case}: peak memory {result["peak_memory_kib"]:.1f} KiB, '
+        f'Modbus {result["modbus_bytes"]} B, MQTT {result["mqtt_bytes"]} B per cycle'
+    )
+    for stage, latency in result['latency_ms'].items():
+        print(f'    {stage:14s}' + ''.join(f' {name} {value:9.3f} ms' for name, value in latency.items()))
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inverters', type=int, nargs='+', default=[1, 10, 100, 500])
+    parser.add_argument('--ports', type=int, default=1)
+    parser.add_argument('--entities', nargs='+', choices=list(ENTITY_SELECTIONS), default=list(ENTITY_SELECTIONS))
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--min-delta-ms', type=float, default=DEFAULT_MIN_DELTA_MS)
+    args = parser.parse_args()
+
+    results = {}
+    for inverters in args.inverters:
+        for entities in args.entities:
+            case = f'{inverters}x{args.ports}-{entities}'
+            results[case] = run_case(inverters, args.ports, entities, args.cycles)
+            _print_result(case, results[case])
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Benchmark of startup time - importing of the entry point (`python -X importtime` based).
+
+Imports the module in fresh interpreters and reports the best cumulative import time with the slowest imports.
+MQTT and Modbus libraries (and sqlite3 of the offline buffer) must not be imported before the configuration
+is parsed (see `hoymiles_mqtt.app`), so `--print-config` and `--check-config` are fast on small devices::
+
+    python -m benchmarks.bench_startup [--module hoymiles_mqtt.__main__] [--repeat 5] [--budget-ms 200]
+
+"""
+
+import argparse
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+DEFAULT_MODULE = 'hoymiles_mqtt.__main__'
+# imported only when the tool runs
+HEAVY_PACKAGES = ['paho', 'pymodbus', 'hoymiles_modbus', 'asyncio', 'sqlite3']
+
+
+def measure_import(module: str) -> Dict[str, int]:
+    """Import the module in a fresh interpreter.
+
+    Arguments:
+        module: name of the module
+
+    Returns:
+        cumulative import times in microseconds by names of all imported modules
+
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        _, cumulative, name = line[len('import time:') :].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def heavy_imports(times: Dict[str, int]) -> List[str]:
+    """Imported packages from `HEAVY_PACKAGES`."""
+    return sorted({name.split('.')[0] for name in times} & set(HEAVY_PACKAGES))
+
+
+def best_import_time(module: str, repeat: int) -> Tuple[int, Dict[str, int]]:
+    """Best cumulative import time of the module (in microseconds) out of `repeat` runs, with times of that run."""
+    runs = [measure_import(module) for _ in range(repeat)]
+    best = min(runs, key=lambda times: times[module])
+    return best[module], best
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default=DEFAULT_MODULE)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=0, help='fail when exceeded, 0 means no budget')
+    args = parser.parse_args()
+
+    total, times = best_import_time(args.module, args.repeat)
+    print(f'{args.module}: {total / 1000:.1f} ms (best of {args.repeat})')
+    for name, cumulative in sorted(times.items(), key=lambda item: item[1], reverse=True)[1 : args.top + 1]:
+        print(f'  {cumulative / 1000:8.1f} ms  {name}')
+    heavy = heavy_imports(times)
+    if heavy:
+        print(f'Heavy modules imported: {", ".join(heavy)}')
+    if args.budget_ms and total / 1000 > args.budget_ms:
+        sys.exit(f'Over budget of {args.budget_ms} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Microbenchmark of extraction of state values from plant data.
+
+Compares the extraction plan compiled by `HassMqtt` with the previous approach - iterating entity descriptions
+of each device with `getattr` by name and calling ignore rules - on synthetic plant data, with producing and
+idle (zero operating status) microinverters::
+
+    python -m benchmarks.bench_states --ports 500 5000
+
+"""
+
+import argparse
+import statistics
+import time
+from typing import Callable, Dict, List
+
+from hoymiles_modbus.datatypes import PlantData
+
+from benchmarks.bench_encoding import make_plant_data
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES
+from hoymiles_mqtt.ha import DtuEntities, EntityDescription, HassMqtt, _ExtractionPlan
+
+
+def _legacy_extract(entity_definitions: Dict[str, EntityDescription], entity_data) -> Dict:
+    values = {}
+    for entity_name, description in entity_definitions.items():
+        value = getattr(entity_data, entity_name)
+        if description.ignore_rule and description.ignore_rule(entity_data, entity_name):
+            continue
+        if description.value_converter:
+            value = description.value_converter(value)
+        values[entity_name] = value
+    return values
+
+
+def _median_ms(function: Callable[[], None], repeat: int) -> float:
+    samples: List[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e3
+
+
+def run(plant_data: PlantData, repeat: int) -> Dict[str, float]:
+    """Run the benchmark for the given plant data.
+
+    Returns:
+        median time [ms] of extraction of values of all devices, by method names
+
+    """
+    builder = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES)
+    mi_entities, port_entities = builder._mi_entities, builder._port_entities
+    dtu_plan, mi_plan, port_plan = (
+        _ExtractionPlan(DtuEntities),
+        _ExtractionPlan(mi_entities),
+        _ExtractionPlan(port_entities),
+    )
+
+    def legacy() -> None:
+        _legacy_extract(DtuEntities, plant_data)
+        for inverter in plant_data.inverters:
+            _legacy_extract(mi_entities, inverter)
+            _legacy_extract(port_entities, inverter)
+
+    def plan() -> None:
+        dtu_plan.extract(plant_data)
+        for inverter in plant_data.inverters:
+            mi_plan.extract(inverter)
+            port_plan.extract(inverter)
+
+    return {'getattr loop': _median_ms(legacy, repeat), 'extraction plan': _median_ms(plan, repeat)}
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ports', type=int, nargs='+', default=[500, 5000])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    for ports in args.ports:
+        plant_data = make_plant_data(ports)
+        for state in ('producing', 'idle'):
+            if state == 'idle':
+                for inverter in plant_data.inverters:
+                    inverter.operating_status = 0
+            results = run(plant_data, args.repeat)
+            legacy, plan = results['getattr loop'], results['extraction plan']
+            print(f'{ports} ports {state:9s} getattr loop {legacy:8.3f} ms  plan {plan:8.3f} ms  x{legacy / plan:.2f}')
+
+
+if __name__ == '__main__':
+    main()
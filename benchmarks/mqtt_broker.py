@@ -0,0 +1,135 @@
+"""Minimal MQTT 3.1.1 and 5 broker stand-in for benchmarks.
+
+Accepts connections, acknowledges CONNECT, SUBSCRIBE, PINGREQ and QoS 1 PUBLISH packets and counts received
+messages and bytes. Messages are not forwarded to subscribers. MQTT 5 clients are announced the given
+maximum of topic aliases, or refused (like by MQTT 3.1.1 only brokers) when MQTT 5 is disabled. Acknowledgements
+of QoS 1 messages can be delayed, to simulate the round-trip time to a remote broker.
+
+"""
+
+import asyncio
+import threading
+from typing import Optional
+
+_CONNECT = 1
+_PUBLISH = 3
+_SUBSCRIBE = 8
+_PINGREQ = 12
+_DISCONNECT = 14
+_MQTT5 = 5
+_TOPIC_ALIAS_MAXIMUM = 0x22
+
+
+class MqttBrokerStandIn:
+    """MQTT broker stand-in running in a background thread with its own event loop."""
+
+    def __init__(
+        self,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        mqtt5: bool = True,
+        topic_alias_maximum: int = 0,
+        ack_delay: float = 0,
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            host: address to listen on
+            port: port to listen on, 0 means any free port
+            mqtt5: if to accept MQTT 5 connections
+            topic_alias_maximum: max number of topic aliases of MQTT 5 connections
+            ack_delay: delay (in seconds) of acknowledgements of QoS 1 and 2 messages
+
+        """
+        self.host = host
+        self.port = port
+        self.mqtt5 = mqtt5
+        self.topic_alias_maximum = topic_alias_maximum
+        self.ack_delay = ack_delay
+        self.bytes_received = 0
+        self.messages_received = 0
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='mqtt_broker', daemon=True)
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def _read_packet(self, reader: asyncio.StreamReader):
+        header = (await reader.readexactly(1))[0]
+        length = 0
+        multiplier = 1
+        size = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            size += 1
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        body = await reader.readexactly(length)
+        self.bytes_received += size + length
+        return header >> 4, header & 0x0F, body
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        version = 4
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == _CONNECT:
+                    version = body[2 + int.from_bytes(body[:2], 'big')]
+                    if version != _MQTT5:
+                        writer.write(bytes([0x20, 2, 0, 0]))
+                    elif not self.mqtt5:
+                        # the way MQTT 3.1.1 brokers refuse unknown protocol versions
+                        writer.write(bytes([0x20, 2, 0, 1]))
+                        break
+                    else:
+                        properties = bytes([_TOPIC_ALIAS_MAXIMUM]) + self.topic_alias_maximum.to_bytes(2, 'big')
+                        writer.write(bytes([0x20, 3 + len(properties), 0, 0, len(properties)]) + properties)
+                elif packet_type == _PUBLISH:
+                    self.messages_received += 1
+                    qos = (flags >> 1) & 0x03
+                    if qos:
+                        topic_length = int.from_bytes(body[:2], 'big')
+                        packet_id = body[2 + topic_length : 4 + topic_length]
+                        ack = bytes([0x40 if qos == 1 else 0x50, 2]) + packet_id
+                        if self.ack_delay:
+                            self._loop.call_later(self.ack_delay, writer.write, ack)
+                        else:
+                            writer.write(ack)
+                elif packet_type == _SUBSCRIBE:
+                    if version == _MQTT5:
+                        writer.write(bytes([0x90, 4]) + body[:2] + bytes([0, 0]))
+                    else:
+                        writer.write(bytes([0x90, 3]) + body[:2] + bytes([0]))
+                elif packet_type == _PINGREQ:
+                    writer.write(bytes([0xD0, 0]))
+                elif packet_type == _DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def __enter__(self) -> 'MqttBrokerStandIn':
+        """Start the broker."""
+        self._thread.start()
+
+        async def start() -> None:
+            self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+            self.host, self.port = self._server.sockets[0].getsockname()[:2]
+
+        asyncio.run_coroutine_threadsafe(start(), self._loop).result()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Stop the broker."""
+
+        async def stop() -> None:
+            if self._server is not None:
+                self._server.close()
+                await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -18,4 +18,45 @@ MI_ENTITIES = [
 
 PORT_ENTITIES = ['pv_voltage', 'pv_current', 'pv_power', 'today_production', 'total_production']
 
+# choices and defaults of options used by the modules and by the command line, defined here,
+# so the configuration can be parsed without importing MQTT and Modbus libraries
+MQTT_VERSION_311 = '3.1.1'
+MQTT_VERSION_5 = '5'
+MQTT_VERSIONS = [MQTT_VERSION_311, MQTT_VERSION_5]
+MQTT_QOS_LEVELS = [0, 1]
+DEFAULT_MAX_INFLIGHT = 20
+
+OVERRUN_SKIP = 'skip'
+OVERRUN_COALESCE = 'coalesce'
+OVERRUN_CATCH_UP = 'catch-up'
+OVERRUN_POLICIES = [OVERRUN_SKIP, OVERRUN_COALESCE, OVERRUN_CATCH_UP]
+DEFAULT_STATS_CYCLES = 60
+
+DEFAULT_BLOCK_RETRIES = 2
+
+DEFAULT_BACKOFF_BASE_SEC = 1.0
+DEFAULT_BACKOFF_MAX_SEC = 300.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_OPEN_PERIOD_SEC = 300.0
+
+DEFAULT_HISTORY_HOST = '127.0.0.1'
+
+DEFAULT_BUFFER_MAX_MESSAGES = 100000
+DEFAULT_BUFFER_RATE = 100.0
+
+DEFAULT_SAVE_INTERVAL_SEC = 300
+
+SNAPSHOT_FORMAT_JSON = 'json'
+SNAPSHOT_FORMAT_MSGPACK = 'msgpack'
+SNAPSHOT_FORMATS = [SNAPSHOT_FORMAT_JSON, SNAPSHOT_FORMAT_MSGPACK]
+DEFAULT_SNAPSHOT_TOPIC = 'hoymiles_mqtt/{dtu}/snapshot'
+
+OUTPUT_DEVICES = 'devices'
+OUTPUT_SNAPSHOT = 'snapshot'
+OUTPUT_BOTH = 'both'
+OUTPUT_MODES = [OUTPUT_DEVICES, OUTPUT_SNAPSHOT, OUTPUT_BOTH]
+
+RUNTIME_THREADS = 'threads'
+RUNTIME_ASYNCIO = 'asyncio'
+
 _main_logger = logging.getLogger(__name__)
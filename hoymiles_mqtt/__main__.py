@@ -3,19 +3,52 @@
 import argparse
 import logging
 import sys
+from typing import Tuple
 
 import configargparse
-from hoymiles_modbus.client import HoymilesModbusTCP
 
-from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES, _main_logger
-from hoymiles_mqtt.ha import HassMqtt
-from hoymiles_mqtt.mqtt import MqttPublisher
-from hoymiles_mqtt.runners import HoymilesQueryJob, run_periodic_job
+from hoymiles_mqtt import (
+    DEFAULT_BACKOFF_BASE_SEC,
+    DEFAULT_BLOCK_RETRIES,
+    DEFAULT_BUFFER_MAX_MESSAGES,
+    DEFAULT_BUFFER_RATE,
+    DEFAULT_FAILURE_THRESHOLD,
+    DEFAULT_HISTORY_HOST,
+    DEFAULT_MAX_INFLIGHT,
+    DEFAULT_OPEN_PERIOD_SEC,
+    DEFAULT_SAVE_INTERVAL_SEC,
+    DEFAULT_SNAPSHOT_TOPIC,
+    DEFAULT_STATS_CYCLES,
+    MI_ENTITIES,
+    MQTT_QOS_LEVELS,
+    MQTT_VERSION_311,
+    MQTT_VERSIONS,
+    OUTPUT_DEVICES,
+    OUTPUT_MODES,
+    OVERRUN_POLICIES,
+    OVERRUN_SKIP,
+    PORT_ENTITIES,
+    RUNTIME_ASYNCIO,
+    RUNTIME_THREADS,
+    SNAPSHOT_FORMAT_JSON,
+    SNAPSHOT_FORMATS,
+    _main_logger,
+)
+from hoymiles_mqtt.adaptive import DEFAULT_DAWN_DURATION_SEC
+from hoymiles_mqtt.encoding import ENCODER_AUTO, ENCODERS, available_encoders
 
 DEFAULT_MQTT_PORT = 1883
 DEFAULT_MODBUS_PORT = 502
 DEFAULT_QUERY_PERIOD_SEC = 60
 DEFAULT_MODBUS_UNIT_ID = 1
+DEFAULT_FULL_REFRESH_CYCLES = 10
+DEFAULT_HISTORY_HOURS = 1.0
+
+CONFIG_SKIPPED_OPTIONS = {'help', 'config', 'print_config', 'check_config'}
+# attributes of options set by `_parse_args`
+CONFIG_DERIVED_OPTIONS = {'dtus'}
+CONFIG_SECRET_OPTIONS = {'mqtt_password'}
+CONFIG_SECRET_MASK = '***'
 
 logger = _main_logger.getChild('__main__')
 
@@ -34,7 +67,7 @@ def _setup_logger(options: configargparse.Namespace) -> None:
     _main_logger.setLevel(options.log_level)
 
 
-def _parse_args() -> argparse.Namespace:
+def _create_parser() -> configargparse.ArgParser:
     cfg_parser = configargparse.ArgParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter, prog='python3 -m hoymiles_mqtt'
     )
@@ -69,9 +102,72 @@ def _parse_args() -> argparse.Namespace:
             '--mqtt-tls option). Do not use in production environments.'
         ),
     )
-    cfg_parser.add('--dtu-host', required=True, type=str, env_var='DTU_HOST', help='Address of Hoymiles DTU')
     cfg_parser.add(
-        '--dtu-port', required=False, type=int, default=DEFAULT_MODBUS_PORT, env_var='DTU_PORT', help='DTU modbus port'
+        '--mqtt-connect-per-cycle',
+        required=False,
+        default=False,
+        action='store_true',
+        env_var='MQTT_CONNECT_PER_CYCLE',
+        help=(
+            'Open a new connection to MQTT broker for each query period instead of keeping one connection open. '
+            'By default the connection is kept open and automatically re-established when lost. '
+            'Note that with this option Home Assistant birth messages (homeassistant/status) are not received, '
+            'so configs and states are not republished when Home Assistant restarts.'
+        ),
+    )
+    cfg_parser.add(
+        '--mqtt-version',
+        required=False,
+        type=str,
+        default=MQTT_VERSION_311,
+        choices=MQTT_VERSIONS,
+        env_var='MQTT_VERSION',
+        help=(
+            'MQTT protocol version. With MQTT 5, states are published with topic aliases (topics are sent in full '
+            'only once per connection) and expire in the broker after --expire-after seconds (if set). '
+            'Falls back to 3.1.1 when not supported by the broker. Ignored with --mqtt-connect-per-cycle.'
+        ),
+    )
+    cfg_parser.add(
+        '--mqtt-qos',
+        required=False,
+        type=int,
+        default=0,
+        choices=MQTT_QOS_LEVELS,
+        env_var='MQTT_QOS',
+        help=(
+            'QoS of published messages. With QoS 1 the broker acknowledges each message, messages are sent without '
+            'waiting for acknowledgement of previous ones (up to --mqtt-max-inflight messages) and the ones not '
+            'acknowledged are resent after reconnection. Delivery ratio is logged and available in metrics.'
+        ),
+    )
+    cfg_parser.add(
+        '--mqtt-max-inflight',
+        required=False,
+        type=int,
+        default=DEFAULT_MAX_INFLIGHT,
+        env_var='MQTT_MAX_INFLIGHT',
+        help='Maximum number of messages with QoS 1 waiting for acknowledgement from MQTT broker.',
+    )
+    cfg_parser.add(
+        '--dtu-host',
+        required=True,
+        type=str,
+        nargs='+',
+        env_var='DTU_HOST',
+        help=(
+            'Address of Hoymiles DTU. Multiple DTUs can be given, each one as HOST[:PORT[:UNIT_ID]] '
+            '(for example: 192.168.1.100 192.168.1.101:5020:2), they are queried concurrently. '
+            'In environment variable or config file use list syntax: [192.168.1.100, 192.168.1.101].'
+        ),
+    )
+    cfg_parser.add(
+        '--dtu-port',
+        required=False,
+        type=int,
+        default=DEFAULT_MODBUS_PORT,
+        env_var='DTU_PORT',
+        help='DTU modbus port, used for DTUs without port given in --dtu-host',
     )
     cfg_parser.add(
         '--modbus-unit-id',
@@ -79,7 +175,7 @@ def _parse_args() -> argparse.Namespace:
         type=int,
         default=DEFAULT_MODBUS_UNIT_ID,
         env_var='MODBUS_UNIT_ID',
-        help='Modbus Unit ID',
+        help='Modbus Unit ID, used for DTUs without unit ID given in --dtu-host',
     )
     cfg_parser.add(
         '--query-period',
@@ -89,6 +185,90 @@ def _parse_args() -> argparse.Namespace:
         env_var='QUERY_PERIOD',
         help='How often (in seconds) DTU shall be queried.',
     )
+    cfg_parser.add(
+        '--night-query-period',
+        required=False,
+        type=int,
+        default=0,
+        env_var='NIGHT_QUERY_PERIOD',
+        help=(
+            "Query period (in seconds) used when all inverters are idle (at night). Inverters are considered idle "
+            "after a few consecutive queries without production and, if --latitude and --longitude are given, "
+            "when the sun is down. By default it is 0, which means that --query-period is always used."
+        ),
+    )
+    cfg_parser.add(
+        '--dawn-query-period',
+        required=False,
+        type=int,
+        default=0,
+        env_var='DAWN_QUERY_PERIOD',
+        help=(
+            "Only relevant with --night-query-period. Query period (in seconds) used after inverters started "
+            "producing following the night and, if --latitude and --longitude are given, around sunrise. "
+            "By default it is 0, which means --query-period."
+        ),
+    )
+    cfg_parser.add(
+        '--dawn-duration',
+        required=False,
+        type=int,
+        default=DEFAULT_DAWN_DURATION_SEC,
+        env_var='DAWN_DURATION',
+        help="Only relevant with --night-query-period. How long (in seconds) --dawn-query-period is used.",
+    )
+    cfg_parser.add(
+        '--latitude',
+        required=False,
+        type=float,
+        default=None,
+        env_var='LATITUDE',
+        help="Only relevant with --night-query-period. Latitude of the plant in degrees (north is positive).",
+    )
+    cfg_parser.add(
+        '--longitude',
+        required=False,
+        type=float,
+        default=None,
+        env_var='LONGITUDE',
+        help="Only relevant with --night-query-period. Longitude of the plant in degrees (east is positive).",
+    )
+    cfg_parser.add(
+        '--overrun-policy',
+        required=False,
+        type=str,
+        default=OVERRUN_SKIP,
+        choices=OVERRUN_POLICIES,
+        env_var='OVERRUN_POLICY',
+        help=(
+            "What to do when querying DTU and publishing takes longer than the query period: "
+            "'skip' - skip missed periods, 'coalesce' - query once immediately, "
+            "'catch-up' - query immediately for each missed period. Queries are aligned to wall-clock "
+            "boundaries of the query period (for example to full minutes for the period of 60 seconds)."
+        ),
+    )
+    cfg_parser.add(
+        '--runtime',
+        required=False,
+        type=str,
+        default=RUNTIME_THREADS,
+        choices=[RUNTIME_THREADS, RUNTIME_ASYNCIO],
+        env_var='RUNTIME',
+        help=(
+            "Runtime used for querying DTUs and publishing. 'threads' - each DTU is queried and its data published "
+            "by a dedicated thread. 'asyncio' - DTUs are queried by asyncio tasks, publishing is done by a separate "
+            "task, so a slow MQTT broker does not delay queries (--overrun-policy is not used, missed periods are "
+            "skipped)."
+        ),
+    )
+    cfg_parser.add(
+        '--scheduler-stats-cycles',
+        required=False,
+        type=int,
+        default=DEFAULT_STATS_CYCLES,
+        env_var='SCHEDULER_STATS_CYCLES',
+        help="Number of query periods after which timing statistics are logged (INFO level). 0 disables them.",
+    )
     cfg_parser.add(
         '--mi-entities',
         required=False,
@@ -120,6 +300,274 @@ def _parse_args() -> argparse.Namespace:
             "such as daily energy production (they never expire)."
         ),
     )
+    cfg_parser.add(
+        '--output-mode',
+        required=False,
+        type=str,
+        default=OUTPUT_DEVICES,
+        choices=OUTPUT_MODES,
+        env_var='OUTPUT_MODE',
+        help=(
+            "What is published in each query period. 'devices' - states of DTU, each microinverter and port on "
+            "their own topics (with Home Assistant discovery configs), 'snapshot' - all data from DTU in one "
+            "message on --snapshot-topic, with arrays of values of all microinverters and ports, "
+            "'both' - both of them."
+        ),
+    )
+    cfg_parser.add(
+        '--snapshot-topic',
+        required=False,
+        type=str,
+        default=DEFAULT_SNAPSHOT_TOPIC,
+        env_var='SNAPSHOT_TOPIC',
+        help="Only relevant with --output-mode snapshot or both. Topic of snapshots, {dtu} is replaced with DTU "
+        "serial number.",
+    )
+    cfg_parser.add(
+        '--snapshot-format',
+        required=False,
+        type=str,
+        default=SNAPSHOT_FORMAT_JSON,
+        choices=SNAPSHOT_FORMATS,
+        env_var='SNAPSHOT_FORMAT',
+        help="Only relevant with --output-mode snapshot or both. Encoding of snapshots.",
+    )
+    cfg_parser.add(
+        '--json-encoder',
+        required=False,
+        type=str,
+        default=ENCODER_AUTO,
+        choices=ENCODERS,
+        env_var='JSON_ENCODER',
+        help=(
+            "Library used for encoding of MQTT payloads to JSON. 'auto' selects the fastest installed one "
+            "(orjson, msgspec, then standard json module)."
+        ),
+    )
+    cfg_parser.add(
+        '--delta-publish',
+        required=False,
+        default=False,
+        action='store_true',
+        env_var='DELTA_PUBLISH',
+        help=(
+            "Publish states of DTU, microinverters and ports only when they changed since the previous query. "
+            "All states are still published periodically, see --full-refresh-cycles and --full-refresh-period."
+        ),
+    )
+    cfg_parser.add(
+        '--full-refresh-cycles',
+        required=False,
+        type=int,
+        default=DEFAULT_FULL_REFRESH_CYCLES,
+        env_var='FULL_REFRESH_CYCLES',
+        help=(
+            "Only relevant with --delta-publish. Number of query periods after which all states are published "
+            "regardless of changes. 0 disables this refresh."
+        ),
+    )
+    cfg_parser.add(
+        '--full-refresh-period',
+        required=False,
+        type=int,
+        default=0,
+        env_var='FULL_REFRESH_PERIOD',
+        help=(
+            "Only relevant with --delta-publish. Number of seconds after which all states are published "
+            "regardless of changes. By default it is 0, which means half of --expire-after, so entities "
+            "do not expire in Home Assistant when their values do not change."
+        ),
+    )
+    cfg_parser.add(
+        '--device-ttl',
+        required=False,
+        type=float,
+        default=0,
+        env_var='DEVICE_TTL',
+        help=(
+            "Number of seconds after which microinverters and ports which are no longer reported by DTU (for example "
+            "replaced ones) are forgotten - removed from energy production caches and DTU totals. Should be longer "
+            "than a night, when DTU may not report idle microinverters. By default it is 0, which means that devices "
+            "are never forgotten."
+        ),
+    )
+    cfg_parser.add(
+        '--clear-evicted-configs',
+        required=False,
+        default=False,
+        action='store_true',
+        env_var='CLEAR_EVICTED_CONFIGS',
+        help=(
+            "Only relevant with --device-ttl. Clear retained configs of forgotten devices (empty retained messages), "
+            "so their entities are removed from Home Assistant."
+        ),
+    )
+    cfg_parser.add(
+        '--offline-buffer',
+        required=False,
+        type=str,
+        default=None,
+        env_var='OFFLINE_BUFFER',
+        help=(
+            "Path of a file (SQLite database) where state messages are stored when they cannot be published, "
+            "for example when MQTT broker is not reachable. The messages are published in the original order "
+            "when the broker is reachable again. By default such messages are dropped."
+        ),
+    )
+    cfg_parser.add(
+        '--offline-buffer-size',
+        required=False,
+        type=int,
+        default=DEFAULT_BUFFER_MAX_MESSAGES,
+        env_var='OFFLINE_BUFFER_SIZE',
+        help="Only relevant with --offline-buffer. Max number of stored messages, the oldest ones are evicted.",
+    )
+    cfg_parser.add(
+        '--offline-buffer-rate',
+        required=False,
+        type=float,
+        default=DEFAULT_BUFFER_RATE,
+        env_var='OFFLINE_BUFFER_RATE',
+        help="Only relevant with --offline-buffer. Max number of stored messages published per second.",
+    )
+    cfg_parser.add(
+        '--production-cache',
+        required=False,
+        type=str,
+        default=None,
+        env_var='PRODUCTION_CACHE',
+        help=(
+            "Path of a file where energy production of microinverters is saved, so it is restored after restart "
+            "and the production reported for DTU does not drop temporarily. Today production is restored only "
+            "on the same day. By default production is not saved."
+        ),
+    )
+    cfg_parser.add(
+        '--production-cache-interval',
+        required=False,
+        type=int,
+        default=DEFAULT_SAVE_INTERVAL_SEC,
+        env_var='PRODUCTION_CACHE_INTERVAL',
+        help="Only relevant with --production-cache. Min number of seconds between saving of energy production.",
+    )
+    cfg_parser.add(
+        '--metrics-port',
+        required=False,
+        type=int,
+        default=0,
+        env_var='METRICS_PORT',
+        help=(
+            "Port of HTTP endpoint (/metrics) with metrics in Prometheus format: timings of reading, building and "
+            "publishing, errors and numbers of sent messages. By default it is 0, which means no endpoint."
+        ),
+    )
+    cfg_parser.add(
+        '--metrics-host',
+        required=False,
+        type=str,
+        default='0.0.0.0',
+        env_var='METRICS_HOST',
+        help="Only relevant with --metrics-port. Address the metrics endpoint listens on.",
+    )
+    cfg_parser.add(
+        '--history-port',
+        required=False,
+        type=int,
+        default=0,
+        env_var='HISTORY_PORT',
+        help=(
+            "Port of HTTP endpoint (/history) with recent values of DTU, microinverter and port entities in JSON, "
+            "kept in memory for --history-hours. By default it is 0, which means no history."
+        ),
+    )
+    cfg_parser.add(
+        '--history-host',
+        required=False,
+        type=str,
+        default=DEFAULT_HISTORY_HOST,
+        env_var='HISTORY_HOST',
+        help="Only relevant with --history-port. Address the history endpoint listens on.",
+    )
+    cfg_parser.add(
+        '--history-hours',
+        required=False,
+        type=float,
+        default=DEFAULT_HISTORY_HOURS,
+        env_var='HISTORY_HOURS',
+        help=(
+            "Only relevant with --history-port. Number of hours of history, kept as one value per query period "
+            "(longer when the query period is lengthened at night)."
+        ),
+    )
+    cfg_parser.add(
+        '--publish-window',
+        required=False,
+        type=float,
+        default=0,
+        env_var='PUBLISH_WINDOW',
+        help=(
+            "Number of seconds over which data from DTU is aggregated before publishing (must not be shorter "
+            "than --query-period). States are published once per window: measurements as means with "
+            "<entity>_min, <entity>_max, <entity>_mean and <entity>_last, energy production as the last values "
+            "with <entity>_delta. By default it is 0, which means that each data set is published."
+        ),
+    )
+    cfg_parser.add(
+        '--block-reads',
+        required=False,
+        default=False,
+        action='store_true',
+        env_var='BLOCK_READS',
+        help=(
+            "Read data of each microinverter port from DTU separately, retry only the reads which failed and "
+            "publish data of the ports which were read. Ports which could not be read become unavailable in "
+            "Home Assistant. By default all data is read at once and nothing is published when any read fails. "
+            "Ports are read one request at a time, as by default, so reading is not faster."
+        ),
+    )
+    cfg_parser.add(
+        '--block-retries',
+        required=False,
+        type=int,
+        default=DEFAULT_BLOCK_RETRIES,
+        env_var='BLOCK_RETRIES',
+        help=(
+            "Only relevant with --block-reads. Max number of additional attempts of reading data of a port "
+            "in each query (on top of --comm-retries)."
+        ),
+    )
+    cfg_parser.add(
+        '--modbus-connect-per-cycle',
+        required=False,
+        default=False,
+        action='store_true',
+        env_var='MODBUS_CONNECT_PER_CYCLE',
+        help=(
+            'Open a new connection to DTU for each query period instead of keeping one connection open. '
+            'By default the connection is kept open, checked before each query and re-established when it is '
+            'closed by DTU or a query fails. After a failure, connecting is paused with exponential backoff, '
+            'see --comm-reconnect-delay and --comm-reconnect-delay-max.'
+        ),
+    )
+    cfg_parser.add(
+        '--modbus-failure-threshold',
+        required=False,
+        type=int,
+        default=DEFAULT_FAILURE_THRESHOLD,
+        env_var='MODBUS_FAILURE_THRESHOLD',
+        help=(
+            "Number of consecutive failed queries after which DTU is not queried for --modbus-circuit-open-period "
+            "seconds (for example while it is rebooting). 0 disables the pause."
+        ),
+    )
+    cfg_parser.add(
+        '--modbus-circuit-open-period',
+        required=False,
+        type=float,
+        default=DEFAULT_OPEN_PERIOD_SEC,
+        env_var='MODBUS_CIRCUIT_OPEN_PERIOD',
+        help="Number of seconds DTU is not queried after --modbus-failure-threshold consecutive failed queries.",
+    )
     cfg_parser.add(
         '--comm-timeout',
         required=False,
@@ -146,7 +594,9 @@ def _parse_args() -> argparse.Namespace:
         "delay in seconds.milliseconds before reconnecting. "
         "Doubles automatically with each unsuccessful connect, from "
         "**reconnect_delay** to **reconnect_delay_max**. "
-        "Default is 0 which means that reconnecting is disabled.",
+        "Default is 0 which means that reconnecting is disabled. "
+        f"For the persistent connection to DTU, it is the pause after the first failed query "
+        f"({DEFAULT_BACKOFF_BASE_SEC}s when 0).",
     )
     cfg_parser.add(
         '--comm-reconnect-delay-max',
@@ -182,36 +632,94 @@ def _parse_args() -> argparse.Namespace:
         env_var='LOG_TO_CONSOLE',
         help="Enable logging to console.",
     )
-    return cfg_parser.parse_args()
+    cfg_parser.add(
+        '--print-config',
+        required=False,
+        action='store_true',
+        default=False,
+        help=(
+            "Print the effective configuration (from command line, environment variables, config file and "
+            "defaults) in config file format, with the MQTT password masked, and exit."
+        ),
+    )
+    cfg_parser.add(
+        '--check-config',
+        required=False,
+        action='store_true',
+        default=False,
+        help="Check the configuration and exit, with non-zero status when it is invalid.",
+    )
+    return cfg_parser
+
+
+def _parse_args(cfg_parser: configargparse.ArgParser) -> argparse.Namespace:
+    options = cfg_parser.parse_args()
+    try:
+        options.dtus = [
+            _parse_dtu_address(value, options.dtu_port, options.modbus_unit_id) for value in options.dtu_host
+        ]
+    except ValueError as exc:
+        cfg_parser.error(str(exc))
+    if options.json_encoder != ENCODER_AUTO and options.json_encoder not in available_encoders():
+        cfg_parser.error(f'JSON encoder {options.json_encoder} is not installed')
+    if (options.latitude is None) != (options.longitude is None):
+        cfg_parser.error('--latitude and --longitude must be given together')
+    if options.publish_window and options.publish_window < options.query_period:
+        cfg_parser.error('--publish-window must not be shorter than --query-period')
+    if options.mqtt_max_inflight < 1:
+        cfg_parser.error('--mqtt-max-inflight must be positive')
+    return options
+
+
+def _parse_dtu_address(value: str, default_port: int, default_unit_id: int) -> Tuple[str, int, int]:
+    """Parse DTU address given as HOST[:PORT[:UNIT_ID]]."""
+    parts = value.split(':')
+    if len(parts) > 3 or not parts[0]:
+        raise ValueError(f'Invalid DTU address {value}, expected HOST[:PORT[:UNIT_ID]]')
+    try:
+        port = int(parts[1]) if len(parts) > 1 and parts[1] else default_port
+        unit_id = int(parts[2]) if len(parts) > 2 and parts[2] else default_unit_id
+    except ValueError:
+        raise ValueError(f'Invalid DTU address {value}, expected HOST[:PORT[:UNIT_ID]]') from None
+    return parts[0], port, unit_id
+
+
+def _format_config(options: argparse.Namespace) -> str:
+    """Format the configuration as a config file (`--config`).
+
+    Names of options in the file are derived from attributes of the parsed options, in the order they were
+    defined, without the ones set by `_parse_args` and the ones not stored in config files.
+
+    """
+    lines = []
+    for name, value in vars(options).items():
+        if name in CONFIG_SKIPPED_OPTIONS or name in CONFIG_DERIVED_OPTIONS or value is None:
+            continue
+        if name in CONFIG_SECRET_OPTIONS:
+            value = CONFIG_SECRET_MASK
+        elif isinstance(value, bool):
+            value = str(value).lower()
+        elif isinstance(value, list):
+            value = f"[{', '.join(str(item) for item in value)}]"
+        lines.append(f"{name.replace('_', '-')} = {value}")
+    return '\n'.join(lines)
 
 
 def main():
     """Main entry point."""
-    options = _parse_args()
+    cfg_parser = _create_parser()
+    options = _parse_args(cfg_parser)
+    if options.print_config:
+        print(_format_config(options))
+        return
+    if options.check_config:
+        print('Configuration is valid.')
+        return
     _setup_logger(options)
-    mqtt_builder = HassMqtt(
-        mi_entities=options.mi_entities, port_entities=options.port_entities, expire_after=options.expire_after
-    )
-    modbus_client = HoymilesModbusTCP(
-        host=options.dtu_host,
-        port=options.dtu_port,
-        unit_id=options.modbus_unit_id,
-    )
-    modbus_client.comm_params.timeout = options.comm_timeout
-    modbus_client.comm_params.retries = options.comm_retries
-    modbus_client.comm_params.reconnect_delay = options.comm_reconnect_delay
-    modbus_client.comm_params.reconnect_delay = options.comm_reconnect_delay_max
-
-    mqtt_publisher = MqttPublisher(
-        mqtt_broker=options.mqtt_broker,
-        mqtt_port=options.mqtt_port,
-        mqtt_user=options.mqtt_user,
-        mqtt_password=options.mqtt_password,
-        mqtt_tls=options.mqtt_tls,
-        mqtt_tls_insecure=options.mqtt_tls_insecure,
-    )
-    query_job = HoymilesQueryJob(mqtt_builder=mqtt_builder, mqtt_publisher=mqtt_publisher, modbus_client=modbus_client)
-    run_periodic_job(period=options.query_period, job=query_job.execute)
+    # MQTT and Modbus libraries are imported only when running, they are slow to import on small devices
+    from hoymiles_mqtt.app import run
+
+    run(options)
 
 
 if __name__ == '__main__':
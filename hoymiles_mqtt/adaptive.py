@@ -0,0 +1,140 @@
+"""Adaptive query period.
+
+At night all inverters are idle, so querying DTU as often as during the day only loads DTU, network and MQTT
+broker. `AdaptivePeriod` lengthens the query period when all inverters report that they are idle and shortens it
+at dawn, when inverters start producing, so changes are caught quickly. Optionally, sunrise and sunset are
+computed from the location of the plant, so querying is more frequent around sunrise, before inverters wake up.
+
+"""
+
+import math
+import time
+from typing import TYPE_CHECKING, Callable, Optional, Tuple
+
+from hoymiles_mqtt import _main_logger
+
+if TYPE_CHECKING:
+    from hoymiles_modbus.datatypes import PlantData
+
+logger = _main_logger.getChild('adaptive')
+
+DEFAULT_DAWN_DURATION_SEC = 3600
+IDLE_CYCLES = 3
+SUN_MARGIN_SEC = 1800
+
+_J2000_UNIX_DAYS = 10957
+_SUN_ALTITUDE = math.radians(-0.833)
+_EARTH_TILT = math.radians(23.4397)
+
+
+def sun_times(timestamp: float, latitude: float, longitude: float) -> Tuple[float, float]:
+    """Calculate sunrise and sunset for the day of the given time, at the given location.
+
+    Uses the sunrise equation, accurate to a few minutes. During polar night sunrise and sunset are both at
+    solar noon, during polar day they are half a day before and after solar noon.
+
+    Arguments:
+        timestamp: time (seconds since the epoch) within the day
+        latitude: latitude in degrees, north is positive
+        longitude: longitude in degrees, east is positive
+
+    Returns:
+        sunrise and sunset, seconds since the epoch
+
+    """
+    # days since J2000.0 of the local solar day
+    day = math.floor(timestamp / 86400 + longitude / 360) - _J2000_UNIX_DAYS
+    mean_solar_time = day - longitude / 360
+    anomaly = math.radians((357.5291 + 0.98560028 * mean_solar_time) % 360)
+    center = 1.9148 * math.sin(anomaly) + 0.02 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic_longitude = math.radians((math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = mean_solar_time + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic_longitude)
+    declination = math.asin(math.sin(ecliptic_longitude) * math.sin(_EARTH_TILT))
+    phi = math.radians(latitude)
+    cos_hour_angle = (math.sin(_SUN_ALTITUDE) - math.sin(phi) * math.sin(declination)) / (
+        math.cos(phi) * math.cos(declination)
+    )
+    hour_angle = math.degrees(math.acos(min(1.0, max(-1.0, cos_hour_angle))))
+    noon = (transit + _J2000_UNIX_DAYS + 0.5) * 86400
+    return noon - hour_angle / 360 * 86400, noon + hour_angle / 360 * 86400
+
+
+class AdaptivePeriod:
+    """Query period depending on the operating state of the plant.
+
+    - night period - used when all inverters were idle (zero operating status and power) in `IDLE_CYCLES`
+      consecutive queries and, if the location is known, the sun is down
+    - dawn period - used for `dawn_duration` after inverters started producing following the night and,
+      if the location is known, around sunrise
+    - day period - otherwise
+
+    The object is callable, it returns the current period.
+
+    """
+
+    def __init__(
+        self,
+        day_period: float,
+        night_period: float,
+        dawn_period: float,
+        dawn_duration: float = DEFAULT_DAWN_DURATION_SEC,
+        location: Optional[Tuple[float, float]] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            day_period: query period during the day, in seconds
+            night_period: query period at night, in seconds
+            dawn_period: query period at dawn, in seconds
+            dawn_duration: number of seconds the dawn period is used after inverters started producing
+            location: latitude and longitude of the plant in degrees, for calculation of sunrise and sunset
+            clock: source of current time (seconds since the epoch)
+
+        """
+        self._day_period = day_period
+        self._night_period = night_period
+        self._dawn_period = dawn_period
+        self._dawn_duration = dawn_duration
+        self._location = location
+        self._clock = clock
+        self._idle_cycles = 0
+        self._dawn_until = float('-inf')
+
+    @property
+    def is_night(self) -> bool:
+        """Whether all inverters were idle in the recent queries."""
+        return self._idle_cycles >= IDLE_CYCLES
+
+    def update(self, plant_data: 'PlantData') -> None:
+        """Update the operating state with data from DTU.
+
+        Arguments:
+            plant_data: data from DTU
+
+        """
+        producing = any(inverter.operating_status or inverter.pv_power for inverter in plant_data.inverters)
+        if producing:
+            if self.is_night:
+                logger.info('Inverters started producing, query period %ss.', self._dawn_period)
+                self._dawn_until = self._clock() + self._dawn_duration
+            self._idle_cycles = 0
+        else:
+            self._idle_cycles += 1
+            if self._idle_cycles == IDLE_CYCLES:
+                logger.info('All inverters are idle, query period %ss when the sun is down.', self._night_period)
+
+    def __call__(self) -> float:
+        """Get the current query period."""
+        now = self._clock()
+        sun_down = True
+        if self._location is not None:
+            sunrise, sunset = sun_times(now, *self._location)
+            if sunrise - SUN_MARGIN_SEC <= now < sunrise + SUN_MARGIN_SEC:
+                return self._dawn_period
+            sun_down = not sunrise - SUN_MARGIN_SEC <= now < sunset + SUN_MARGIN_SEC
+        if now < self._dawn_until:
+            return self._dawn_period
+        if self.is_night and sun_down:
+            return self._night_period
+        return self._day_period
@@ -0,0 +1,285 @@
+"""Asyncio runtime.
+
+Acquisition of data from DTUs and publication to MQTT broker are separate tasks, connected by a bounded queue.
+Each DTU is read by its own task, so a slow DTU does not delay the others, and a slow MQTT broker
+does not delay reading of DTUs.
+
+"""
+
+import asyncio
+import signal
+import time
+from dataclasses import asdict
+from typing import Dict, List, Optional, Tuple
+
+# private API of hoymiles_modbus, its exact version is pinned in pyproject.toml
+from hoymiles_modbus._modbus_tcp_client import _CustomReadHoldingRegistersResponse
+from hoymiles_modbus.client import HoymilesModbusTCP
+from hoymiles_modbus.datatypes import CommunicationParams, InverterData, PlantData, _serial_number_t
+from pymodbus.client import AsyncModbusTcpClient
+
+from hoymiles_mqtt import _main_logger
+from hoymiles_mqtt.blocks import (
+    DTU_REGISTERS_COUNT,
+    DTU_REGISTERS_START,
+    INVERTER_REGISTERS_COUNT,
+    BlockLayout,
+    BlockResult,
+    block_address,
+    calculate_plant_data,
+    unpack_block,
+)
+from hoymiles_mqtt.connection import ReconnectPolicy
+from hoymiles_mqtt.runners import HoymilesQueryJob, log_read_failure
+
+logger = _main_logger.getChild('aio')
+
+DEFAULT_QUEUE_SIZE = 10
+
+
+class AsyncHoymilesModbusTCP:
+    """Hoymiles Modbus TCP client based on asyncio pymodbus client.
+
+    The counterpart of `HoymilesModbusTCP` for the asyncio runtime.
+
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int = 502,
+        unit_id: int = 1,
+        comm_params: Optional[CommunicationParams] = None,
+        block_layout: Optional[BlockLayout] = None,
+        policy: Optional[ReconnectPolicy] = None,
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            host: DTU address
+            port: target DTU modbus TCP port
+            unit_id: Modbus unit ID
+            comm_params: low level communication parameters
+            block_layout: when given, data of microinverter ports is read block by block with retries
+                          and partial results, see `hoymiles_mqtt.blocks`
+            policy: backoff and circuit breaker, when given the connection to DTU is kept open across reads,
+                    see `hoymiles_mqtt.connection`
+
+        """
+        self._host = host
+        self._port = port
+        self._unit_id = unit_id
+        self._comm_params = comm_params or CommunicationParams()
+        self._block_layout = block_layout
+        self._policy = policy
+        self._client: Optional[AsyncModbusTcpClient] = None
+        self._dtu_serial_number = ''
+
+    @property
+    def host(self) -> str:
+        """DTU address."""
+        return self._host
+
+    @property
+    def comm_params(self) -> CommunicationParams:
+        """Low level communication parameters."""
+        return self._comm_params
+
+    def _get_client(self) -> AsyncModbusTcpClient:
+        client = AsyncModbusTcpClient(host=self._host, port=self._port, **asdict(self._comm_params))
+        # some DTUs send responses with wrong data size byte
+        client.register(_CustomReadHoldingRegistersResponse)
+        return client
+
+    async def _connect(self) -> AsyncModbusTcpClient:
+        if self._policy is not None:
+            self._policy.check()
+            if self._client is not None and self._client.connected:
+                return self._client
+        client = self._get_client()
+        start = time.perf_counter()
+        if not await client.connect():
+            if self._policy is not None:
+                self._policy.failure()
+            raise ConnectionError(f'Failed to connect to DTU {self._host}:{self._port}')
+        if self._policy is not None:
+            self._policy.connected(time.perf_counter() - start)
+            self._client = client
+        return client
+
+    def close(self) -> None:
+        """Close the persistent connection (if used)."""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+            if self._policy is not None:
+                self._policy.disconnected()
+
+    async def _read_registers(self, client: AsyncModbusTcpClient, start_address: int, count: int) -> bytes:
+        start = time.perf_counter()
+        result = await client.read_holding_registers(start_address, count=count, device_id=self._unit_id)
+        if self._policy is not None:
+            self._policy.record_latency(time.perf_counter() - start)
+        if result.isError():
+            raise RuntimeError(f'Received error response {result}')
+        return result.encode()
+
+    async def _read_block(self, client: AsyncModbusTcpClient, index: int) -> Optional[InverterData]:
+        return unpack_block(
+            index, (await self._read_registers(client, block_address(index), INVERTER_REGISTERS_COUNT))[1:41]
+        )
+
+    async def _read_inverters(self, client: AsyncModbusTcpClient) -> List[InverterData]:
+        data: List[InverterData] = []
+        for i in range(HoymilesModbusTCP._MAX_INVERTER_COUNT):
+            inverter_data = await self._read_block(client, i)
+            if inverter_data is None:
+                break
+            data.append(inverter_data)
+        return data
+
+    async def _read_blocks(
+        self, client: AsyncModbusTcpClient, layout: BlockLayout
+    ) -> Tuple[List[InverterData], List[Tuple[str, int]]]:
+        # the same as `hoymiles_mqtt.blocks.read_blocks`, with awaited reads
+        scan = layout.scan()
+        try:
+            index = next(scan)
+            while True:
+                result: BlockResult
+                try:
+                    result = await self._read_block(client, index)
+                except Exception as exc:
+                    result = exc
+                index = scan.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+    async def _read_dtu_serial_number(self, client: AsyncModbusTcpClient) -> str:
+        attempts = 1 if self._block_layout is None else self._block_layout.retries + 1
+        for attempt in range(attempts):
+            try:
+                result = await self._read_registers(client, DTU_REGISTERS_START, DTU_REGISTERS_COUNT)
+            except Exception:
+                if attempt == attempts - 1:
+                    raise
+            else:
+                return _serial_number_t.unpack(result[1:])
+        raise AssertionError('unreachable')
+
+    async def get_plant_data(self) -> PlantData:
+        """Read plant status data from DTU."""
+        client = await self._connect()
+        try:
+            if not self._dtu_serial_number:
+                self._dtu_serial_number = await self._read_dtu_serial_number(client)
+            missing_ports: List[Tuple[str, int]] = []
+            if self._block_layout is None:
+                inverters = await self._read_inverters(client)
+            else:
+                inverters, missing_ports = await self._read_blocks(client, self._block_layout)
+        except Exception:
+            if self._policy is not None:
+                self.close()
+                self._policy.failure()
+            raise
+        finally:
+            if self._policy is None:
+                client.close()
+        if self._policy is not None:
+            self._policy.success()
+        return calculate_plant_data(self._dtu_serial_number, inverters, missing_ports)
+
+
+async def _acquire(
+    name: str,
+    modbus_client: AsyncHoymilesModbusTCP,
+    query_job: HoymilesQueryJob,
+    period: float,
+    queue: 'asyncio.Queue[Tuple[str, HoymilesQueryJob, PlantData, float]]',
+) -> None:
+    loop = asyncio.get_running_loop()
+    get_period = query_job.adaptive_period or (lambda: period)
+    current_period = get_period()
+    # align to wall-clock boundaries of the period, the same way as `PeriodicScheduler`
+    tick = loop.time() + (-time.time()) % current_period
+    while True:
+        await asyncio.sleep(max(0.0, tick - loop.time()))
+        logger.debug("Read data from DTU %s", name)
+        metrics = query_job.metrics
+        start = time.perf_counter()
+        try:
+            plant_data = await modbus_client.get_plant_data()
+        except Exception as exc:
+            log_read_failure(exc)
+            logger.warning("No DTU data received from %s!", name)
+            if metrics is not None:
+                metrics.read_error(exc)
+        else:
+            if metrics is not None:
+                metrics.read_time.observe(time.perf_counter() - start)
+                metrics.last_poll.set(time.time())
+            if queue.full():
+                queue.get_nowait()
+                queue.task_done()
+                logger.warning('Publishing does not keep up with reading DTUs, dropped the oldest data.')
+            queue.put_nowait((name, query_job, plant_data, time.time()))
+        new_period = get_period()
+        if new_period != current_period:
+            logger.info('Query period of DTU %s changed from %ss to %ss.', name, current_period, new_period)
+            current_period = new_period
+            tick = loop.time() + (-time.time()) % current_period
+            continue
+        tick += current_period
+        now = loop.time()
+        if tick <= now:
+            missed = int((now - tick) // current_period) + 1
+            logger.warning('Reading DTU %s took longer than the period, skipped %s tick(s).', name, missed)
+            tick += missed * current_period
+
+
+async def _publish(queue: 'asyncio.Queue[Tuple[str, HoymilesQueryJob, PlantData, float]]') -> None:
+    while True:
+        name, query_job, plant_data, acquired_at = await queue.get()
+        try:
+            # MQTT client runs its network loop in a background thread, publishing only waits for it
+            await asyncio.to_thread(query_job.publish, plant_data, acquired_at)
+        except Exception:
+            logger.exception("Failed to publish data from DTU %s.", name)
+        finally:
+            queue.task_done()
+
+
+async def run_async(
+    period: float,
+    dtus: Dict[str, Tuple[AsyncHoymilesModbusTCP, HoymilesQueryJob]],
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    stop_event: Optional[asyncio.Event] = None,
+) -> None:
+    """Read DTUs and publish their data periodically, until termination signal is received.
+
+    Arguments:
+        period: query period in seconds
+        dtus: Modbus client and query job (used for publishing) for each DTU, by DTU names
+        queue_size: max number of data sets waiting for publishing, the oldest data is dropped when exceeded
+        stop_event: event which stops the runtime, by default it is set by termination signals
+
+    """
+    loop = asyncio.get_running_loop()
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop_event.set)
+
+    queue: asyncio.Queue[Tuple[str, HoymilesQueryJob, PlantData, float]] = asyncio.Queue(maxsize=queue_size)
+    tasks = [
+        asyncio.create_task(_acquire(name, modbus_client, query_job, period, queue), name=name)
+        for name, (modbus_client, query_job) in dtus.items()
+    ]
+    tasks.append(asyncio.create_task(_publish(queue), name='publish'))
+    logger.info("Begin looping messages")
+    await stop_event.wait()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    logger.info("Done looping messages")
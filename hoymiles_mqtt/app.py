@@ -0,0 +1,234 @@
+"""Running of the tool - MQTT and Modbus clients, query jobs and the optional services.
+
+Imported by `hoymiles_mqtt.__main__` only after the configuration is parsed, so MQTT and Modbus libraries
+are not imported when only the configuration is printed or checked.
+
+"""
+
+import argparse
+import asyncio
+import math
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from hoymiles_modbus.datatypes import CommunicationParams
+
+from hoymiles_mqtt import DEFAULT_BACKOFF_BASE_SEC, OUTPUT_DEVICES, OUTPUT_SNAPSHOT, RUNTIME_ASYNCIO
+from hoymiles_mqtt.adaptive import AdaptivePeriod
+from hoymiles_mqtt.blocks import BlockLayout, BlockModbusTCP
+from hoymiles_mqtt.buffer import BufferDrainer, OfflineBuffer
+from hoymiles_mqtt.connection import ManagedModbusTCP, ReconnectPolicy
+from hoymiles_mqtt.downsampling import WindowAggregator
+from hoymiles_mqtt.encoding import get_encoder
+from hoymiles_mqtt.ha import HassMqtt
+from hoymiles_mqtt.history import HistoryServer, PlantHistory
+from hoymiles_mqtt.metrics import DtuMetrics, MetricsRegistry, MetricsServer
+from hoymiles_mqtt.mqtt import MqttPublisher
+from hoymiles_mqtt.persistence import ProductionCacheStore
+from hoymiles_mqtt.runners import HoymilesQueryJob, run_periodic_jobs
+from hoymiles_mqtt.snapshot import SnapshotOutput
+
+
+def _set_comm_params(options: argparse.Namespace, comm_params: CommunicationParams) -> None:
+    comm_params.timeout = options.comm_timeout
+    comm_params.retries = options.comm_retries
+    comm_params.reconnect_delay = options.comm_reconnect_delay
+    comm_params.reconnect_delay_max = options.comm_reconnect_delay_max
+
+
+def _create_reconnect_policy(
+    options: argparse.Namespace, name: str, metrics: Optional[DtuMetrics]
+) -> Optional[ReconnectPolicy]:
+    if options.modbus_connect_per_cycle:
+        return None
+    return ReconnectPolicy(
+        name=name,
+        backoff_base=options.comm_reconnect_delay or DEFAULT_BACKOFF_BASE_SEC,
+        backoff_max=options.comm_reconnect_delay_max,
+        failure_threshold=options.modbus_failure_threshold,
+        open_period=options.modbus_circuit_open_period,
+        metrics=metrics,
+    )
+
+
+def _create_modbus_client(
+    options: argparse.Namespace, host: str, port: int, unit_id: int, metrics: Optional[DtuMetrics] = None
+) -> ManagedModbusTCP:
+    policy = _create_reconnect_policy(options, f'{host}:{port}:{unit_id}', metrics)
+    modbus_client: ManagedModbusTCP
+    if options.block_reads:
+        modbus_client = BlockModbusTCP(
+            host=host, port=port, unit_id=unit_id, retries=options.block_retries, policy=policy
+        )
+    else:
+        modbus_client = ManagedModbusTCP(host=host, port=port, unit_id=unit_id, policy=policy)
+    _set_comm_params(options, modbus_client.comm_params)
+    return modbus_client
+
+
+def _create_adaptive_period(options: argparse.Namespace) -> Optional[AdaptivePeriod]:
+    if not options.night_query_period:
+        return None
+    location = None
+    if options.latitude is not None and options.longitude is not None:
+        location = (options.latitude, options.longitude)
+    return AdaptivePeriod(
+        day_period=options.query_period,
+        night_period=options.night_query_period,
+        dawn_period=options.dawn_query_period or options.query_period,
+        dawn_duration=options.dawn_duration,
+        location=location,
+    )
+
+
+def run(options: argparse.Namespace) -> None:
+    """Run the tool until termination signal is received.
+
+    Arguments:
+        options: parsed configuration, see `hoymiles_mqtt.__main__`
+
+    """
+    metrics_registry = None
+    metrics_server = None
+    if options.metrics_port:
+        metrics_registry = MetricsRegistry()
+        metrics_server = MetricsServer(metrics_registry, host=options.metrics_host, port=options.metrics_port)
+        metrics_server.start()
+    mqtt_publisher = MqttPublisher(
+        mqtt_broker=options.mqtt_broker,
+        mqtt_port=options.mqtt_port,
+        mqtt_user=options.mqtt_user,
+        mqtt_password=options.mqtt_password,
+        mqtt_tls=options.mqtt_tls,
+        mqtt_tls_insecure=options.mqtt_tls_insecure,
+        persistent_session=not options.mqtt_connect_per_cycle,
+        mqtt_version=options.mqtt_version,
+        message_expiry=options.expire_after,
+        qos=options.mqtt_qos,
+        max_inflight=options.mqtt_max_inflight,
+        metrics=metrics_registry,
+    )
+    offline_buffer = None
+    buffer_drainer = None
+    if options.offline_buffer:
+        offline_buffer = OfflineBuffer(path=options.offline_buffer, max_messages=options.offline_buffer_size)
+        buffer_drainer = BufferDrainer(
+            buffer=offline_buffer, mqtt_publisher=mqtt_publisher, rate=options.offline_buffer_rate
+        )
+        buffer_drainer.start()
+    # each DTU has its own builder (with its own production cache) and job,
+    # all of them publish through the same MQTT connection
+    jobs = {}
+    encoder = get_encoder(options.json_encoder)
+    for host, port, unit_id in options.dtus:
+        mqtt_builder = HassMqtt(
+            mi_entities=options.mi_entities,
+            port_entities=options.port_entities,
+            expire_after=options.expire_after,
+            delta=options.delta_publish,
+            full_refresh_cycles=options.full_refresh_cycles,
+            full_refresh_period=options.full_refresh_period,
+            encoder=encoder,
+            snapshot=(
+                SnapshotOutput(topic=options.snapshot_topic, payload_format=options.snapshot_format, encoder=encoder)
+                if options.output_mode != OUTPUT_DEVICES
+                else None
+            ),
+            device_topics=options.output_mode != OUTPUT_SNAPSHOT,
+            device_ttl=options.device_ttl,
+            clear_evicted_configs=options.clear_evicted_configs,
+        )
+        jobs[f'dtu_{host}:{port}:{unit_id}'] = (host, port, unit_id, mqtt_builder)
+    production_store = None
+    if options.production_cache:
+        production_store = ProductionCacheStore(
+            path=options.production_cache,
+            builders={name: mqtt_builder for name, (_, _, _, mqtt_builder) in jobs.items()},
+            save_interval=options.production_cache_interval,
+        )
+        production_store.load()
+    histories = {}
+    history_server = None
+    if options.history_port:
+        capacity = max(1, math.ceil(options.history_hours * 3600 / options.query_period))
+        histories = {name: PlantHistory(capacity) for name in jobs}
+        history_server = HistoryServer(histories, host=options.history_host, port=options.history_port, encoder=encoder)
+        history_server.start()
+    job_options: Dict[str, Dict[str, Any]] = {
+        name: {
+            'mqtt_publisher': mqtt_publisher,
+            'offline_buffer': offline_buffer,
+            'production_store': production_store,
+            'metrics': metrics_registry.for_dtu(f'{host}:{port}:{unit_id}') if metrics_registry else None,
+            'adaptive_period': _create_adaptive_period(options),
+            'history': histories.get(name),
+            'downsampler': WindowAggregator(options.publish_window) if options.publish_window else None,
+        }
+        for name, (host, port, unit_id, _) in jobs.items()
+    }
+    try:
+        if options.runtime == RUNTIME_ASYNCIO:
+            _run_asyncio(options, jobs, job_options)
+        else:
+            _run_threads(options, jobs, job_options)
+    finally:
+        if buffer_drainer is not None:
+            buffer_drainer.stop()
+        mqtt_publisher.close()
+        if offline_buffer is not None:
+            offline_buffer.close()
+        if production_store is not None:
+            production_store.save(force=True)
+        if metrics_server is not None:
+            metrics_server.stop()
+        if history_server is not None:
+            history_server.stop()
+
+
+def _run_threads(
+    options: argparse.Namespace,
+    jobs: Dict[str, Tuple[str, int, int, HassMqtt]],
+    job_options: Dict[str, Dict[str, Any]],
+) -> None:
+    query_jobs = {}
+    periods: Dict[str, Callable[[], float]] = {}
+    modbus_clients = []
+    for name, (host, port, unit_id, mqtt_builder) in jobs.items():
+        modbus_client = _create_modbus_client(options, host, port, unit_id, job_options[name]['metrics'])
+        modbus_clients.append(modbus_client)
+        query_job = HoymilesQueryJob(mqtt_builder=mqtt_builder, modbus_client=modbus_client, **job_options[name])
+        query_jobs[name] = query_job.execute
+        if query_job.adaptive_period is not None:
+            periods[name] = query_job.adaptive_period
+    try:
+        run_periodic_jobs(
+            period=options.query_period,
+            jobs=query_jobs,
+            overrun_policy=options.overrun_policy,
+            stats_cycles=options.scheduler_stats_cycles,
+            periods=periods,
+        )
+    finally:
+        for modbus_client in modbus_clients:
+            modbus_client.close()
+
+
+def _run_asyncio(
+    options: argparse.Namespace,
+    jobs: Dict[str, Tuple[str, int, int, HassMqtt]],
+    job_options: Dict[str, Dict[str, Any]],
+) -> None:
+    from hoymiles_mqtt.aio import AsyncHoymilesModbusTCP, run_async
+
+    dtus = {}
+    for name, (host, port, unit_id, mqtt_builder) in jobs.items():
+        modbus_client = AsyncHoymilesModbusTCP(
+            host=host,
+            port=port,
+            unit_id=unit_id,
+            block_layout=BlockLayout(retries=options.block_retries) if options.block_reads else None,
+            policy=_create_reconnect_policy(options, f'{host}:{port}:{unit_id}', job_options[name]['metrics']),
+        )
+        _set_comm_params(options, modbus_client.comm_params)
+        query_job = HoymilesQueryJob(mqtt_builder=mqtt_builder, **job_options[name])
+        dtus[name] = (modbus_client, query_job)
+    asyncio.run(run_async(period=options.query_period, dtus=dtus))
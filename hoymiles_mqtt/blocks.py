@@ -0,0 +1,287 @@
+"""Reading of DTU data block by block, with partial results.
+
+Data of each microinverter port is a separate block of registers in DTU. `HoymilesModbusTCP.plant_data` reads
+them in one go - when reading of any block fails, the whole data set is lost. With block reads, each block is
+read independently (sequentially, over one connection), only failed blocks are retried and data of the blocks
+which were read is returned. Ports which could not be read are listed in `PartialPlantData.missing_ports`,
+so they can be marked unavailable.
+
+The layout of blocks (number of ports and their serial numbers) is learnt from previous reads, so the reading
+continues after a failed block when it is known that more blocks follow.
+
+Block reads isolate failures, they are not faster. Blocks are read one request at a time - neither concurrent nor
+pipelined requests are sent, as DTUs serve Modbus requests one at a time and a DTU busy with a request may drop
+the next one, which would turn the latency gain into failed blocks. Without failures, a read takes the same round
+trips as `HoymilesModbusTCP.plant_data` (one per port, plus the end of data and the DTU serial number once).
+
+"""
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Generator, List, Optional, Tuple, Union
+
+from hoymiles_modbus.client import HoymilesModbusTCP
+from hoymiles_modbus.datatypes import InverterData, PlantData, _serial_number_t
+
+from hoymiles_mqtt import DEFAULT_BLOCK_RETRIES, _main_logger
+from hoymiles_mqtt.connection import ManagedModbusTCP, ReconnectPolicy
+
+logger = _main_logger.getChild('blocks')
+
+INVERTER_REGISTERS_START = 0x1000
+INVERTER_REGISTERS_STEP = 40
+INVERTER_REGISTERS_COUNT = 20
+DTU_REGISTERS_START = 0x2000
+DTU_REGISTERS_COUNT = 3
+
+# result of reading a block - port data, None for the null record (end of data) or the failure
+BlockResult = Union[InverterData, None, Exception]
+BlockScan = Generator[int, BlockResult, Tuple[List[InverterData], List[Tuple[str, int]]]]
+
+
+@dataclass
+class PartialPlantData(PlantData):
+    """Plant data without data of some microinverter ports (which could not be read)."""
+
+    missing_ports: List[Tuple[str, int]] = field(default_factory=list)
+    """Microinverter serial numbers and port numbers of ports which could not be read."""
+
+
+def calculate_plant_data(
+    dtu: str, inverters: List[InverterData], missing_ports: Optional[List[Tuple[str, int]]] = None
+) -> PlantData:
+    """Calculate data for the whole plant from inverters data.
+
+    Only active inverters are included (the same way as `HoymilesModbusTCP.plant_data`).
+
+    Arguments:
+        dtu: DTU serial number
+        inverters: data of all inverters
+        missing_ports: microinverter serial numbers and port numbers of ports which could not be read,
+                       `PartialPlantData` is returned when there are any
+
+    """
+    data = PartialPlantData(dtu, missing_ports=missing_ports) if missing_ports else PlantData(dtu)
+    data.inverters = inverters
+    for inverter in inverters:
+        if inverter.link_status:
+            data.pv_power += inverter.pv_power
+            data.today_production += inverter.today_production
+            data.total_production += inverter.total_production
+            if inverter.alarm_code:
+                data.alarm_flag = True
+    return data
+
+
+def block_address(index: int) -> int:
+    """Address of the first register of the block with the given index."""
+    return INVERTER_REGISTERS_START + index * INVERTER_REGISTERS_STEP
+
+
+def unpack_block(index: int, data: bytes) -> Optional[InverterData]:
+    """Unpack port data from the block content.
+
+    Arguments:
+        index: index of the block
+        data: content of the block registers
+
+    Returns:
+        port data, None for the null record which ends the data
+
+    Raises:
+        RuntimeError: inverters are not mapped in DTU yet
+
+    """
+    if index == 0 and not data:
+        raise RuntimeError("Inverters not mapped yet.")
+    inverter_data = InverterData.unpack(data)
+    if inverter_data.serial_number == HoymilesModbusTCP._NULL_INVERTER:
+        return None
+    return inverter_data
+
+
+class BlockLayout:
+    """Layout of blocks of a DTU, learnt from reads, and the procedure of reading them.
+
+    `scan` generates indexes of blocks to read and receives the results of reading, so the same procedure
+    is used for synchronous and asyncio clients.
+
+    """
+
+    def __init__(self, retries: int = DEFAULT_BLOCK_RETRIES) -> None:
+        """Initialize the object.
+
+        Arguments:
+            retries: max number of additional attempts of reading a failed block within a single read
+
+        """
+        self._retries = retries
+        self._count: Optional[int] = None
+        self._seen = 0
+        self._ports: Dict[int, Tuple[str, int]] = {}
+
+    @property
+    def retries(self) -> int:
+        """Max number of additional attempts of reading a failed block within a single read."""
+        return self._retries
+
+    @property
+    def count(self) -> Optional[int]:
+        """Number of blocks with port data, None until the end of data was read."""
+        return self._count
+
+    def _record(self, index: int, records: Dict[int, InverterData], port_data: InverterData) -> None:
+        records[index] = port_data
+        self._ports[index] = (port_data.serial_number, port_data.port_number)
+        self._seen = max(self._seen, index + 1)
+
+    def _scan_from(
+        self, start: int, records: Dict[int, InverterData], failed: Dict[int, Exception]
+    ) -> Generator[int, BlockResult, Optional[int]]:
+        """Read blocks from the given one until the end of data.
+
+        Returns:
+            index of a failed block after which the reading stopped, as it is unknown if more blocks follow,
+            None if the end of data was reached
+
+        """
+        for index in range(start, HoymilesModbusTCP._MAX_INVERTER_COUNT):
+            result = yield index
+            if isinstance(result, Exception):
+                failed[index] = result
+                # until the end of data is read, blocks read before are known to exist
+                if index >= (self._seen if self._count is None else self._count):
+                    return index
+            elif result is None:
+                self._count = index
+                return None
+            else:
+                self._record(index, records, result)
+        self._count = HoymilesModbusTCP._MAX_INVERTER_COUNT
+        return None
+
+    def scan(self) -> BlockScan:
+        """Read all blocks, retrying failed ones.
+
+        Yields:
+            index of a block to read, the result of reading (see `BlockResult`) is expected to be sent back
+
+        Returns:
+            data of ports which were read and serial numbers and port numbers of ports which could not be read
+
+        Raises:
+            Exception: the last failure, when no block could be read
+
+        """
+        records: Dict[int, InverterData] = {}
+        failed: Dict[int, Exception] = {}
+        stopped_at = yield from self._scan_from(0, records, failed)
+        for _ in range(self._retries):
+            if not failed:
+                break
+            retried, failed = failed, {}
+            for index in retried:
+                result = yield index
+                if isinstance(result, Exception):
+                    failed[index] = result
+                elif result is None:
+                    self._count = index
+                else:
+                    self._record(index, records, result)
+                    if index == stopped_at:
+                        stopped_at = yield from self._scan_from(index + 1, records, failed)
+        if failed and not records:
+            raise list(failed.values())[-1]
+        missing_ports = [self._ports[index] for index in failed if index in self._ports]
+        if failed:
+            logger.warning(
+                'Failed to read %s block(s) of microinverter data%s, publishing data of %s port(s).',
+                len(failed),
+                f' (ports {", ".join(f"{serial}/{port}" for serial, port in missing_ports)})' if missing_ports else '',
+                len(records),
+            )
+        return [records[index] for index in sorted(records)], missing_ports
+
+
+def read_blocks(layout: BlockLayout, read_block: Callable[[int], Optional[InverterData]]):
+    """Read all blocks with the given function.
+
+    Arguments:
+        layout: layout of blocks of the DTU
+        read_block: function reading the block with the given index
+
+    Returns:
+        the same as `BlockLayout.scan`
+
+    """
+    scan = layout.scan()
+    try:
+        index = next(scan)
+        while True:
+            result: BlockResult
+            try:
+                result = read_block(index)
+            except Exception as exc:
+                result = exc
+            index = scan.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+class BlockModbusTCP(ManagedModbusTCP):
+    """Hoymiles Modbus TCP client reading data of microinverter ports block by block.
+
+    Returns `PartialPlantData` when data of some ports could not be read, see `hoymiles_mqtt.blocks`.
+
+    """
+
+    _dtu_serial_number: str
+
+    def __init__(
+        self,
+        host: str,
+        port: int = 502,
+        unit_id: int = 1,
+        retries: int = DEFAULT_BLOCK_RETRIES,
+        policy: Optional[ReconnectPolicy] = None,
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            host: DTU address
+            port: target DTU modbus TCP port
+            unit_id: Modbus unit ID
+            retries: max number of additional attempts of reading a failed block within a single read
+            policy: backoff and circuit breaker of persistent connection, see `ManagedModbusTCP`
+
+        """
+        super().__init__(host=host, port=port, unit_id=unit_id, policy=policy)
+        self._layout = BlockLayout(retries=retries)
+
+    def _read_dtu_serial_number(self, client) -> str:
+        for attempt in range(self._layout.retries + 1):
+            try:
+                result = self._read_registers(client, DTU_REGISTERS_START, DTU_REGISTERS_COUNT, self._unit_id)
+            except Exception:
+                if attempt == self._layout.retries:
+                    raise
+            else:
+                return _serial_number_t.unpack(result.encode()[1:])
+        raise AssertionError('unreachable')
+
+    @property
+    def plant_data(self) -> PlantData:
+        """Plant status data.
+
+        Each `get` is a new request and data from the installation.
+
+        """
+        with self._get_client() as client:
+            if not self._dtu_serial_number:
+                self._dtu_serial_number = self._read_dtu_serial_number(client)
+
+            def read_block(index: int) -> Optional[InverterData]:
+                result = self._read_registers(client, block_address(index), INVERTER_REGISTERS_COUNT, self._unit_id)
+                return unpack_block(index, result.encode()[1:41])
+
+            inverters, missing_ports = read_blocks(self._layout, read_block)
+        return calculate_plant_data(self._dtu_serial_number, inverters, missing_ports)
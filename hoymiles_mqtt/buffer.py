@@ -0,0 +1,224 @@
+"""Offline store-and-forward buffer of MQTT messages.
+
+State messages which could not be published (for example during maintenance of MQTT broker) are stored
+in SQLite database (in WAL mode) together with the acquisition time of their data. When the broker is
+reachable again, the messages are published in batches, in the original order, with limited rate.
+
+"""
+
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from hoymiles_mqtt import DEFAULT_BUFFER_MAX_MESSAGES, DEFAULT_BUFFER_RATE, _main_logger
+
+if TYPE_CHECKING:
+    from hoymiles_mqtt.mqtt import MqttPublisher
+
+logger = _main_logger.getChild('buffer')
+
+DEFAULT_BATCH_SIZE = 50
+IDLE_DELAY_SEC = 1.0
+RETRY_DELAY_SEC = 10.0
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    acquired_at REAL NOT NULL,
+    topic TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    qos INTEGER NOT NULL,
+    retain INTEGER NOT NULL
+)
+'''
+
+
+class BufferedMessage(NamedTuple):
+    """Message stored in the offline buffer."""
+
+    id: int
+    acquired_at: float
+    topic: str
+    payload: bytes
+    qos: int
+    retain: bool
+
+
+class OfflineBuffer:
+    """Bounded, persistent FIFO of MQTT messages.
+
+    When the buffer is full, the oldest messages are evicted. The buffer can be shared between threads.
+
+    """
+
+    def __init__(self, path: str, max_messages: int = DEFAULT_BUFFER_MAX_MESSAGES) -> None:
+        """Initialize the object.
+
+        Arguments:
+            path: path of SQLite database file, created if it does not exist
+            max_messages: max number of stored messages
+
+        """
+        self._max_messages = max_messages
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(_SCHEMA)
+        self._count: int = self._db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        if self._count:
+            logger.info('Offline buffer contains %s messages waiting for publishing.', self._count)
+
+    def __len__(self) -> int:
+        """Return number of stored messages."""
+        return self._count
+
+    @property
+    def max_messages(self) -> int:
+        """Max number of stored messages."""
+        return self._max_messages
+
+    def add(
+        self, messages: Iterable[Tuple[str, Union[str, bytes]]], acquired_at: float, qos: int = 0, retain: bool = False
+    ) -> int:
+        """Store messages, evict the oldest ones when the buffer is full.
+
+        Arguments:
+            messages: topics and payloads
+            acquired_at: acquisition time (seconds since the epoch) of data in the messages
+            qos: quality of service level of the messages
+            retain: retain flag of the messages
+
+        Returns:
+            number of stored messages
+
+        """
+        rows = [
+            (acquired_at, topic, payload.encode() if isinstance(payload, str) else payload, qos, retain)
+            for topic, payload in messages
+        ]
+        with self._lock, self._db:
+            self._db.execute('BEGIN')
+            self._db.executemany(
+                'INSERT INTO messages (acquired_at, topic, payload, qos, retain) VALUES (?, ?, ?, ?, ?)', rows
+            )
+            self._count += len(rows)
+            evicted = self._count - self._max_messages
+            if evicted > 0:
+                self._db.execute(
+                    'DELETE FROM messages WHERE id IN (SELECT id FROM messages ORDER BY id LIMIT ?)', (evicted,)
+                )
+                self._count = self._max_messages
+        if evicted > 0:
+            logger.warning('Offline buffer is full, evicted %s oldest messages.', evicted)
+        return len(rows)
+
+    def peek(self, limit: int) -> List[BufferedMessage]:
+        """Get the oldest messages, without removing them.
+
+        Arguments:
+            limit: max number of messages
+
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, acquired_at, topic, payload, qos, retain FROM messages ORDER BY id LIMIT ?', (limit,)
+            ).fetchall()
+        return [
+            BufferedMessage(id_, acquired_at, topic, bytes(payload), qos, bool(retain))
+            for id_, acquired_at, topic, payload, qos, retain in rows
+        ]
+
+    def remove(self, last_id: int) -> None:
+        """Remove messages up to the given one (inclusive).
+
+        Arguments:
+            last_id: ID of the last message to remove
+
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM messages WHERE id <= ?', (last_id,))
+            self._count = self._db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+
+class BufferDrainer:
+    """Publish messages from the offline buffer in batches, with limited rate, in a background thread."""
+
+    def __init__(
+        self,
+        buffer: OfflineBuffer,
+        mqtt_publisher: 'MqttPublisher',
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        rate: float = DEFAULT_BUFFER_RATE,
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            buffer: the offline buffer
+            mqtt_publisher: an instance of MQTT publisher
+            batch_size: max number of messages published together
+            rate: max number of published messages per second
+
+        """
+        self._buffer = buffer
+        self._mqtt_publisher = mqtt_publisher
+        self._batch_size = batch_size
+        self._rate = rate
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def drain_batch(self) -> int:
+        """Publish one batch of the oldest messages and remove them from the buffer.
+
+        Returns:
+            number of published messages
+
+        Raises:
+            Exception: when publishing failed, the messages are kept in the buffer
+
+        """
+        messages = self._buffer.peek(self._batch_size)
+        if not messages:
+            return 0
+        with self._mqtt_publisher.schedule_publish() as queue:
+            for message in messages:
+                queue.add(topic=message.topic, payload=message.payload, qos=message.qos, retain=message.retain)
+        self._buffer.remove(messages[-1].id)
+        logger.info(
+            'Published %s buffered messages acquired from %s to %s, %s messages left.',
+            len(messages),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(messages[0].acquired_at)),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(messages[-1].acquired_at)),
+            len(self._buffer),
+        )
+        return len(messages)
+
+    def _run(self) -> None:
+        delay = IDLE_DELAY_SEC
+        while not self._stop_event.wait(delay):
+            try:
+                published = self.drain_batch()
+            except Exception as exc:
+                logger.warning('Failed to publish buffered messages (%s), will retry.', exc)
+                delay = RETRY_DELAY_SEC
+            else:
+                delay = published / self._rate if published else IDLE_DELAY_SEC
+
+    def start(self) -> None:
+        """Start publishing in a background thread."""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='buffer_drain', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop publishing and wait for the background thread."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
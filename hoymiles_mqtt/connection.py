@@ -0,0 +1,318 @@
+"""Persistent Modbus TCP connection to DTU.
+
+DTUs are slow to accept connections and become unresponsive when they are rebooting. Instead of connecting in each
+query period, `ModbusConnection` keeps one connection open across queries. Before each use the connection is checked
+without any traffic - a socket closed by DTU, or with unexpected (stale) data waiting, is replaced with a new one.
+
+After a failure, connecting is paused with exponential backoff (with jitter, so multiple DTUs are not retried
+at the same time). After `failure_threshold` consecutive failures the circuit opens - DTU is not queried at all
+for `open_period` seconds, then a single attempt is made, which closes the circuit when it succeeds.
+Queries which are not attempted fail immediately with `DtuUnavailableError`.
+
+"""
+
+import random
+import select
+import socket
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
+
+# private API of hoymiles_modbus, its exact version is pinned in pyproject.toml
+from hoymiles_modbus._modbus_tcp_client import create_modbus_tcp_client
+from hoymiles_modbus.client import HoymilesModbusTCP
+from hoymiles_modbus.datatypes import CommunicationParams
+from pymodbus.exceptions import ConnectionException
+
+from hoymiles_mqtt import (
+    DEFAULT_BACKOFF_BASE_SEC,
+    DEFAULT_BACKOFF_MAX_SEC,
+    DEFAULT_FAILURE_THRESHOLD,
+    DEFAULT_OPEN_PERIOD_SEC,
+    _main_logger,
+)
+from hoymiles_mqtt.metrics import DtuMetrics
+
+if TYPE_CHECKING:  # pragma: no cover
+    from pymodbus.client import ModbusTcpClient
+
+logger = _main_logger.getChild('connection')
+
+# weight of the latest request in the moving average of latency
+LATENCY_SMOOTHING = 0.2
+
+
+class DtuUnavailableError(ConnectionError):
+    """Querying of DTU is paused after failures (backoff or open circuit)."""
+
+
+class ReconnectPolicy:
+    """Backoff, circuit breaker and latency statistics of a connection to DTU.
+
+    Only decides when DTU can be queried, the connection itself is handled by the user (like `ModbusConnection`),
+    which reports results of the queries.
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        backoff_base: float = DEFAULT_BACKOFF_BASE_SEC,
+        backoff_max: float = DEFAULT_BACKOFF_MAX_SEC,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        open_period: float = DEFAULT_OPEN_PERIOD_SEC,
+        metrics: Optional[DtuMetrics] = None,
+        clock: Callable[[], float] = time.monotonic,
+        jitter: Callable[[], float] = random.random,
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            name: DTU name, for logs
+            backoff_base: pause after the first failure in seconds, doubled with each consecutive failure
+            backoff_max: max pause in seconds
+            failure_threshold: number of consecutive failures which open the circuit, 0 disables the circuit breaker
+            open_period: number of seconds DTU is not queried when the circuit is open
+            metrics: metrics of the DTU, not recorded by default
+            clock: source of monotonic time in seconds
+            jitter: source of random numbers in [0, 1) used for jitter of backoff
+
+        """
+        self._name = name
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._failure_threshold = failure_threshold
+        self._open_period = open_period
+        self._metrics = metrics
+        self._clock = clock
+        self._jitter = jitter
+        self._failures = 0
+        self._retry_at = float('-inf')
+        self._circuit_open = False
+        self._requests = 0
+        self._latency: Optional[float] = None
+
+    @property
+    def failures(self) -> int:
+        """Number of consecutive failures."""
+        return self._failures
+
+    @property
+    def circuit_open(self) -> bool:
+        """Whether the circuit is open (DTU failed `failure_threshold` times in a row)."""
+        return self._circuit_open
+
+    @property
+    def latency(self) -> Optional[float]:
+        """Moving average of latency of requests over the current connection in seconds, None without requests."""
+        return self._latency
+
+    def check(self) -> None:
+        """Check if DTU can be queried now.
+
+        Raises:
+            DtuUnavailableError: querying is paused
+
+        """
+        remaining = self._retry_at - self._clock()
+        if remaining > 0:
+            state = 'circuit open' if self._circuit_open else 'backoff'
+            raise DtuUnavailableError(
+                f'DTU {self._name} failed {self._failures} time(s) in a row, next attempt in {remaining:.1f}s ({state})'
+            )
+
+    def success(self) -> None:
+        """Report a successful query."""
+        if self._circuit_open:
+            logger.info('DTU %s is responding again.', self._name)
+            self._circuit_open = False
+            if self._metrics is not None:
+                self._metrics.circuit_open.set(0)
+        self._failures = 0
+        self._retry_at = float('-inf')
+
+    def failure(self) -> None:
+        """Report a failed query (or connection attempt)."""
+        self._failures += 1
+        if self._failure_threshold and self._failures >= self._failure_threshold:
+            if not self._circuit_open:
+                logger.warning(
+                    'DTU %s failed %s times in a row, pausing queries for %ss.',
+                    self._name,
+                    self._failures,
+                    self._open_period,
+                )
+                self._circuit_open = True
+                if self._metrics is not None:
+                    self._metrics.circuit_open.set(1)
+            delay = self._open_period
+        else:
+            # "equal jitter" - at least half of the exponential delay
+            delay = min(self._backoff_max, self._backoff_base * 2 ** (self._failures - 1))
+            delay = delay / 2 + self._jitter() * delay / 2
+        self._retry_at = self._clock() + delay
+
+    def connected(self, connect_time: float) -> None:
+        """Report a new connection.
+
+        Arguments:
+            connect_time: time of establishing the connection in seconds
+
+        """
+        logger.debug('Connected to DTU %s in %.3fs.', self._name, connect_time)
+        self._requests = 0
+        self._latency = None
+        if self._metrics is not None:
+            self._metrics.connects.inc()
+
+    def disconnected(self) -> None:
+        """Report closing of the connection."""
+        if self._requests:
+            logger.debug(
+                'Closed connection to DTU %s after %s requests, latency %.3fs.',
+                self._name,
+                self._requests,
+                self._latency,
+            )
+
+    def record_latency(self, latency: float) -> None:
+        """Record latency of a request.
+
+        Arguments:
+            latency: time from sending the request until receiving the response in seconds
+
+        """
+        self._requests += 1
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += LATENCY_SMOOTHING * (latency - self._latency)
+        if self._metrics is not None:
+            self._metrics.request_time.observe(latency)
+
+
+def is_socket_usable(sock: Optional[socket.socket]) -> bool:
+    """Check, without any traffic, if a socket can be used for the next request.
+
+    Nothing should be waiting to be read from an idle connection - readable socket means that it was closed
+    by the other side, or that it holds a late response to a previous request (which would be taken as
+    the response to the next request).
+
+    """
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+class ModbusConnection:
+    """Modbus TCP connection to DTU kept open across queries."""
+
+    def __init__(self, host: str, port: int, comm_params: CommunicationParams, policy: ReconnectPolicy) -> None:
+        """Initialize the object.
+
+        Arguments:
+            host: DTU address
+            port: DTU Modbus TCP port
+            comm_params: low level communication parameters, used when a new connection is created
+            policy: backoff and circuit breaker of the connection
+
+        """
+        self._host = host
+        self._port = port
+        self._comm_params = comm_params
+        self._policy = policy
+        self._client: Optional['ModbusTcpClient'] = None
+
+    @property
+    def policy(self) -> ReconnectPolicy:
+        """Backoff and circuit breaker of the connection."""
+        return self._policy
+
+    def _connect(self) -> 'ModbusTcpClient':
+        client = create_modbus_tcp_client(self._host, self._port, self._comm_params)
+        start = time.perf_counter()
+        if not client.connect():
+            raise ConnectionException(f'Failed to connect to DTU {self._host}:{self._port}')
+        self._policy.connected(time.perf_counter() - start)
+        return client
+
+    def _acquire(self) -> 'ModbusTcpClient':
+        self._policy.check()
+        if self._client is not None and not is_socket_usable(self._client.socket):
+            logger.debug('Connection to DTU %s:%s is not usable, reconnecting.', self._host, self._port)
+            self.close()
+        if self._client is None:
+            try:
+                self._client = self._connect()
+            except Exception:
+                self._policy.failure()
+                raise
+        return self._client
+
+    @contextmanager
+    def session(self) -> Iterator['ModbusTcpClient']:
+        """Get the connected client for a query.
+
+        The connection is closed when the query fails, so the next query uses a new one.
+
+        Raises:
+            DtuUnavailableError: querying is paused after failures
+            ConnectionException: connecting failed
+
+        """
+        client = self._acquire()
+        try:
+            yield client
+        except Exception:
+            self.close()
+            self._policy.failure()
+            raise
+        self._policy.success()
+
+    def close(self) -> None:
+        """Close the connection."""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+            self._policy.disconnected()
+
+
+class ManagedModbusTCP(HoymilesModbusTCP):
+    """Hoymiles Modbus TCP client using a persistent connection (if given), with latency of requests recorded."""
+
+    def __init__(self, host: str, port: int = 502, unit_id: int = 1, policy: Optional[ReconnectPolicy] = None) -> None:
+        """Initialize the object.
+
+        Arguments:
+            host: DTU address
+            port: target DTU modbus TCP port
+            unit_id: Modbus unit ID
+            policy: backoff and circuit breaker, when given the connection to DTU is kept open across queries,
+                    otherwise a new connection is used for each query (like by `HoymilesModbusTCP`)
+
+        """
+        super().__init__(host=host, port=port, unit_id=unit_id)
+        self._connection: Optional[ModbusConnection] = None
+        if policy is not None:
+            self._connection = ModbusConnection(host, port, self.comm_params, policy)
+
+    def _get_client(self):
+        if self._connection is None:
+            return super()._get_client()
+        return self._connection.session()
+
+    def _read_registers(self, client: 'ModbusTcpClient', start_address: int, count: int, unit_id: int):
+        start = time.perf_counter()
+        result = super()._read_registers(client, start_address, count, unit_id)
+        if self._connection is not None:
+            self._connection.policy.record_latency(time.perf_counter() - start)
+        return result
+
+    def close(self) -> None:
+        """Close the persistent connection (if used)."""
+        if self._connection is not None:
+            self._connection.close()
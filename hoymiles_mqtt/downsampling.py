@@ -0,0 +1,260 @@
+"""Downsampling of plant data - frequent queries, published once per window.
+
+Querying DTU often gives accurate peaks and energy, but publishing each data set loads MQTT broker and the recorder
+of Home Assistant. `WindowAggregator` accumulates data sets over a window (aligned to wall-clock boundaries) and
+returns one aggregated data set per window, with constant work per value:
+
+- measurements (entities with `measurement` state class, like power or voltage) - the mean, with min, max, mean
+  and last value in statistics
+- counters (entities with `total_increasing` state class, energy production) - the last value, with the increase
+  since the previous window (`delta`) in statistics
+- other entities (like operating status) - the last value
+
+The window is closed by the first data set acquired after its end, so the aggregate is published one query period
+after the end of the window. The data set which closes the window belongs to the next one.
+
+"""
+
+import copy
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from hoymiles_modbus.datatypes import InverterData, PlantData
+
+from hoymiles_mqtt import _main_logger
+from hoymiles_mqtt.ha import (
+    STATE_CLASS_MEASUREMENT,
+    STATE_CLASS_TOTAL_INCREASING,
+    DtuEntities,
+    EntityDescription,
+    MicroinverterEntities,
+    PortEntities,
+)
+
+logger = _main_logger.getChild('downsampling')
+
+# number of decimal places of means
+MEAN_PRECISION = 3
+
+# serial number of DTU or microinverter, port number (None for DTU and microinverter level entities)
+DeviceKey = Tuple[str, Optional[int]]
+
+
+def _entities_by_state_class(entity_definitions: Dict[str, EntityDescription], state_class: str) -> List[str]:
+    return [name for name, description in entity_definitions.items() if description.state_class == state_class]
+
+
+@dataclass
+class AggregatedPlantData(PlantData):
+    """Plant data aggregated over a window."""
+
+    missing_ports: List[Tuple[str, int]] = field(default_factory=list)
+    """Microinverter serial numbers and port numbers of ports which could not be read in the whole window."""
+    statistics: Dict[DeviceKey, Dict[str, Dict[str, float]]] = field(default_factory=dict)
+    """Statistics of entities (by names of statistics) by devices and entity names."""
+    samples: int = 0
+    """Number of data sets in the window."""
+
+
+class Aggregate:
+    """Running min, max, mean and last value."""
+
+    __slots__ = ('count', 'minimum', 'maximum', 'total', 'first', 'last')
+
+    def __init__(self, value: float) -> None:
+        """Initialize the object with the first value."""
+        self.count = 1
+        self.minimum = self.maximum = self.total = self.first = self.last = value
+
+    def add(self, value: float) -> None:
+        """Add a value."""
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value < self.minimum:
+            self.minimum = value
+        elif value > self.maximum:
+            self.maximum = value
+
+    @property
+    def mean(self) -> float:
+        """Mean of the values."""
+        return round(self.total / self.count, MEAN_PRECISION)
+
+
+class _DeviceWindow:
+    """Aggregates of entities of a device within a window, with its latest data."""
+
+    __slots__ = ('aggregates', 'latest')
+
+    def __init__(self, latest: Any) -> None:
+        self.aggregates: Dict[str, Aggregate] = {}
+        self.latest = latest
+
+
+class WindowAggregator:
+    """Aggregation of plant data over windows of the given length."""
+
+    def __init__(self, window: float) -> None:
+        """Initialize the object.
+
+        Arguments:
+            window: length of the window in seconds
+
+        """
+        if window <= 0:
+            raise ValueError('Window must be positive')
+        self._window = window
+        self._window_end: Optional[float] = None
+        self._samples = 0
+        self._dtu: Optional[_DeviceWindow] = None
+        self._devices: Dict[DeviceKey, _DeviceWindow] = {}
+        self._missing_ports: Dict[Tuple[str, int], None] = {}
+        # last values of counters from the previous windows, the base of increases
+        self._counters: Dict[Tuple[str, Optional[int], str], float] = {}
+        self._dtu_entities = self._classify(DtuEntities)
+        self._mi_entities = self._classify(MicroinverterEntities)
+        self._port_entities = self._classify(PortEntities)
+
+    @staticmethod
+    def _classify(entity_definitions: Dict[str, EntityDescription]) -> Tuple[List[str], List[str]]:
+        return (
+            _entities_by_state_class(entity_definitions, STATE_CLASS_MEASUREMENT),
+            _entities_by_state_class(entity_definitions, STATE_CLASS_TOTAL_INCREASING),
+        )
+
+    @property
+    def window(self) -> float:
+        """Length of the window in seconds."""
+        return self._window
+
+    @property
+    def samples(self) -> int:
+        """Number of data sets in the current window."""
+        return self._samples
+
+    @staticmethod
+    def _update(device: _DeviceWindow, data: Any, entities: Tuple[List[str], List[str]]) -> None:
+        aggregates = device.aggregates
+        device.latest = data
+        for entity_names in entities:
+            for entity_name in entity_names:
+                value = float(getattr(data, entity_name))
+                aggregate = aggregates.get(entity_name)
+                if aggregate is None:
+                    aggregates[entity_name] = Aggregate(value)
+                else:
+                    aggregate.add(value)
+
+    def _get_device(self, key: DeviceKey, data: Any) -> _DeviceWindow:
+        device = self._devices.get(key)
+        if device is None:
+            device = self._devices[key] = _DeviceWindow(data)
+        return device
+
+    def _add(self, plant_data: PlantData) -> None:
+        self._samples += 1
+        if self._dtu is None:
+            self._dtu = _DeviceWindow(plant_data)
+        self._update(self._dtu, plant_data, self._dtu_entities)
+        seen = set()
+        for port_data in plant_data.inverters:
+            serial_number = port_data.serial_number
+            if serial_number not in seen:
+                # microinverter level values are the same in records of all ports
+                seen.add(serial_number)
+                self._update(self._get_device((serial_number, None), port_data), port_data, self._mi_entities)
+            key = (serial_number, port_data.port_number)
+            self._update(self._get_device(key, port_data), port_data, self._port_entities)
+        for port in getattr(plant_data, 'missing_ports', None) or []:
+            self._missing_ports[port] = None
+
+    def _get_statistics(
+        self,
+        key: DeviceKey,
+        device: _DeviceWindow,
+        entities: Tuple[List[str], List[str]],
+        previous_counters: Dict[Tuple[str, Optional[int], str], float],
+    ) -> Dict[str, Dict[str, float]]:
+        measurements, counters = entities
+        statistics = {}
+        for entity_name in measurements:
+            aggregate = device.aggregates[entity_name]
+            statistics[entity_name] = {
+                'min': aggregate.minimum,
+                'max': aggregate.maximum,
+                'mean': aggregate.mean,
+                'last': aggregate.last,
+            }
+        for entity_name in counters:
+            aggregate = device.aggregates[entity_name]
+            counter_key = (*key, entity_name)
+            base = previous_counters.get(counter_key, aggregate.first)
+            # a counter lower than the base was reset (like today production at midnight)
+            statistics[entity_name] = {'delta': aggregate.last - base if aggregate.last >= base else aggregate.last}
+            self._counters[counter_key] = aggregate.last
+        return statistics
+
+    @staticmethod
+    def _set_means(data: Any, device: _DeviceWindow, measurements: List[str]) -> None:
+        for entity_name in measurements:
+            setattr(data, entity_name, device.aggregates[entity_name].mean)
+
+    def _close(self) -> AggregatedPlantData:
+        assert self._dtu is not None
+        dtu_data: PlantData = self._dtu.latest
+        # only counters of devices present in the window are kept, devices which are gone are forgotten
+        previous_counters, self._counters = self._counters, {}
+        statistics: Dict[DeviceKey, Dict[str, Dict[str, float]]] = {
+            (dtu_data.dtu, None): self._get_statistics(
+                (dtu_data.dtu, None), self._dtu, self._dtu_entities, previous_counters
+            )
+        }
+        inverters: List[InverterData] = []
+        for key, device in self._devices.items():
+            serial_number, port_number = key
+            if port_number is None:
+                statistics[key] = self._get_statistics(key, device, self._mi_entities, previous_counters)
+                continue
+            statistics[key] = self._get_statistics(key, device, self._port_entities, previous_counters)
+            port_data = copy.copy(device.latest)
+            self._set_means(port_data, device, self._port_entities[0])
+            self._set_means(port_data, self._devices[(serial_number, None)], self._mi_entities[0])
+            inverters.append(port_data)
+        result = AggregatedPlantData(
+            dtu=dtu_data.dtu,
+            today_production=dtu_data.today_production,
+            total_production=dtu_data.total_production,
+            alarm_flag=dtu_data.alarm_flag,
+            inverters=inverters,
+            missing_ports=[port for port in self._missing_ports if port not in self._devices],
+            statistics=statistics,
+            samples=self._samples,
+        )
+        self._set_means(result, self._dtu, self._dtu_entities[0])
+        logger.debug('Aggregated %s data sets of DTU %s.', self._samples, result.dtu)
+        self._samples = 0
+        self._dtu = None
+        self._devices = {}
+        self._missing_ports = {}
+        return result
+
+    def add(self, plant_data: PlantData, timestamp: float) -> Optional[AggregatedPlantData]:
+        """Add a data set.
+
+        Arguments:
+            plant_data: data from DTU, not modified
+            timestamp: acquisition time of the data (seconds since the epoch)
+
+        Returns:
+            aggregate of the previous window when the data set closes it, otherwise None
+
+        """
+        result = None
+        if self._window_end is not None and timestamp >= self._window_end:
+            result = self._close()
+            self._window_end = None
+        if self._window_end is None:
+            self._window_end = (timestamp // self._window + 1) * self._window
+        self._add(plant_data)
+        return result
@@ -0,0 +1,87 @@
+"""JSON encoders of MQTT payloads.
+
+Payloads are encoded directly to `bytes`, so they are not encoded again when published. orjson or msgspec
+(several times faster than the standard library) are used when installed, otherwise the standard `json` module.
+All encoders produce compact UTF-8 encoded JSON which parses to the same values.
+
+"""
+
+import json
+from typing import Any, Callable, Dict, List
+
+ENCODER_AUTO = 'auto'
+ENCODER_ORJSON = 'orjson'
+ENCODER_MSGSPEC = 'msgspec'
+ENCODER_STDLIB = 'json'
+
+Encoder = Callable[[Any], bytes]
+
+
+def _orjson_encoder() -> Encoder:
+    import orjson
+
+    return orjson.dumps
+
+
+def _msgspec_encoder() -> Encoder:
+    import msgspec
+
+    return msgspec.json.Encoder().encode
+
+
+def _stdlib_encoder() -> Encoder:
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(obj: Any) -> bytes:
+        return encoder.encode(obj).encode()
+
+    return dumps
+
+
+_FACTORIES: Dict[str, Callable[[], Encoder]] = {
+    ENCODER_ORJSON: _orjson_encoder,
+    ENCODER_MSGSPEC: _msgspec_encoder,
+    ENCODER_STDLIB: _stdlib_encoder,
+}
+
+ENCODERS = [ENCODER_AUTO, *_FACTORIES]
+
+
+def available_encoders() -> List[str]:
+    """Names of encoders which can be used, the fastest first."""
+    available = []
+    for name, factory in _FACTORIES.items():
+        try:
+            factory()
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+
+def get_encoder(name: str = ENCODER_AUTO) -> Encoder:
+    """Get JSON encoder.
+
+    Arguments:
+        name: one of `ENCODERS`, `auto` selects the fastest installed encoder
+
+    Returns:
+        function encoding an object to JSON (bytes)
+
+    Raises:
+        ValueError: unknown encoder
+        ImportError: library of the encoder is not installed
+
+    """
+    if name == ENCODER_AUTO:
+        # the first one which can be imported, without importing the slower ones
+        for factory in _FACTORIES.values():
+            try:
+                return factory()
+            except ImportError:
+                continue
+    try:
+        factory = _FACTORIES[name]
+    except KeyError:
+        raise ValueError(f'Unknown JSON encoder {name}') from None
+    return factory()
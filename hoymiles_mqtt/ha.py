@@ -1,16 +1,22 @@
 """MQTT message builders for Home Assistant."""
 
-import json
+import time
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Tuple
+from operator import attrgetter
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 from hoymiles_mqtt import _main_logger
+from hoymiles_mqtt.encoding import Encoder, get_encoder
+from hoymiles_mqtt.snapshot import SnapshotOutput
 
 if TYPE_CHECKING:
-    from hoymiles_modbus.datatypes import PlantData
+    from hoymiles_modbus.datatypes import InverterData, PlantData
 
 logger = _main_logger.getChild('ha')
 
+HA_STATUS_TOPIC = 'homeassistant/status'
+HA_STATUS_ONLINE = b'online'
+
 PLATFORM_SENSOR = 'sensor'
 PLATFORM_BINARY_SENSOR = 'binary_sensor'
 
@@ -146,11 +152,108 @@ DtuEntities = {
 }
 
 
+# names of entities, getter of their values, ignore rules and value converters by indexes of entities
+_CompiledPlan = Tuple[
+    Tuple[str, ...],
+    Callable[[Any], Tuple],
+    Tuple[Tuple[int, str, Callable], ...],
+    Tuple[Tuple[int, str, Callable], ...],
+]
+
+
+class _TupleGetter:
+    """Getter of a tuple of attributes also for zero or one attribute (`attrgetter` returns a plain value then)."""
+
+    def __init__(self, names: List[str]) -> None:
+        self._getters = [attrgetter(name) for name in names]
+
+    def __call__(self, data) -> Tuple:
+        return tuple(getter(data) for getter in self._getters)
+
+
+class _ExtractionPlan:
+    """Extraction of state values of entities from device data, compiled from entity descriptions.
+
+    Entities ignored when operating status is zero are filtered with a single status check per device, values of
+    the remaining entities are read with one `attrgetter` call. Only values with other ignore rules or converters
+    are processed further.
+
+    """
+
+    def __init__(self, entity_definitions: Dict[str, EntityDescription]) -> None:
+        """Initialize the object.
+
+        Arguments:
+            entity_definitions: descriptions of entities by names
+
+        """
+        self._check_status = any(
+            description.ignore_rule is _ignore_when_zero_operating_status for description in entity_definitions.values()
+        )
+        self._active = self._compile(entity_definitions, idle=False)
+        self._idle = self._compile(entity_definitions, idle=True)
+
+    @staticmethod
+    def _compile(entity_definitions: Dict[str, EntityDescription], idle: bool) -> _CompiledPlan:
+        names: List[str] = []
+        ignore_rules: List[Tuple[int, str, Callable]] = []
+        converters: List[Tuple[int, str, Callable]] = []
+        for entity_name, description in entity_definitions.items():
+            if description.ignore_rule is _ignore_when_zero_operating_status:
+                if idle:
+                    continue
+            elif description.ignore_rule:
+                ignore_rules.append((len(names), entity_name, description.ignore_rule))
+            if description.value_converter:
+                converters.append((len(names), entity_name, description.value_converter))
+            names.append(entity_name)
+        getter: Callable[[Any], Tuple] = attrgetter(*names) if len(names) > 1 else _TupleGetter(names)
+        return tuple(names), getter, tuple(ignore_rules), tuple(converters)
+
+    def extract(self, data) -> Dict[str, Any]:
+        """Get state values of entities (not ignored) from device data."""
+        names, getter, ignore_rules, converters = (
+            self._idle if self._check_status and data.operating_status == ZERO else self._active
+        )
+        raw_values = getter(data)
+        values = dict(zip(names, raw_values))
+        for index, entity_name, value_converter in converters:
+            values[entity_name] = value_converter(raw_values[index])
+        for index, entity_name, ignore_rule in ignore_rules:
+            if raw_values[index] == ZERO if ignore_rule is _ignore_when_zero else ignore_rule(data, entity_name):
+                del values[entity_name]
+        return values
+
+
+def _group_by_serial(plant_data: 'PlantData') -> Dict[str, List['InverterData']]:
+    """Group records of microinverter ports by microinverter serial numbers (in order of first appearance)."""
+    index: Dict[str, List['InverterData']] = {}
+    for microinverter_data in plant_data.inverters:
+        ports = index.get(microinverter_data.serial_number)
+        if ports is None:
+            index[microinverter_data.serial_number] = [microinverter_data]
+        else:
+            ports.append(microinverter_data)
+    return index
+
+
 class HassMqtt:
     """MQTT message builder for Home Assistant."""
 
     def __init__(
-        self, mi_entities: List[str], port_entities: List[str], post_process: bool = True, expire_after: int = 0
+        self,
+        mi_entities: List[str],
+        port_entities: List[str],
+        post_process: bool = True,
+        expire_after: int = 0,
+        delta: bool = False,
+        full_refresh_cycles: int = 0,
+        full_refresh_period: float = 0,
+        encoder: Optional[Encoder] = None,
+        snapshot: Optional[SnapshotOutput] = None,
+        device_topics: bool = True,
+        device_ttl: float = 0,
+        clear_evicted_configs: bool = False,
     ) -> None:
         """Initialize the object.
 
@@ -160,15 +263,46 @@ class HassMqtt:
             post_process: if to cache energy production
             expire_after: number of seconds after which an entity state should expire. This setting is added to the
                           entity configuration. Applied only when `expire` flag is set in the entity description.
+            delta: if to skip state messages which payload did not change since the last time
+            full_refresh_cycles: in delta mode, number of `get_states` calls after which all states are sent
+                                 regardless of changes, 0 disables the refresh based on calls count
+            full_refresh_period: in delta mode, number of seconds after which all states are sent regardless of
+                                 changes, 0 means half of `expire_after` (no time based refresh if entities
+                                 never expire)
+            encoder: JSON encoder of payloads (see `hoymiles_mqtt.encoding`), the fastest installed one by default
+            snapshot: output of aggregated snapshots of plant data, see `hoymiles_mqtt.snapshot`
+            device_topics: if to generate states (and configs) of each device on their own topics
+            device_ttl: number of seconds after which devices (DTU, microinverters and ports) which are not present
+                        in data from DTU are forgotten - removed from energy production caches (so from DTU totals)
+                        and from state and config caches, 0 means that devices are never forgotten
+            clear_evicted_configs: if `get_configs` should return empty configs of forgotten devices, so their
+                                   retained configs are cleared and the entities are removed from Home Assistant
 
         """
         self._logger = logger
-        self._state_topics: Dict = {}
-        self._config_topics: Dict = {}
+        self._state_topics: Dict[str, bytes] = {}
+        self._config_topics: Dict[Tuple[str, str, str], Tuple[str, bytes]] = {}
+        self._configured_devices: Set[Tuple[str, Optional[int]]] = set()
         self._post_process: bool = post_process
         self._expire_after: int = expire_after
         self._prod_today_cache: Dict[Tuple[str, int], int] = {}
         self._prod_total_cache: Dict[Tuple[str, int], int] = {}
+        self._delta: bool = delta
+        self._full_refresh_cycles: int = full_refresh_cycles
+        self._full_refresh_period: float = full_refresh_period or expire_after / 2
+        self._cycles_since_refresh: int = 0
+        self._last_refresh: Optional[float] = None
+        self._skipped_states: int = 0
+        self._encode: Encoder = encoder or get_encoder()
+        self._snapshot = snapshot
+        self._device_topics = device_topics
+        self._device_ttl = device_ttl
+        self._clear_evicted_configs = clear_evicted_configs
+        # monotonic time when devices were seen, by device name ('DTU' or 'inv'), serial number and port
+        self._last_seen: Dict[Tuple[str, str, Optional[int]], float] = {}
+        self._evicted_config_topics: List[str] = []
+        # empty configs returned by the last `get_configs` call, returned again after `clear_configs`
+        self._returned_evicted_config_topics: List[str] = []
         self._mi_entities: Dict[str, EntityDescription] = {}
         self._port_entities: Dict[str, EntityDescription] = {}
         for entity_name, description in MicroinverterEntities.items():
@@ -177,6 +311,9 @@ class HassMqtt:
         for entity_name, description in PortEntities.items():
             if entity_name in port_entities:
                 self._port_entities[entity_name] = description
+        self._dtu_plan = _ExtractionPlan(DtuEntities)
+        self._mi_plan = _ExtractionPlan(self._mi_entities)
+        self._port_plan = _ExtractionPlan(self._port_entities)
 
     @staticmethod
     def _get_config_topic(platform: str, device_serial: str, entity_name) -> str:
@@ -190,84 +327,177 @@ class HassMqtt:
             sub_topic = device_serial
         return f"homeassistant/hoymiles_mqtt/{sub_topic}/state"
 
+    def _build_config_payload(
+        self,
+        device_name: str,
+        device_serial_number: str,
+        entity_name: str,
+        entity_definition: EntityDescription,
+        port: Optional[int],
+    ) -> Tuple[str, bytes]:
+        port_prefix = f'port_{port}' if port is not None else ''
+        entity_prefix = port_prefix if port_prefix else device_name
+        state_topic = self._get_state_topic(device_serial_number, port)
+        config_payload = {
+            "device": {
+                "name": f"{device_name}_{device_serial_number}",
+                "identifiers": [f"hoymiles_mqtt_{device_serial_number}"],
+                "manufacturer": "Hoymiles",
+            },
+            "name": f'{port_prefix}_{entity_name}' if port_prefix else entity_name,
+            "unique_id": f"hoymiles_mqtt_{entity_prefix}_{device_serial_number}_{entity_name}",
+            "state_topic": state_topic,
+            "value_template": f"{{{{ iif(value_json.{entity_name} is defined, value_json.{entity_name}, '') }}}}",
+            "availability_topic": state_topic,
+            "availability_template": f"{{{{ iif(value_json.{entity_name} is defined, 'online', 'offline') }}}}",
+        }
+        if entity_definition.device_class:
+            config_payload['device_class'] = entity_definition.device_class
+        if entity_definition.unit:
+            config_payload['unit_of_measurement'] = entity_definition.unit
+        if entity_definition.state_class:
+            config_payload['state_class'] = entity_definition.state_class
+        if entity_definition.expire and self._expire_after:
+            config_payload['expire_after'] = str(self._expire_after)
+        config_topic = self._get_config_topic(
+            entity_definition.platform, device_serial_number, f'{entity_prefix}_{entity_name}'
+        )
+        return config_topic, self._encode(config_payload)
+
     def _get_config_payloads(
         self,
         device_name: str,
-        device_serial_number,
+        device_serial_number: str,
         entity_definitions: Dict[str, EntityDescription],
         port: Optional[int] = None,
-    ) -> Iterable[Tuple[str, str]]:
-        port_prefix = f'port_{port}' if port is not None else ''
-        entity_prefix = port_prefix if port_prefix else device_name
+    ) -> Iterable[Tuple[str, bytes]]:
+        entity_prefix = f'port_{port}' if port is not None else device_name
         for entity_name, entity_definition in entity_definitions.items():
-            state_topic = self._get_state_topic(device_serial_number, port)
-            config_payload = {
-                "device": {
-                    "name": f"{device_name}_{device_serial_number}",
-                    "identifiers": [f"hoymiles_mqtt_{device_serial_number}"],
-                    "manufacturer": "Hoymiles",
-                },
-                "name": f'{port_prefix}_{entity_name}' if port_prefix else entity_name,
-                "unique_id": f"hoymiles_mqtt_{entity_prefix}_{device_serial_number}_{entity_name}",
-                "state_topic": state_topic,
-                "value_template": f"{{{{ iif(value_json.{entity_name} is defined, value_json.{entity_name}, '') }}}}",
-                "availability_topic": state_topic,
-                "availability_template": f"{{{{ iif(value_json.{entity_name} is defined, 'online', 'offline') }}}}",
-            }
-            if entity_definition.device_class:
-                config_payload['device_class'] = entity_definition.device_class
-            if entity_definition.unit:
-                config_payload['unit_of_measurement'] = entity_definition.unit
-            if entity_definition.state_class:
-                config_payload['state_class'] = entity_definition.state_class
-            if entity_definition.expire and self._expire_after:
-                config_payload['expire_after'] = str(self._expire_after)
-            config_topic = self._get_config_topic(
-                entity_definition.platform, device_serial_number, f'{entity_prefix}_{entity_name}'
-            )
-            yield config_topic, json.dumps(config_payload)
+            cache_key = (entity_definition.platform, device_serial_number, f'{entity_prefix}_{entity_name}')
+            config = self._config_topics.get(cache_key)
+            if config is None:
+                config = self._build_config_payload(
+                    device_name, device_serial_number, entity_name, entity_definition, port
+                )
+                self._config_topics[cache_key] = config
+            yield config
+
+    @property
+    def expire_after(self) -> int:
+        """Number of seconds after which an entity state should expire."""
+        return self._expire_after
+
+    @expire_after.setter
+    def expire_after(self, value: int) -> None:
+        if value != self._expire_after:
+            self._expire_after = value
+            self._config_topics = {}
+
+    @property
+    def skipped_states(self) -> int:
+        """Number of state messages skipped (as unchanged) during the last `get_states` call."""
+        return self._skipped_states
+
+    def clear_states(self) -> None:
+        """Forget previously generated states, so all states are sent by the next `get_states` call.
+
+        Useful in delta mode when the previously generated messages were not delivered.
+
+        """
+        self._state_topics = {}
+        self._last_refresh = None
+
+    def clear_configs(self) -> None:
+        """Forget devices for which configs were generated, so all configs are returned by the next `get_configs` call.
+
+        Configs are still taken from the cache. Empty configs of forgotten devices returned by the previous call
+        are returned again.
+
+        """
+        self._configured_devices = set()
+        self._evicted_config_topics = self._returned_evicted_config_topics + self._evicted_config_topics
+        self._returned_evicted_config_topics = []
 
     def clear_production_today(self) -> None:
         """Clear todays' energy production."""
         self._logger.debug('Clear today production cache.')
         self._prod_today_cache = {}
 
-    def get_configs(self, plant_data: 'PlantData') -> Iterable[Tuple[str, str]]:
+    def get_production_cache(self) -> Tuple[Dict[Tuple[str, int], int], Dict[Tuple[str, int], int]]:
+        """Get copies of today and total energy production caches, by microinverter serial number and port."""
+        return dict(self._prod_today_cache), dict(self._prod_total_cache)
+
+    def restore_production_cache(self, today: Dict[Tuple[str, int], int], total: Dict[Tuple[str, int], int]) -> None:
+        """Restore today and total energy production caches (for example after restart).
+
+        Arguments:
+            today: today production by microinverter serial number and port
+            total: total production by microinverter serial number and port
+
+        """
+        self._prod_today_cache = dict(today)
+        self._prod_total_cache = dict(total)
+        if self._device_ttl:
+            # restored microinverters and ports are forgotten when they are not seen again
+            now = time.monotonic()
+            for serial_number, port_number in {**today, **total}:
+                self._last_seen.setdefault(('inv', serial_number, None), now)
+                self._last_seen.setdefault(('inv', serial_number, port_number), now)
+
+    def get_configs(self, plant_data: 'PlantData') -> Iterable[Tuple[str, bytes]]:
         """Get MQTT config messages for given data from DTU.
 
+        Configs are returned only for devices (DTU, microinverters and their ports) which were not returned
+        by the previous calls, see also `clear_configs`.
+
+        Encoded config payloads are cached per platform, device serial number and entity,
+        so they are built only for newly seen devices (or after change of `expire_after`).
+
+        No configs are generated when states of devices are not published on their own topics
+        (snapshots only).
+
+        Empty configs of forgotten devices (see `device_ttl`) are returned first, when enabled
+        by `clear_evicted_configs`.
+
         Arguments:
             plant_data: data from DTU
 
         """
-        for topic, payload in self._get_config_payloads('DTU', plant_data.dtu, DtuEntities):
-            yield topic, payload
-        for microinverter_data in plant_data.inverters:
-            for topic, payload in self._get_config_payloads('inv', microinverter_data.serial_number, self._mi_entities):
-                yield topic, payload
-            for topic, payload in self._get_config_payloads(
-                'inv',
-                microinverter_data.serial_number,
-                self._port_entities,
-                microinverter_data.port_number,
-            ):
-                yield topic, payload
+        evicted_config_topics, self._evicted_config_topics = self._evicted_config_topics, []
+        self._returned_evicted_config_topics = evicted_config_topics
+        if not self._device_topics:
+            return
+        for topic in evicted_config_topics:
+            yield topic, b''
+        configured = self._configured_devices
+        if (plant_data.dtu, None) not in configured:
+            configured.add((plant_data.dtu, None))
+            yield from self._get_config_payloads('DTU', plant_data.dtu, DtuEntities)
+        for serial_number, ports in _group_by_serial(plant_data).items():
+            if (serial_number, None) not in configured:
+                configured.add((serial_number, None))
+                yield from self._get_config_payloads('inv', serial_number, self._mi_entities)
+            for port_data in ports:
+                port_number = port_data.port_number
+                if (serial_number, port_number) not in configured:
+                    configured.add((serial_number, port_number))
+                    yield from self._get_config_payloads('inv', serial_number, self._port_entities, port_number)
 
     def _get_state(
         self,
         device_serial: str,
-        entity_definitions: Dict[str, EntityDescription],
+        plan: _ExtractionPlan,
         entity_data,
         port: Optional[int] = None,
-    ) -> Tuple[str, str]:
-        values = {}
-        for entity_name, description in entity_definitions.items():
-            value = getattr(entity_data, entity_name)
-            if description.ignore_rule and description.ignore_rule(entity_data, entity_name):
-                continue
-            if description.value_converter:
-                value = description.value_converter(value)
-            values[entity_name] = value
-        payload = json.dumps(values)
+        statistics: Optional[Dict[str, Dict[str, float]]] = None,
+    ) -> Tuple[str, bytes]:
+        values = plan.extract(entity_data)
+        if statistics:
+            # statistics of entities which are not ignored, as `<entity>_<statistic>`
+            for entity_name in [entity_name for entity_name in values if entity_name in statistics]:
+                for statistic, value in statistics[entity_name].items():
+                    values[f'{entity_name}_{statistic}'] = value
+        payload = self._encode(values)
         state_topic = self._get_state_topic(device_serial, port)
         return state_topic, payload
 
@@ -305,24 +535,149 @@ class HassMqtt:
         plant_data.today_production = sum(self._prod_today_cache.values()) if self._prod_today_cache else ZERO
         plant_data.total_production = sum(self._prod_total_cache.values()) if self._prod_total_cache else ZERO
 
-    def get_states(self, plant_data: 'PlantData') -> Iterable[Tuple[str, str]]:
+    def _is_full_refresh_due(self) -> bool:
+        if not self._delta or self._last_refresh is None:
+            return True
+        if self._full_refresh_cycles and self._cycles_since_refresh >= self._full_refresh_cycles:
+            return True
+        if self._full_refresh_period and time.monotonic() - self._last_refresh >= self._full_refresh_period:
+            return True
+        return False
+
+    def get_states(self, plant_data: 'PlantData') -> Iterable[Tuple[str, bytes]]:
         """Get MQTT message for DTU data.
 
+        In delta mode, states which did not change since the previous call are skipped,
+        unless a full refresh is due.
+
+        For data aggregated over a window (see `hoymiles_mqtt.downsampling`), statistics of entities are added
+        to their state payloads as `<entity>_<statistic>` (like `pv_power_max`).
+
         Arguments:
             plant_data: data from DTU
 
         """
+        if self._device_ttl:
+            self._evict_devices(plant_data)
+        full_refresh = self._is_full_refresh_due()
+        if full_refresh:
+            self._cycles_since_refresh = 0
+            self._last_refresh = time.monotonic()
+        self._cycles_since_refresh += 1
+        self._skipped_states = 0
+        for topic, payload in self._get_states(plant_data):
+            if self._delta:
+                if not full_refresh and self._state_topics.get(topic) == payload:
+                    self._skipped_states += 1
+                    continue
+                self._state_topics[topic] = payload
+            yield topic, payload
+
+    def _evict_devices(self, plant_data: 'PlantData') -> None:
+        """Update the time when devices were seen and forget devices which were not seen for `device_ttl`."""
+        now = time.monotonic()
+        last_seen = self._last_seen
+        last_seen[('DTU', plant_data.dtu, None)] = now
+        for port_data in plant_data.inverters:
+            last_seen[('inv', port_data.serial_number, None)] = now
+            last_seen[('inv', port_data.serial_number, port_data.port_number)] = now
+        # ports which could not be read, see `hoymiles_mqtt.blocks.PartialPlantData`, are still present
+        for serial_number, port_number in getattr(plant_data, 'missing_ports', None) or []:
+            last_seen[('inv', serial_number, None)] = now
+            last_seen[('inv', serial_number, port_number)] = now
+        for device, seen in list(last_seen.items()):
+            if now - seen >= self._device_ttl:
+                self._evict_device(*device)
+
+    def _evict_device(self, device_name: str, serial_number: str, port: Optional[int]) -> None:
+        self._logger.info(
+            'Device %s%s not seen for %ss, forgetting it.',
+            serial_number,
+            f' port {port}' if port is not None else '',
+            self._device_ttl,
+        )
+        del self._last_seen[(device_name, serial_number, port)]
+        self._configured_devices.discard((serial_number, port))
+        self._state_topics.pop(self._get_state_topic(serial_number, port), None)
+        if port is not None:
+            self._prod_today_cache.pop((serial_number, port), None)
+            self._prod_total_cache.pop((serial_number, port), None)
+            entity_definitions = self._port_entities
+        else:
+            entity_definitions = DtuEntities if device_name == 'DTU' else self._mi_entities
+        entity_prefix = f'port_{port}' if port is not None else device_name
+        for entity_name, entity_definition in entity_definitions.items():
+            cache_key = (entity_definition.platform, serial_number, f'{entity_prefix}_{entity_name}')
+            self._config_topics.pop(cache_key, None)
+            if self._clear_evicted_configs:
+                self._evicted_config_topics.append(self._get_config_topic(*cache_key))
+
+    def _get_states(self, plant_data: 'PlantData') -> Iterable[Tuple[str, bytes]]:
         if self._post_process:
             self._process_plant_data(plant_data)
-        yield self._get_state(plant_data.dtu, DtuEntities, plant_data)
-        known_serials = []
-        for microinverter_data in plant_data.inverters:
-            if microinverter_data.serial_number not in known_serials:
-                known_serials.append(microinverter_data.serial_number)
-                yield self._get_state(microinverter_data.serial_number, self._mi_entities, microinverter_data)
+        index = _group_by_serial(plant_data)
+        if self._device_topics:
+            # data aggregated over a window, see `hoymiles_mqtt.downsampling.AggregatedPlantData`
+            statistics = getattr(plant_data, 'statistics', None) or {}
             yield self._get_state(
-                microinverter_data.serial_number,
-                self._port_entities,
-                microinverter_data,
-                microinverter_data.port_number,
+                plant_data.dtu, self._dtu_plan, plant_data, statistics=statistics.get((plant_data.dtu, None))
             )
+            for serial_number, ports in index.items():
+                # microinverter level values are the same in records of all ports
+                yield self._get_state(
+                    serial_number, self._mi_plan, ports[0], statistics=statistics.get((serial_number, None))
+                )
+                for port_data in ports:
+                    port_number = port_data.port_number
+                    yield self._get_state(
+                        serial_number,
+                        self._port_plan,
+                        port_data,
+                        port_number,
+                        statistics=statistics.get((serial_number, port_number)),
+                    )
+            # ports which could not be read, see `hoymiles_mqtt.blocks.PartialPlantData`
+            missing_ports = getattr(plant_data, 'missing_ports', None)
+            if missing_ports:
+                yield from self._get_unavailable_states(missing_ports, index)
+        if self._snapshot is not None:
+            yield self._snapshot.get_topic(plant_data.dtu), self._snapshot.encode(self._get_snapshot(plant_data, index))
+
+    def _get_unavailable_states(
+        self, missing_ports: List[Tuple[str, int]], index: Dict[str, List['InverterData']]
+    ) -> Iterable[Tuple[str, bytes]]:
+        """Get states without values (so entities become unavailable) of ports which could not be read.
+
+        Microinverters are unavailable when none of their ports was read.
+
+        """
+        payload = self._encode({})
+        missing_inverters: Set[str] = set()
+        for serial_number, port_number in missing_ports:
+            if serial_number not in index and serial_number not in missing_inverters:
+                missing_inverters.add(serial_number)
+                yield self._get_state_topic(serial_number, None), payload
+            yield self._get_state_topic(serial_number, port_number), payload
+
+    def _get_snapshot(self, plant_data: 'PlantData', index: Dict[str, List['InverterData']]) -> Dict[str, Any]:
+        """Build columnar snapshot of plant data.
+
+        Microinverter and port entities are arrays with values of all microinverters and ports respectively,
+        ignored values are null.
+
+        """
+        inverters: Dict[str, List[Any]] = {'serial_number': list(index)}
+        inverters.update((entity_name, []) for entity_name in self._mi_entities)
+        ports: Dict[str, List[Any]] = {'serial_number': [], 'port_number': []}
+        ports.update((entity_name, []) for entity_name in self._port_entities)
+        for serial_number, inverter_ports in index.items():
+            values = self._mi_plan.extract(inverter_ports[0])
+            for entity_name in self._mi_entities:
+                inverters[entity_name].append(values.get(entity_name))
+            for port_data in inverter_ports:
+                values = self._port_plan.extract(port_data)
+                ports['serial_number'].append(serial_number)
+                ports['port_number'].append(port_data.port_number)
+                for entity_name in self._port_entities:
+                    ports[entity_name].append(values.get(entity_name))
+        return {'dtu': plant_data.dtu, **self._dtu_plan.extract(plant_data), 'inverters': inverters, 'ports': ports}
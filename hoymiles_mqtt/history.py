@@ -0,0 +1,263 @@
+"""History of recent plant data, queried over HTTP.
+
+Values of DTU, microinverter and port entities from each query are kept in ring buffers - one slot per query,
+with fixed memory per device entity (`array` of floats, missing values are NaN), so the last hours of data can be
+read from the process instead of being re-stored from MQTT by each consumer. Series of devices which are no longer
+reported by DTU are dropped once all their values are overwritten.
+
+The history is served as JSON by `HistoryServer`:
+
+- `/history` - devices (serial numbers, ports and entities) with the number of recorded queries per DTU
+- `/history/<serial_number>[/<port_number>]?entity=<name>&start=<timestamp>&end=<timestamp>` - timestamps
+  (seconds since the epoch) and values of the device entities (all by default, `entity` can be repeated)
+  in the given time range (the whole history by default), missing values are null
+
+"""
+
+import bisect
+import math
+import threading
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES, _main_logger
+from hoymiles_mqtt.encoding import Encoder, get_encoder
+from hoymiles_mqtt.ha import DtuEntities
+
+if TYPE_CHECKING:
+    from hoymiles_modbus.datatypes import PlantData
+
+logger = _main_logger.getChild('history')
+
+CONTENT_TYPE = 'application/json'
+
+DTU_ENTITIES = list(DtuEntities)
+
+# serial number, port number (None for DTU and microinverter level entities), entity name
+SeriesKey = Tuple[str, Optional[int], str]
+
+
+class PlantHistory:
+    """Ring buffer of values of entities of a DTU and its microinverters, one slot per query."""
+
+    def __init__(self, capacity: int) -> None:
+        """Initialize the object.
+
+        Arguments:
+            capacity: number of queries kept, the oldest ones are overwritten
+
+        """
+        if capacity < 1:
+            raise ValueError('History capacity must be positive')
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._timestamps = array('d', [math.nan]) * capacity
+        self._series: Dict[SeriesKey, array] = {}
+        # number of the last query with a value, by series
+        self._last_recorded: Dict[SeriesKey, int] = {}
+        self._recorded = 0
+        self._next = 0
+        self._size = 0
+
+    @property
+    def capacity(self) -> int:
+        """Number of queries kept."""
+        return self._capacity
+
+    def __len__(self) -> int:
+        """Number of recorded queries."""
+        return self._size
+
+    def _slot_values(self, plant_data: 'PlantData') -> Dict[SeriesKey, float]:
+        values: Dict[SeriesKey, float] = {}
+        for entity_name in DTU_ENTITIES:
+            values[(plant_data.dtu, None, entity_name)] = float(getattr(plant_data, entity_name))
+        for port_data in plant_data.inverters:
+            serial_number = port_data.serial_number
+            if (serial_number, None, MI_ENTITIES[0]) not in values:
+                # microinverter level values are the same in records of all ports
+                for entity_name in MI_ENTITIES:
+                    values[(serial_number, None, entity_name)] = float(getattr(port_data, entity_name))
+            for entity_name in PORT_ENTITIES:
+                values[(serial_number, port_data.port_number, entity_name)] = float(getattr(port_data, entity_name))
+        return values
+
+    def record(self, plant_data: 'PlantData', timestamp: float) -> None:
+        """Record data from a query.
+
+        Arguments:
+            plant_data: data from DTU
+            timestamp: acquisition time of the data (seconds since the epoch)
+
+        """
+        values = self._slot_values(plant_data)
+        with self._lock:
+            slot = self._next
+            self._recorded += 1
+            self._timestamps[slot] = timestamp
+            last_recorded = self._last_recorded
+            for key, series in list(self._series.items()):
+                value = values.pop(key, math.nan)
+                if not math.isnan(value):
+                    last_recorded[key] = self._recorded
+                elif self._recorded - last_recorded[key] >= self._capacity:
+                    # only missing values left
+                    del self._series[key]
+                    del last_recorded[key]
+                    continue
+                series[slot] = value
+            for key, value in values.items():
+                # device seen for the first time
+                series = array('d', [math.nan]) * self._capacity
+                series[slot] = value
+                self._series[key] = series
+                last_recorded[key] = self._recorded
+            self._next = (slot + 1) % self._capacity
+            self._size = min(self._size + 1, self._capacity)
+
+    def devices(self) -> List[Dict[str, Any]]:
+        """Devices in the history - serial numbers, port numbers (None for DTU and microinverters) and entities."""
+        with self._lock:
+            keys = list(self._series)
+        devices: Dict[Tuple[str, Optional[int]], List[str]] = {}
+        for serial_number, port_number, entity_name in keys:
+            devices.setdefault((serial_number, port_number), []).append(entity_name)
+        return [
+            {'serial_number': serial_number, 'port_number': port_number, 'entities': entities}
+            for (serial_number, port_number), entities in devices.items()
+        ]
+
+    def has_device(self, serial_number: str, port_number: Optional[int] = None) -> bool:
+        """Whether there is history of the given device."""
+        with self._lock:
+            return any(key[:2] == (serial_number, port_number) for key in self._series)
+
+    def query(
+        self,
+        serial_number: str,
+        port_number: Optional[int] = None,
+        entities: Optional[List[str]] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """Get values of a device from the given time range.
+
+        Arguments:
+            serial_number: serial number of DTU or microinverter
+            port_number: port number, None for DTU or microinverter level entities
+            entities: names of entities, all entities of the device by default
+            start: beginning of the time range (seconds since the epoch, inclusive), the oldest data by default
+            end: end of the time range (seconds since the epoch, inclusive), the latest data by default
+
+        Returns:
+            `timestamps` of queries and `values` - lists of values (None when missing) by entity names
+
+        """
+        with self._lock:
+            # slots from the oldest to the latest
+            slots = [(self._next - self._size + index) % self._capacity for index in range(self._size)]
+            timestamps = [self._timestamps[slot] for slot in slots]
+            first = 0 if start is None else bisect.bisect_left(timestamps, start)
+            last = len(timestamps) if end is None else bisect.bisect_right(timestamps, end)
+            slots = slots[first:last]
+            values = {}
+            for (series_serial, series_port, entity_name), series in self._series.items():
+                if series_serial != serial_number or series_port != port_number:
+                    continue
+                if entities is not None and entity_name not in entities:
+                    continue
+                values[entity_name] = [None if math.isnan(value) else value for value in map(series.__getitem__, slots)]
+        return {'timestamps': timestamps[first:last], 'values': values}
+
+
+class HistoryServer:
+    """HTTP server of history (read-only JSON), running in a background thread."""
+
+    def __init__(
+        self, histories: Dict[str, PlantHistory], host: str, port: int, encoder: Optional[Encoder] = None
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            histories: history of each DTU, by DTU names
+            host: address to listen on
+            port: port to listen on
+            encoder: JSON encoder (see `hoymiles_mqtt.encoding`), the fastest installed one by default
+
+        """
+        encode = encoder or get_encoder()
+
+        def get_devices() -> Dict[str, Any]:
+            return {
+                'dtus': {
+                    name: {'queries': len(history), 'capacity': history.capacity, 'devices': history.devices()}
+                    for name, history in histories.items()
+                }
+            }
+
+        def get_device_history(path: List[str], query: Dict[str, List[str]]) -> Optional[Dict[str, Any]]:
+            serial_number = path[0]
+            port_number = int(path[1]) if len(path) > 1 else None
+            start = float(query['start'][0]) if 'start' in query else None
+            end = float(query['end'][0]) if 'end' in query else None
+            for history in histories.values():
+                if history.has_device(serial_number, port_number):
+                    result = history.query(serial_number, port_number, query.get('entity'), start, end)
+                    return {'serial_number': serial_number, 'port_number': port_number, **result}
+            return None
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send_json(self, status: int, content: Any) -> None:
+                body = encode(content)
+                self.send_response(status)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self) -> None:  # noqa: N802
+                url = urlsplit(self.path)
+                path = [part for part in url.path.split('/') if part]
+                if not path or path[0] != 'history' or len(path) > 3:
+                    self.send_error(404)
+                    return
+                if len(path) == 1:
+                    self._send_json(200, get_devices())
+                    return
+                try:
+                    result = get_device_history(path[1:], parse_qs(url.query))
+                except ValueError as exc:
+                    self._send_json(400, {'error': str(exc)})
+                    return
+                if result is None:
+                    self._send_json(404, {'error': 'Unknown device'})
+                    return
+                self._send_json(200, result)
+
+            def log_message(self, format, *args) -> None:  # noqa: A002
+                logger.debug(format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        """Port the server listens on."""
+        return self._server.server_address[1]
+
+    def start(self) -> None:
+        """Start serving in a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name='history', daemon=True)
+        self._thread.start()
+        logger.info('Serving history on port %s', self.port)
+
+    def stop(self) -> None:
+        """Stop serving."""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
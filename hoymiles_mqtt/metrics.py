@@ -0,0 +1,336 @@
+"""Metrics in Prometheus text format, served over HTTP.
+
+Implemented with standard library only. Each series is updated by a single thread (the one handling its DTU),
+so no locks are used when recording values - reading a value during an update may return the value from
+before the update, which is acceptable for scraping.
+
+"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from hoymiles_mqtt import _main_logger
+
+logger = _main_logger.getChild('metrics')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Value:
+    """Value of a counter or a gauge."""
+
+    def __init__(self) -> None:
+        """Initialize the object."""
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        """Increase the value."""
+        self.value += amount
+
+    def set(self, value: float) -> None:
+        """Set the value (gauges only)."""
+        self.value = value
+
+
+class HistogramValue:
+    """Observations of a histogram."""
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        """Initialize the object.
+
+        Arguments:
+            buckets: upper bounds of buckets, sorted
+
+        """
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Record an observation."""
+        self.counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    """Metric with series for each combination of label values."""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        """Initialize the object.
+
+        Arguments:
+            name: name of the metric
+            documentation: help text
+            label_names: names of labels
+
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._series: Dict[Tuple[str, ...], object] = {}
+
+    def _new_series(self) -> object:
+        return Value()
+
+    def _labels(self, *values: str) -> object:
+        series = self._series.get(values)
+        if series is None:
+            series = self._series.setdefault(values, self._new_series())
+        return series
+
+    def _render_series(self, label_values: Tuple[str, ...], series) -> List[str]:
+        return [f'{self.name}{_format_labels(self.label_names, label_values)} {_format_value(series.value)}']
+
+    def render(self) -> List[str]:
+        """Lines of text representation of the metric."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for label_values, series in list(self._series.items()):
+            lines.extend(self._render_series(label_values, series))
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    type = 'counter'
+
+    def labels(self, *values: str) -> Value:
+        """Get series for given label values."""
+        return self._labels(*values)  # type: ignore[return-value]
+
+
+class Gauge(Metric):
+    """Value that can go up and down."""
+
+    type = 'gauge'
+
+    def labels(self, *values: str) -> Value:
+        """Get series for given label values."""
+        return self._labels(*values)  # type: ignore[return-value]
+
+
+class Histogram(Metric):
+    """Distribution of observed values in buckets."""
+
+    type = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            name: name of the metric
+            documentation: help text
+            label_names: names of labels
+            buckets: upper bounds of buckets (+Inf bucket is added automatically)
+
+        """
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_series(self) -> object:
+        return HistogramValue(self.buckets)
+
+    def labels(self, *values: str) -> HistogramValue:
+        """Get series for given label values."""
+        return self._labels(*values)  # type: ignore[return-value]
+
+    def _render_series(self, label_values: Tuple[str, ...], series) -> List[str]:
+        lines = []
+        counts = list(series.counts)
+        cumulative = 0
+        for bound, count in zip([*map(_format_value, self.buckets), '+Inf'], counts):
+            cumulative += count
+            labels = _format_labels((*self.label_names, 'le'), (*label_values, bound))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.label_names, label_values)
+        lines.append(f'{self.name}_sum{labels} {_format_value(series.sum)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """Metrics of the tool."""
+
+    def __init__(self) -> None:
+        """Initialize the object."""
+        self.read_time = Histogram('hoymiles_mqtt_modbus_read_seconds', 'Time of reading data from DTU.', ['dtu'])
+        self.build_time = Histogram(
+            'hoymiles_mqtt_build_seconds', 'Time of building MQTT messages (configs and states).', ['dtu']
+        )
+        self.publish_time = Histogram('hoymiles_mqtt_publish_seconds', 'Time of publishing MQTT messages.', ['dtu'])
+        self.skipped_cycles = Counter(
+            'hoymiles_mqtt_skipped_cycles_total', 'Query cycles skipped as the previous one was not finished.', ['dtu']
+        )
+        self.read_errors = Counter(
+            'hoymiles_mqtt_modbus_errors_total', 'Failures of reading data from DTU, by error type.', ['dtu', 'type']
+        )
+        self.publish_failures = Counter(
+            'hoymiles_mqtt_publish_failures_total', 'Failures of publishing MQTT messages.', ['dtu']
+        )
+        self.messages_sent = Counter('hoymiles_mqtt_messages_sent_total', 'Published MQTT messages.', ['dtu'])
+        self.bytes_sent = Counter(
+            'hoymiles_mqtt_bytes_sent_total', 'Size of topics and payloads of published MQTT messages.', ['dtu']
+        )
+        self.last_poll = Gauge(
+            'hoymiles_mqtt_last_successful_poll_timestamp_seconds',
+            'Time (seconds since the epoch) of the last successful reading of data from DTU.',
+            ['dtu'],
+        )
+        self.request_time = Histogram(
+            'hoymiles_mqtt_modbus_request_seconds',
+            'Latency of Modbus requests to DTU (persistent connection).',
+            ['dtu'],
+        )
+        self.connects = Counter('hoymiles_mqtt_modbus_connects_total', 'Connections established to DTU.', ['dtu'])
+        self.circuit_open = Gauge(
+            'hoymiles_mqtt_modbus_circuit_open', '1 when querying of DTU is paused after repeated failures.', ['dtu']
+        )
+        self.mqtt_published = Counter(
+            'hoymiles_mqtt_mqtt_qos_published_total', 'MQTT messages published with QoS 1 (persistent connection).'
+        )
+        self.mqtt_acked = Counter(
+            'hoymiles_mqtt_mqtt_acked_total', 'MQTT messages published with QoS 1 acknowledged by the broker.'
+        )
+        self.mqtt_retried = Counter(
+            'hoymiles_mqtt_mqtt_retried_total', 'MQTT messages with QoS 1 resent after reconnection to the broker.'
+        )
+        self.mqtt_ack_time = Histogram(
+            'hoymiles_mqtt_mqtt_ack_seconds', 'Time from publishing MQTT messages with QoS 1 to their acknowledgement.'
+        )
+        self.mqtt_delivery_ratio = Gauge(
+            'hoymiles_mqtt_mqtt_delivery_ratio', 'Ratio of acknowledged to published MQTT messages with QoS 1.'
+        )
+        self._metrics: List[Metric] = [
+            self.read_time,
+            self.build_time,
+            self.publish_time,
+            self.skipped_cycles,
+            self.read_errors,
+            self.publish_failures,
+            self.messages_sent,
+            self.bytes_sent,
+            self.last_poll,
+            self.request_time,
+            self.connects,
+            self.circuit_open,
+            self.mqtt_published,
+            self.mqtt_acked,
+            self.mqtt_retried,
+            self.mqtt_ack_time,
+            self.mqtt_delivery_ratio,
+        ]
+
+    def for_dtu(self, dtu: str) -> 'DtuMetrics':
+        """Get metrics of a DTU."""
+        return DtuMetrics(self, dtu)
+
+    def render(self) -> str:
+        """Text representation of all metrics."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class DtuMetrics:
+    """Metrics of a single DTU, to be updated from a single thread."""
+
+    def __init__(self, registry: MetricsRegistry, dtu: str) -> None:
+        """Initialize the object.
+
+        Arguments:
+            registry: registry of metrics
+            dtu: DTU name (value of `dtu` label)
+
+        """
+        self._dtu = dtu
+        self._read_errors = registry.read_errors
+        self.read_time = registry.read_time.labels(dtu)
+        self.build_time = registry.build_time.labels(dtu)
+        self.publish_time = registry.publish_time.labels(dtu)
+        self.skipped_cycles = registry.skipped_cycles.labels(dtu)
+        self.publish_failures = registry.publish_failures.labels(dtu)
+        self.messages_sent = registry.messages_sent.labels(dtu)
+        self.bytes_sent = registry.bytes_sent.labels(dtu)
+        self.last_poll = registry.last_poll.labels(dtu)
+        self.request_time = registry.request_time.labels(dtu)
+        self.connects = registry.connects.labels(dtu)
+        self.circuit_open = registry.circuit_open.labels(dtu)
+
+    def read_error(self, exc: Exception) -> None:
+        """Count a failure of reading data from DTU."""
+        self._read_errors.labels(self._dtu, type(exc).__name__).inc()
+
+
+class MetricsServer:
+    """HTTP server of metrics (`/metrics`), running in a background thread."""
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int) -> None:
+        """Initialize the object.
+
+        Arguments:
+            registry: registry of metrics
+            host: address to listen on
+            port: port to listen on
+
+        """
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:  # noqa: N802
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:  # noqa: A002
+                logger.debug(format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        """Port the server listens on."""
+        return self._server.server_address[1]
+
+    def start(self) -> None:
+        """Start serving in a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logger.info('Serving metrics on port %s', self.port)
+
+    def stop(self) -> None:
+        """Stop serving."""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
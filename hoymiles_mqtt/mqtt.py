@@ -1,28 +1,213 @@
 """MQTT related interfaces."""
 
+import threading
+import time
 from contextlib import contextmanager
-from typing import TYPE_CHECKING, Any, Generator, Optional
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generator, List, Optional, Tuple, Union
 
+from paho.mqtt import client as mqtt_client
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from paho.mqtt.publish import multiple as publish_multiple
 
+from hoymiles_mqtt import (
+    DEFAULT_MAX_INFLIGHT,
+    MQTT_QOS_LEVELS,
+    MQTT_VERSION_5,
+    MQTT_VERSION_311,
+    MQTT_VERSIONS,
+    _main_logger,
+)
+
 if TYPE_CHECKING:
     from paho.mqtt.publish import AuthParameter, MessagesList, TLSParameter
 
+    from hoymiles_mqtt.metrics import MetricsRegistry
+
+logger = _main_logger.getChild('mqtt')
+
+KEEPALIVE_SEC = 60
+RECONNECT_DELAY_MIN_SEC = 1
+RECONNECT_DELAY_MAX_SEC = 120
+CONNECT_TIMEOUT_SEC = 10
+PUBLISH_TIMEOUT_SEC = 10
+CONNECT_POLL_SEC = 0.1
+
 
 class MsgQueue:
     """MQTT message queue."""
 
-    def __init__(self, buffer: "MessagesList") -> None:
-        """Initialize the queue."""
+    def __init__(self, buffer: "MessagesList", qos: int = 0) -> None:
+        """Initialize the queue.
+
+        Arguments:
+            buffer: list the messages are added to
+            qos: QoS of messages added without explicit QoS
+
+        """
         self._buffer = buffer
+        self._qos = qos
 
-    def add(self, topic: str, payload: str, qos: int = 0, retain: bool = False) -> None:
+    def add(self, topic: str, payload: Union[str, bytes], qos: Optional[int] = None, retain: bool = False) -> None:
         """Add a message to the queue."""
-        self._buffer.append((topic, payload, qos, retain))
+        self._buffer.append((topic, payload, self._qos if qos is None else qos, retain))
+
+
+class DeliveryStats:
+    """Delivery statistics of messages published with QoS 1 through the long-lived connection."""
+
+    __slots__ = ('published', 'acked', 'rejected', 'retried', 'latency_total', 'latency_max')
+
+    def __init__(self) -> None:
+        """Initialize the object."""
+        self.published = 0
+        self.acked = 0
+        self.rejected = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    @property
+    def delivery_ratio(self) -> float:
+        """Ratio of acknowledged to published messages (messages still in flight are not delivered yet)."""
+        return self.acked / self.published if self.published else 1.0
+
+    @property
+    def mean_latency(self) -> float:
+        """Mean time (in seconds) from publishing to acknowledgement."""
+        return self.latency_total / self.acked if self.acked else 0.0
+
+
+class _InflightWindow:
+    """Messages published with QoS 1 and waiting for acknowledgement, limited to a number of messages.
+
+    Acknowledgements are recorded from the network loop thread (`on_publish` callback). An acknowledgement received
+    before the message is registered (the callback does not find it) is detected with `MQTTMessageInfo`
+    when sweeping, so no message is left in the window.
+
+    """
+
+    def __init__(self, max_inflight: int, metrics: Optional["MetricsRegistry"] = None) -> None:
+        self.max_inflight = max_inflight
+        self.limit = max_inflight
+        self.stats = DeliveryStats()
+        self._condition = threading.Condition()
+        self._pending: Dict[int, Tuple[float, mqtt_client.MQTTMessageInfo]] = {}
+        self._metrics = metrics
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _ack(self, sent_at: float) -> None:
+        latency = time.monotonic() - sent_at
+        stats = self.stats
+        stats.acked += 1
+        stats.latency_total += latency
+        stats.latency_max = max(stats.latency_max, latency)
+        if self._metrics is not None:
+            self._metrics.mqtt_acked.labels().inc()
+            self._metrics.mqtt_ack_time.labels().observe(latency)
+            self._metrics.mqtt_delivery_ratio.labels().set(stats.delivery_ratio)
+
+    def _sweep(self) -> None:
+        for mid, (sent_at, info) in list(self._pending.items()):
+            if info.is_published():
+                del self._pending[mid]
+                self._ack(sent_at)
+
+    def acquire(self, timeout: float) -> bool:
+        """Wait until there is room for a message, `False` when there is no room within `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while len(self._pending) >= self.limit:
+                self._sweep()
+                if len(self._pending) < self.limit:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(timeout=min(CONNECT_POLL_SEC, remaining))
+            return True
+
+    def add(self, info: mqtt_client.MQTTMessageInfo, sent_at: float) -> None:
+        """Register a published message."""
+        with self._condition:
+            self.stats.published += 1
+            if self._metrics is not None:
+                self._metrics.mqtt_published.labels().inc()
+            self._pending[info.mid] = (sent_at, info)
+            if info.is_published():
+                del self._pending[info.mid]
+                self._ack(sent_at)
+
+    def on_ack(self, mid: int, accepted: bool = True) -> None:
+        """Record acknowledgement of a message, not accepted ones are rejected by the broker (MQTT 5)."""
+        with self._condition:
+            pending = self._pending.pop(mid, None)
+            if pending is None:
+                return
+            if accepted:
+                self._ack(pending[0])
+            else:
+                self.stats.rejected += 1
+            self._condition.notify_all()
+
+    def on_reconnect(self) -> int:
+        """Count messages in flight, the client resends them after reconnection."""
+        with self._condition:
+            retried = len(self._pending)
+            self.stats.retried += retried
+            if self._metrics is not None and retried:
+                self._metrics.mqtt_retried.labels().inc(retried)
+            return retried
+
+    def wait(self, mids: List[int], timeout: float) -> int:
+        """Wait for acknowledgement of messages, until no message is acknowledged for `timeout` seconds.
+
+        Returns:
+            number of messages not acknowledged
+
+        """
+        with self._condition:
+            waiting = len(mids)
+            deadline = time.monotonic() + timeout
+            while True:
+                self._sweep()
+                not_acked = sum(1 for mid in mids if mid in self._pending)
+                if not_acked < waiting:
+                    # progress, the broker is reachable
+                    waiting = not_acked
+                    deadline = time.monotonic() + timeout
+                remaining = deadline - time.monotonic()
+                if not waiting or remaining <= 0:
+                    return waiting
+                self._condition.wait(timeout=min(CONNECT_POLL_SEC, remaining))
+
+    def clear(self) -> None:
+        """Forget messages in flight (the client was replaced)."""
+        with self._condition:
+            self._pending.clear()
+            self._condition.notify_all()
 
 
 class MqttPublisher:
-    """MQTT Publisher."""
+    """MQTT Publisher.
+
+    By default, the publisher keeps a single long-lived connection to the broker. The network loop runs
+    in a background thread and the connection is automatically re-established (with exponential backoff)
+    when lost. Alternatively, the publisher can open a new connection for each group of messages.
+
+    Messages with QoS 1 sent through the long-lived connection are pipelined - up to `max_inflight` messages wait for
+    acknowledgement (PUBACK) at once, instead of waiting for each one in turn. Acknowledgements are tracked with
+    their latency in `delivery_stats` (and in metrics, when given). Messages not acknowledged before the connection
+    is lost are resent by the client after reconnection.
+
+    With the long-lived connection, MQTT 5 can be used. Then non-retained messages (states) published with
+    QoS 0 get topic aliases (up to the maximum announced by the broker), so their topics are sent in full
+    only once per connection, and optionally Message Expiry Interval. When the broker does not support MQTT 5,
+    the publisher falls back to MQTT 3.1.1.
+
+    """
 
     def __init__(
         self,
@@ -32,6 +217,12 @@ class MqttPublisher:
         mqtt_password: Optional[str] = None,
         mqtt_tls: bool = False,
         mqtt_tls_insecure: bool = False,
+        persistent_session: bool = True,
+        mqtt_version: str = MQTT_VERSION_311,
+        message_expiry: int = 0,
+        qos: int = 0,
+        max_inflight: int = DEFAULT_MAX_INFLIGHT,
+        metrics: Optional["MetricsRegistry"] = None,
     ):
         """Initialize the object.
 
@@ -42,6 +233,15 @@ class MqttPublisher:
             mqtt_password: password
             mqtt_tls: TLS connection
             mqtt_tls_insecure: TLS insecure connection
+            persistent_session: keep one connection open across publishing sessions, when `False`
+                                a new connection is opened (and closed) for each publishing session
+            mqtt_version: MQTT protocol version (one of `MQTT_VERSIONS`) of the long-lived connection
+            message_expiry: MQTT 5 only, number of seconds after which the broker drops non-retained messages
+                            not delivered to subscribers, 0 means no expiry
+            qos: QoS of messages (one of `MQTT_QOS_LEVELS`)
+            max_inflight: maximum number of messages with QoS 1 waiting for acknowledgement, with the long-lived
+                          connection (MQTT 5 brokers may lower it with Receive Maximum)
+            metrics: metrics where delivery of messages with QoS 1 is recorded, not recorded by default
 
         """
         self._mqtt_broker = mqtt_broker
@@ -55,6 +255,25 @@ class MqttPublisher:
                 'ca_certs': None,  # use default certs
                 'insecure': mqtt_tls_insecure,
             }
+        self._persistent_session = persistent_session
+        self._client: Optional[mqtt_client.Client] = None
+        self._client_lock = threading.Lock()
+        self._connected = threading.Event()
+        self._subscriptions: Dict[str, List[Callable[[bytes], None]]] = {}
+        if mqtt_version not in MQTT_VERSIONS:
+            raise ValueError(f'Unknown MQTT version {mqtt_version}')
+        self._protocol = mqtt_client.MQTTv5 if mqtt_version == MQTT_VERSION_5 else mqtt_client.MQTTv311
+        self._protocol_downgraded = threading.Event()
+        self._message_expiry = message_expiry
+        self._alias_lock = threading.Lock()
+        self._topic_aliases: Dict[str, int] = {}
+        self._topic_alias_max = 0
+        if qos not in MQTT_QOS_LEVELS:
+            raise ValueError(f'Unsupported QoS {qos}')
+        if max_inflight < 1:
+            raise ValueError('Maximum number of messages in flight must be positive')
+        self._qos = qos
+        self._window = _InflightWindow(max_inflight, metrics)
 
     @property
     def broker(self) -> str:
@@ -66,22 +285,250 @@ class MqttPublisher:
         """Port of the MQTT broker."""
         return self._mqtt_port
 
+    @property
+    def persistent_session(self) -> bool:
+        """Whether the publisher keeps a long-lived connection to the broker."""
+        return self._persistent_session
+
+    @property
+    def mqtt_version(self) -> str:
+        """MQTT protocol version of the long-lived connection (after fallback, if any)."""
+        return MQTT_VERSION_5 if self._protocol == mqtt_client.MQTTv5 else MQTT_VERSION_311
+
+    @property
+    def qos(self) -> int:
+        """Quality of service level of messages."""
+        return self._qos
+
+    @property
+    def delivery_stats(self) -> DeliveryStats:
+        """Delivery statistics of messages published with QoS 1."""
+        return self._window.stats
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties) -> None:
+        if reason_code.is_failure:
+            if self._protocol == mqtt_client.MQTTv5 and reason_code == 'Unsupported protocol version':
+                logger.warning('MQTT broker does not support MQTT 5, falling back to MQTT 3.1.1.')
+                self._protocol = mqtt_client.MQTTv311
+                self._protocol_downgraded.set()
+                return
+            logger.warning('Connection to MQTT broker refused: %s', reason_code)
+            return
+        with self._alias_lock:
+            # topic aliases are valid only within a single network connection
+            self._topic_aliases = {}
+            self._topic_alias_max = 0
+            if self._protocol == mqtt_client.MQTTv5 and properties is not None:
+                self._topic_alias_max = getattr(properties, 'TopicAliasMaximum', 0)
+        receive_maximum = getattr(properties, 'ReceiveMaximum', None) if self._protocol == mqtt_client.MQTTv5 else None
+        self._window.limit = min(self._window.max_inflight, receive_maximum or self._window.max_inflight)
+        retried = self._window.on_reconnect()
+        if retried:
+            logger.info('Resending %s MQTT messages not acknowledged before reconnection.', retried)
+        logger.info(
+            'Connected to MQTT broker mqtt://%s:%s (MQTT %s, topic aliases %s)',
+            self.broker,
+            self.broker_port,
+            self.mqtt_version,
+            self._topic_alias_max,
+        )
+        for topic in list(self._subscriptions):
+            client.subscribe(topic)
+        self._connected.set()
+
+    def _on_message(self, client, userdata, message) -> None:
+        for callback in self._subscriptions.get(message.topic, []):
+            try:
+                callback(message.payload)
+            except Exception:
+                logger.exception('Failed to handle message from %s', message.topic)
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties) -> None:
+        if reason_code.is_failure:
+            logger.warning('MQTT broker rejected message %s: %s', mid, reason_code)
+        self._window.on_ack(mid, accepted=not reason_code.is_failure)
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties) -> None:
+        self._connected.clear()
+        if reason_code.is_failure:
+            logger.warning('Connection to MQTT broker lost (%s), reconnecting.', reason_code)
+        else:
+            logger.info('Disconnected from MQTT broker.')
+
+    def _create_client(self) -> mqtt_client.Client:
+        client = mqtt_client.Client(
+            callback_api_version=mqtt_client.CallbackAPIVersion.VERSION2, protocol=self._protocol
+        )
+        if self._auth:
+            client.username_pw_set(self._auth['username'], self._auth.get('password'))
+        if self._tls:
+            client.tls_set(ca_certs=self._tls.get('ca_certs'))
+            client.tls_insecure_set(bool(self._tls.get('insecure')))
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_message = self._on_message
+        client.on_publish = self._on_publish
+        client.max_inflight_messages_set(self._window.max_inflight)
+        client.reconnect_delay_set(min_delay=RECONNECT_DELAY_MIN_SEC, max_delay=RECONNECT_DELAY_MAX_SEC)
+        client.connect_async(self.broker, self.broker_port, keepalive=KEEPALIVE_SEC)
+        client.loop_start()
+        return client
+
+    def _get_client(self) -> mqtt_client.Client:
+        with self._client_lock:
+            if self._protocol_downgraded.is_set():
+                self._protocol_downgraded.clear()
+                client, self._client = self._client, None
+                if client is not None:
+                    client.disconnect()
+                    client.loop_stop()
+                # messages in flight are lost with the old client
+                self._window.clear()
+            if self._client is None:
+                self._client = self._create_client()
+            return self._client
+
+    def subscribe(self, topic: str, callback: Callable[[bytes], None]) -> None:
+        """Subscribe to a topic.
+
+        Only supported with the long-lived connection. The subscription is renewed after each reconnection.
+        The connection is not opened by this method, it is opened with the first publishing session.
+        Multiple callbacks can be subscribed to the same topic.
+
+        Arguments:
+            topic: topic to subscribe (without wildcards)
+            callback: function called with payload of each received message, from the network loop thread
+
+        """
+        if not self._persistent_session:
+            logger.warning('Subscribing to %s is not supported without persistent MQTT session.', topic)
+            return
+        callbacks = self._subscriptions.setdefault(topic, [])
+        callbacks.append(callback)
+        with self._client_lock:
+            if len(callbacks) == 1 and self._client is not None and self._connected.is_set():
+                self._client.subscribe(topic)
+
+    def _get_topic_alias(self, topic: str) -> Tuple[str, Optional[int]]:
+        """Get topic and alias to publish with, the topic is empty when the alias is already known by the broker.
+
+        Must be called with `_alias_lock` held.
+
+        """
+        alias = self._topic_aliases.get(topic)
+        if alias is not None:
+            return '', alias
+        if len(self._topic_aliases) < self._topic_alias_max:
+            alias = self._topic_aliases[topic] = len(self._topic_aliases) + 1
+        return topic, alias
+
+    def _publish_message(
+        self, client: mqtt_client.Client, topic: str, payload: Union[str, bytes], qos: int, retain: bool
+    ) -> mqtt_client.MQTTMessageInfo:
+        if self._protocol != mqtt_client.MQTTv5 or retain:
+            return client.publish(topic, payload, qos, retain)
+        properties = Properties(PacketTypes.PUBLISH)
+        if self._message_expiry:
+            properties.MessageExpiryInterval = self._message_expiry
+        if qos != 0:
+            # messages with higher QoS may be resent after reconnection, when the alias is no longer valid
+            return client.publish(topic, payload, qos, retain, properties=None if properties.isEmpty() else properties)
+        # aliases are reset on reconnection (by `_on_connect`), so the lock is held until the message is queued
+        # within the connection the alias was assigned for - `publish` does not wait for the network loop thread
+        with self._alias_lock:
+            topic, alias = self._get_topic_alias(topic)
+            if alias is not None:
+                properties.TopicAlias = alias
+            return client.publish(topic, payload, qos, retain, properties=None if properties.isEmpty() else properties)
+
+    def _wait_for_connection(self) -> mqtt_client.Client:
+        deadline = time.monotonic() + CONNECT_TIMEOUT_SEC
+        client = self._get_client()
+        while not self._connected.wait(timeout=max(0.0, min(CONNECT_POLL_SEC, deadline - time.monotonic()))):
+            if time.monotonic() >= deadline:
+                raise ConnectionError(f'Not connected to MQTT broker mqtt://{self.broker}:{self.broker_port}')
+            # the client is replaced when falling back to an older protocol version
+            client = self._get_client()
+        return client
+
+    def _publish_persistent(self, messages: "MessagesList") -> None:
+        client = self._wait_for_connection()
+        infos = []
+        mids = []
+        for message in messages:
+            qos = message[2]  # type: ignore[literal-required]
+            if qos and not self._window.acquire(PUBLISH_TIMEOUT_SEC):
+                raise ConnectionError(
+                    f'{len(self._window)} messages not acknowledged by MQTT broker '
+                    f'mqtt://{self.broker}:{self.broker_port}'
+                )
+            sent_at = time.monotonic()
+            info = self._publish_message(client, *message)  # type: ignore[misc]
+            if qos:
+                self._window.add(info, sent_at)
+                mids.append(info.mid)
+            else:
+                infos.append(info)
+        deadline = time.monotonic() + PUBLISH_TIMEOUT_SEC
+        for info in infos:
+            info.wait_for_publish(timeout=max(0.0, deadline - time.monotonic()))
+        unpublished = sum(1 for info in infos if not info.is_published())
+        if mids:
+            unpublished += self._window.wait(mids, PUBLISH_TIMEOUT_SEC)
+            stats = self._window.stats
+            logger.debug(
+                'Delivered %s of %s MQTT messages with QoS 1 (mean latency %.3f s, max %.3f s, %s resent).',
+                stats.acked,
+                stats.published,
+                stats.mean_latency,
+                stats.latency_max,
+                stats.retried,
+            )
+        if unpublished:
+            raise ConnectionError(
+                f'{unpublished} of {len(messages)} messages not published to MQTT broker '
+                f'mqtt://{self.broker}:{self.broker_port}'
+            )
+
+    def close(self) -> None:
+        """Close the long-lived connection (if any)."""
+        with self._client_lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.disconnect()
+            client.loop_stop()
+            self._connected.clear()
+        stats = self._window.stats
+        if stats.published:
+            logger.info(
+                'Delivery ratio of MQTT messages with QoS 1: %.3f (%s of %s, %s rejected, %s resent).',
+                stats.delivery_ratio,
+                stats.acked,
+                stats.published,
+                stats.rejected,
+                stats.retried,
+            )
+        self._window.clear()
+
     @contextmanager
     def schedule_publish(self) -> Generator[MsgQueue, Any, None]:
         """Schedule and send messages in a group.
 
-        Context manager to collect messages and send them all
-        together within the same MQTT connection session at exit.
+        Context manager to collect messages and send them all together at exit,
+        either through the long-lived connection or within a dedicated MQTT connection session.
 
         """
         messages: MessagesList = []
 
-        yield MsgQueue(messages)
+        yield MsgQueue(messages, qos=self._qos)
 
-        publish_multiple(
-            msgs=messages,
-            hostname=self.broker,
-            port=self.broker_port,
-            auth=self._auth,
-            tls=self._tls,
-        )
+        if self._persistent_session:
+            self._publish_persistent(messages)
+        else:
+            publish_multiple(
+                msgs=messages,
+                hostname=self.broker,
+                port=self.broker_port,
+                auth=self._auth,
+                tls=self._tls,
+            )
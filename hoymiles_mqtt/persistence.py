@@ -0,0 +1,125 @@
+"""Persistence of energy production caches.
+
+`HassMqtt` guards today/total production of each microinverter port against values dropping (for example
+when a microinverter is temporarily not reachable). The caches are kept in memory, so after a restart
+the guard starts from zero. This module stores a snapshot of the caches in a file and restores it at startup.
+
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from hoymiles_mqtt import DEFAULT_SAVE_INTERVAL_SEC, _main_logger
+from hoymiles_mqtt.ha import HassMqtt
+
+logger = _main_logger.getChild('persistence')
+
+SNAPSHOT_VERSION = 1
+
+
+def _same_day(timestamp: float, other_timestamp: float) -> bool:
+    return time.localtime(timestamp)[:3] == time.localtime(other_timestamp)[:3]
+
+
+class ProductionCacheStore:
+    """Snapshot of production caches of one or more builders (DTUs), stored in a JSON file.
+
+    The snapshot is written atomically (temporary file, then rename), so a crash during writing does not
+    corrupt the previous snapshot. Today production is restored only when the snapshot was taken on the same
+    (local) day, total production is always restored.
+
+    """
+
+    def __init__(
+        self, path: str, builders: Dict[str, HassMqtt], save_interval: float = DEFAULT_SAVE_INTERVAL_SEC
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            path: path of the snapshot file
+            builders: builders by DTU names, the names are used as keys in the snapshot
+            save_interval: min number of seconds between writing of snapshots, see `save`
+
+        """
+        self._path = path
+        self._builders = builders
+        self._save_interval = save_interval
+        self._last_save: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """Restore production caches of the builders from the snapshot (if it exists)."""
+        try:
+            with open(self._path, encoding='utf-8') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            logger.warning('Failed to load production cache snapshot %s: %s', self._path, exc)
+            return
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            logger.warning('Unsupported version of production cache snapshot %s, ignored.', self._path)
+            return
+        with_today = _same_day(snapshot['timestamp'], time.time())
+        for name, builder in self._builders.items():
+            caches = snapshot['dtus'].get(name)
+            if caches is None:
+                continue
+            builder.restore_production_cache(
+                today={(serial, port): value for serial, port, value in caches['today']} if with_today else {},
+                total={(serial, port): value for serial, port, value in caches['total']},
+            )
+        logger.info(
+            'Production caches restored from %s (snapshot of %s%s).',
+            self._path,
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot['timestamp'])),
+            '' if with_today else ', today production not restored after day change',
+        )
+
+    def save(self, force: bool = False) -> bool:
+        """Write snapshot of production caches of the builders.
+
+        Safe to call in each query period, the snapshot is written at most once per `save_interval`.
+
+        Arguments:
+            force: write the snapshot regardless of the time of the previous one
+
+        Returns:
+            `True` if the snapshot was written
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_save is not None and now - self._last_save < self._save_interval:
+                return False
+            self._last_save = now
+            snapshot: Dict[str, Any] = {'version': SNAPSHOT_VERSION, 'timestamp': time.time(), 'dtus': {}}
+            for name, builder in self._builders.items():
+                today, total = builder.get_production_cache()
+                snapshot['dtus'][name] = {
+                    'today': [[serial, port, value] for (serial, port), value in today.items()],
+                    'total': [[serial, port, value] for (serial, port), value in total.items()],
+                }
+            try:
+                self._write(json.dumps(snapshot, separators=(',', ':')))
+            except OSError as exc:
+                logger.warning('Failed to save production cache snapshot %s: %s', self._path, exc)
+                return False
+        return True
+
+    def _write(self, content: str) -> None:
+        directory = os.path.dirname(os.path.abspath(self._path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.production_cache_')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as tmp_file:
+                tmp_file.write(content)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
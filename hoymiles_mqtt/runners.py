@@ -1,116 +1,461 @@
 """Runners."""
 
 import signal
+import statistics
 import threading
 import time
-from typing import Callable
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 from hoymiles_modbus.client import HoymilesModbusTCP
+from hoymiles_modbus.datatypes import PlantData
 from pymodbus import exceptions as pymodbus_exceptions
 
-from hoymiles_mqtt import _main_logger
-from hoymiles_mqtt.ha import HassMqtt
+from hoymiles_mqtt import DEFAULT_STATS_CYCLES, OVERRUN_COALESCE, OVERRUN_POLICIES, OVERRUN_SKIP, _main_logger
+from hoymiles_mqtt.adaptive import AdaptivePeriod
+from hoymiles_mqtt.buffer import OfflineBuffer
+from hoymiles_mqtt.connection import DtuUnavailableError
+from hoymiles_mqtt.downsampling import WindowAggregator
+from hoymiles_mqtt.ha import HA_STATUS_ONLINE, HA_STATUS_TOPIC, HassMqtt
+from hoymiles_mqtt.history import PlantHistory
+from hoymiles_mqtt.metrics import DtuMetrics
 from hoymiles_mqtt.mqtt import MqttPublisher
+from hoymiles_mqtt.persistence import ProductionCacheStore
 
 logger = _main_logger.getChild('runners')
 
 RESET_HOUR = 23
 
 
+def log_read_failure(exc: Exception) -> None:
+    """Log failure of reading data from DTU.
+
+    Must be called from an exception handler.
+
+    Arguments:
+        exc: the exception
+
+    """
+    if isinstance(exc, DtuUnavailableError):
+        # the pause itself is logged when it starts
+        logger.info("Skipped reading data from DTU: %s", exc)
+    elif isinstance(exc, pymodbus_exceptions.ModbusIOException):
+        # DTU did not respond, the exact message depends on pymodbus version
+        if 'No response received' in exc.message:
+            logger.warning("Failed to read data from DTU via Modbus. Will retry.")
+        else:
+            logger.exception("Failed to read data from DTU via Modbus.")
+    else:
+        logger.exception("Failed to read data from DTU. Unknown failure type.")
+
+
 class HoymilesQueryJob:
     """Get data from DTU and publish to MQTT broker."""
 
-    _lock = threading.Lock()
-
-    def __init__(self, mqtt_builder: HassMqtt, mqtt_publisher: MqttPublisher, modbus_client: HoymilesModbusTCP):
+    def __init__(
+        self,
+        mqtt_builder: HassMqtt,
+        mqtt_publisher: MqttPublisher,
+        modbus_client: Optional[HoymilesModbusTCP] = None,
+        offline_buffer: Optional[OfflineBuffer] = None,
+        production_store: Optional[ProductionCacheStore] = None,
+        metrics: Optional[DtuMetrics] = None,
+        adaptive_period: Optional[AdaptivePeriod] = None,
+        history: Optional[PlantHistory] = None,
+        downsampler: Optional[WindowAggregator] = None,
+    ):
         """Initialize the object.
 
         Arguments:
             mqtt_builder: an instance of MQTT message builder
             mqtt_publisher: an instance of MQTT publisher
-            modbus_client: an instance of Modbus client
+            modbus_client: an instance of Modbus client, not needed when data is acquired outside of the job
+                           and given to `publish`
+            offline_buffer: buffer for state messages which could not be published, by default they are dropped
+            production_store: store of energy production caches, saved (when due) after each data set
+            metrics: metrics of the DTU, not recorded by default
+            adaptive_period: query period updated with operating state of the plant from each data set
+            history: history where each data set is recorded, not recorded by default
+            downsampler: aggregation of data sets over windows, only aggregates are published when given
 
         """
         self._mqtt_builder: HassMqtt = mqtt_builder
         self._mqtt_publisher: MqttPublisher = mqtt_publisher
-        self._modbus_client: HoymilesModbusTCP = modbus_client
-        self._mqtt_configured: bool = False
+        self._modbus_client: Optional[HoymilesModbusTCP] = modbus_client
+        self._lock = threading.Lock()
+        self._offline_buffer = offline_buffer
+        self._production_store = production_store
+        self._metrics = metrics
+        self._adaptive_period = adaptive_period
+        self._history = history
+        self._downsampler = downsampler
+        self._last_plant_data: Optional[PlantData] = None
+        self._last_acquired_at = 0.0
+        self._republish_thread: Optional[threading.Thread] = None
+        self._mqtt_publisher.subscribe(HA_STATUS_TOPIC, self._on_ha_status)
+
+    def _on_ha_status(self, payload: bytes) -> None:
+        if payload == HA_STATUS_ONLINE:
+            logger.info('Home Assistant is online, republishing configs and states.')
+            # publish from a separate thread, the callback is called from MQTT network loop
+            self._republish_thread = threading.Thread(target=self._republish, name='ha_birth', daemon=True)
+            self._republish_thread.start()
+
+    def _republish(self) -> None:
+        with self._lock:
+            self._mqtt_builder.clear_configs()
+            self._mqtt_builder.clear_states()
+            # without any data, everything is published with the first data set
+            if self._last_plant_data is not None:
+                self._publish(self._last_plant_data, self._last_acquired_at)
+
+    @property
+    def metrics(self) -> Optional[DtuMetrics]:
+        """Metrics of the DTU (if recorded)."""
+        return self._metrics
+
+    @property
+    def adaptive_period(self) -> Optional[AdaptivePeriod]:
+        """Query period adapted to the operating state of the plant (if used)."""
+        return self._adaptive_period
+
+    def _record_sent(self, messages: Sequence[Tuple[str, Union[str, bytes]]]) -> None:
+        if self._metrics is not None:
+            self._metrics.messages_sent.inc(len(messages))
+            self._metrics.bytes_sent.inc(sum(len(topic) + len(payload) for topic, payload in messages))
+
+    def _publish_configs(self, configs: List[Tuple[str, bytes]]) -> None:
+        if not configs:
+            return
+        with self._mqtt_publisher.schedule_publish() as queue:
+            for topic, payload in configs:
+                queue.add(topic=topic, payload=payload, retain=True)
+                logger.debug(
+                    "Scheduled config publish into mqtt://%s:%s/%s",
+                    self._mqtt_publisher.broker,
+                    self._mqtt_publisher.broker_port,
+                    topic,
+                )
+
+    def _publish_states(self, states: List[Tuple[str, bytes]]) -> None:
+        with self._mqtt_publisher.schedule_publish() as queue:
+            for topic, payload in states:
+                queue.add(topic=topic, payload=payload)
+                logger.debug(
+                    "Scheduled data publish into mqtt://%s:%s/%s",
+                    self._mqtt_publisher.broker,
+                    self._mqtt_publisher.broker_port,
+                    topic,
+                )
+
+    def _publish(self, plant_data: PlantData, acquired_at: float) -> None:
+        states: List[Tuple[str, bytes]] = []
+        try:
+            start = time.perf_counter()
+            states = list(self._mqtt_builder.get_states(plant_data=plant_data))
+            # configs are generated only for devices which were not configured yet
+            configs = list(self._mqtt_builder.get_configs(plant_data=plant_data))
+            if self._metrics is not None:
+                self._metrics.build_time.observe(time.perf_counter() - start)
+            if self._production_store is not None:
+                self._production_store.save()
+            start = time.perf_counter()
+            self._publish_configs(configs)
+            self._record_sent(configs)
+            if self._offline_buffer is not None and len(self._offline_buffer):
+                # keep the order, current states are published after the buffered ones
+                self._offline_buffer.add(states, acquired_at, qos=self._mqtt_publisher.qos)
+                logger.info(
+                    "DTU data received, %s messages added to offline buffer (%s messages waiting)",
+                    len(states),
+                    len(self._offline_buffer),
+                )
+                return
+            self._publish_states(states)
+            if self._metrics is not None:
+                self._metrics.publish_time.observe(time.perf_counter() - start)
+            self._record_sent(states)
+        except Exception:
+            # make sure that next time all configs and states are sent
+            self._mqtt_builder.clear_configs()
+            self._mqtt_builder.clear_states()
+            logger.exception("Failed to publish data from DTU. Unknown failure type.")
+            if self._metrics is not None:
+                self._metrics.publish_failures.inc()
+            if self._offline_buffer is not None and states:
+                self._offline_buffer.add(states, acquired_at, qos=self._mqtt_publisher.qos)
+                logger.warning("Stored %s messages in offline buffer.", len(states))
+        else:
+            logger.info(
+                "DTU data received and published %s messages (%s unchanged skipped) into mqtt://%s:%d",
+                len(states),
+                self._mqtt_builder.skipped_states,
+                self._mqtt_publisher.broker,
+                self._mqtt_publisher.broker_port,
+            )
+
+    def _check_reset_hour(self) -> None:
+        if time.localtime().tm_hour == RESET_HOUR:
+            self._mqtt_builder.clear_production_today()
+            logger.info("Reset hour reached")
+
+    def _update_state(self, plant_data: PlantData, acquired_at: float) -> None:
+        if self._adaptive_period is not None:
+            self._adaptive_period.update(plant_data)
+        if self._history is not None:
+            self._history.record(plant_data, acquired_at)
+
+    def _process(self, plant_data: PlantData, acquired_at: float) -> None:
+        self._update_state(plant_data, acquired_at)
+        if self._downsampler is not None:
+            aggregated = self._downsampler.add(plant_data, acquired_at)
+            if aggregated is None:
+                logger.debug('DTU data received, %s data sets in the current window.', self._downsampler.samples)
+                return
+            plant_data = aggregated
+        self._last_plant_data = plant_data
+        self._last_acquired_at = acquired_at
+        self._publish(plant_data, acquired_at)
+
+    def publish(self, plant_data: PlantData, acquired_at: Optional[float] = None) -> None:
+        """Publish given data from DTU to MQTT broker.
+
+        Used when data is acquired outside of the job, see `hoymiles_mqtt.aio`.
+
+        Arguments:
+            plant_data: data from DTU
+            acquired_at: acquisition time of the data (seconds since the epoch), current time by default
+
+        """
+        with self._lock:
+            self._check_reset_hour()
+            self._process(plant_data, time.time() if acquired_at is None else acquired_at)
 
     def execute(self):
         """Get data from DTU and publish to MQTT broker."""
+        if self._modbus_client is None:
+            raise RuntimeError('Modbus client not given')
         is_acquired = self._lock.acquire(blocking=False)
         if not is_acquired:
             logger.warning(
                 'Previous data acquire and send was not finished before '
                 'starting the next loop. Perhaps query period is too small.'
             )
+            if self._metrics is not None:
+                self._metrics.skipped_cycles.inc()
             return
         try:
-            if time.localtime().tm_hour == RESET_HOUR:
-                self._mqtt_builder.clear_production_today()
-                logger.info("Reset hour reached")
+            self._check_reset_hour()
 
             logger.debug("Read data from DTU")
             plant_data = None
-            publish_count = 0
+            start = time.perf_counter()
             try:
                 plant_data = self._modbus_client.plant_data
                 logger.debug("Received data from DTU")
-            except pymodbus_exceptions.ModbusIOException as exc:
-                if 'No response received, expected at least 8 bytes' in exc.message:
-                    logger.warning("Failed to read data from DTU via Modbus. Will retry.")
-                else:
-                    logger.exception("Failed to read data from DTU via Modbus.")
-            except Exception:
-                logger.exception("Failed to read data from DTU. Unknown failure type.")
+            except Exception as exc:
+                log_read_failure(exc)
+                if self._metrics is not None:
+                    self._metrics.read_error(exc)
+            else:
+                if self._metrics is not None:
+                    self._metrics.read_time.observe(time.perf_counter() - start)
+                    self._metrics.last_poll.set(time.time())
 
             if plant_data:
-                try:
-                    # Publish configurations?
-                    # This is done only for the first data set
-                    if not self._mqtt_configured:
-                        with self._mqtt_publisher.schedule_publish() as queue:
-                            for topic, payload in self._mqtt_builder.get_configs(plant_data=plant_data):
-                                queue.add(topic=topic, payload=payload, retain=True)
-                                logger.debug(
-                                    "Scheduled config publish into mqtt://%s:%s/%s",
-                                    self._mqtt_publisher.broker,
-                                    self._mqtt_publisher.broker_port,
-                                    topic,
-                                )
-                        self._mqtt_configured = True
-                    # Publish data
-                    with self._mqtt_publisher.schedule_publish() as queue:
-                        for topic, payload in self._mqtt_builder.get_states(plant_data=plant_data):
-                            queue.add(topic=topic, payload=payload)
-                            publish_count += 1
-                            logger.debug(
-                                "Scheduled data publish into mqtt://%s:%s/%s",
-                                self._mqtt_publisher.broker,
-                                self._mqtt_publisher.broker_port,
-                                topic,
-                            )
-                except Exception:
-                    logger.exception("Failed to publish data from DTU. Unknown failure type.")
-                else:
-                    logger.info(
-                        "DTU data received and published %s messages into mqtt://%s:%d",
-                        publish_count,
-                        self._mqtt_publisher.broker,
-                        self._mqtt_publisher.broker_port,
-                    )
+                self._process(plant_data, time.time())
             else:
                 logger.warning("No DTU data received!")
         finally:
             self._lock.release()
 
 
-def run_periodic_job(period: int, job: Callable) -> None:
-    """Run given function periodically.
+class PeriodicScheduler:
+    """Fixed-rate scheduler of a periodic job.
+
+    Ticks are computed from the monotonic clock, so execution time of the job does not shift the schedule.
+    Optionally, ticks are aligned to wall-clock boundaries of the period (for example to full minutes when
+    the period is 60 seconds). The job is always executed in the thread calling `run`.
+
+    When the job does not finish before the next tick, the overrun policy decides what happens with missed ticks:
+
+    - `skip` - missed ticks are dropped, the job is executed at the next tick in the future
+    - `coalesce` - the job is executed once immediately, then the schedule continues
+    - `catch-up` - the job is executed immediately for each missed tick
+
+    The period can be variable (see `hoymiles_mqtt.adaptive.AdaptivePeriod`), it is checked after each execution
+    of the job. When it changes, the schedule starts again from the next (aligned) tick of the new period.
+
+    """
+
+    def __init__(
+        self,
+        period: Union[float, Callable[[], float]],
+        job: Callable,
+        overrun_policy: str = OVERRUN_SKIP,
+        align: bool = True,
+        stats_cycles: int = DEFAULT_STATS_CYCLES,
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            period: execution period in seconds, or a function returning the current period
+            job: function to execute
+            overrun_policy: one of `OVERRUN_POLICIES`
+            align: if to align ticks to wall-clock boundaries of the period
+            stats_cycles: number of executions after which lateness statistics are logged, 0 disables statistics
+
+        """
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise ValueError(f'Unknown overrun policy {overrun_policy}')
+        self._get_period: Callable[[], float] = period if callable(period) else lambda: period
+        self._period = self._get_period()
+        self._job = job
+        self._overrun_policy = overrun_policy
+        self._align = align
+        self._stats_cycles = stats_cycles
+        self._lateness: List[float] = []
+        self._missed_ticks = 0
+        self._replayed_ticks = 0
+        self._replay_until = float('-inf')
+
+    def _first_tick(self) -> float:
+        now = time.monotonic()
+        if self._align:
+            return now + (-time.time()) % self._period
+        return now
+
+    def _next_tick(self, tick: float) -> float:
+        period = self._get_period()
+        if period != self._period:
+            logger.info('Query period changed from %ss to %ss.', self._period, period)
+            self._period = period
+            self._replay_until = float('-inf')
+            return self._first_tick() if self._align else max(tick + period, time.monotonic())
+        next_tick = tick + self._period
+        if next_tick <= self._replay_until:
+            # catch-up of an overrun which was already reported
+            return next_tick
+        now = time.monotonic()
+        if next_tick > now:
+            return next_tick
+        missed = int((now - next_tick) // self._period)
+        logger.warning(
+            'Job execution took longer than the period, %s tick(s) already passed. Perhaps query period is too small.',
+            missed + 1,
+        )
+        if self._overrun_policy == OVERRUN_SKIP:
+            self._missed_ticks += missed + 1
+            return next_tick + (missed + 1) * self._period
+        if self._overrun_policy == OVERRUN_COALESCE:
+            self._missed_ticks += missed
+            return next_tick + missed * self._period
+        self._replayed_ticks += missed + 1
+        self._replay_until = next_tick + missed * self._period
+        return next_tick
+
+    def _record_lateness(self, lateness: float) -> None:
+        if not self._stats_cycles:
+            return
+        self._lateness.append(lateness)
+        if len(self._lateness) >= self._stats_cycles:
+            logger.info(
+                'Scheduler statistics for last %s executions: lateness min %.3fs, mean %.3fs, max %.3fs, '
+                'jitter %.3fs, missed ticks %s, replayed ticks %s',
+                len(self._lateness),
+                min(self._lateness),
+                statistics.fmean(self._lateness),
+                max(self._lateness),
+                statistics.pstdev(self._lateness),
+                self._missed_ticks,
+                self._replayed_ticks,
+            )
+            self._lateness = []
+            self._missed_ticks = 0
+            self._replayed_ticks = 0
+
+    def _execute_job(self) -> None:
+        try:
+            self._job()
+        except Exception:
+            logger.exception('Unhandled exception during data acquire and send')
+
+    def run(self, stop_event: threading.Event) -> None:
+        """Execute the job periodically until the stop event is set.
+
+        Arguments:
+            stop_event: event which stops the scheduler
+
+        """
+        tick = self._first_tick()
+        while not stop_event.wait(timeout=max(0.0, tick - time.monotonic())):
+            self._record_lateness(time.monotonic() - tick)
+            self._execute_job()
+            tick = self._next_tick(tick)
+
+
+def start_periodic_jobs(
+    period: int,
+    jobs: Dict[str, Callable],
+    stop_event: threading.Event,
+    overrun_policy: str = OVERRUN_SKIP,
+    align: bool = True,
+    stats_cycles: int = DEFAULT_STATS_CYCLES,
+    periods: Optional[Dict[str, Callable[[], float]]] = None,
+) -> List[threading.Thread]:
+    """Start periodic execution of given functions, each one in its own worker thread.
+
+    Functions are executed independently, so a slow function does not delay the others.
 
     Arguments:
         period: execution period
-        job: function to execute
+        jobs: functions to execute, by names of worker threads
+        stop_event: event which stops the execution
+        overrun_policy: what to do when a job does not finish before the next tick, see `PeriodicScheduler`
+        align: if to align executions to wall-clock boundaries of the period
+        stats_cycles: number of executions after which scheduler statistics are logged
+        periods: variable periods (functions returning the current period) of particular jobs, by names,
+                 the other jobs are executed with `period`
+
+    Returns:
+        started worker threads
+
+    """
+    threads = []
+    periods = periods or {}
+    for name, job in jobs.items():
+        scheduler = PeriodicScheduler(
+            period=periods.get(name, period),
+            job=job,
+            overrun_policy=overrun_policy,
+            align=align,
+            stats_cycles=stats_cycles,
+        )
+        thread = threading.Thread(target=scheduler.run, args=(stop_event,), name=name)
+        logger.debug('Start acquire and send thread %s', name)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def run_periodic_jobs(
+    period: int,
+    jobs: Dict[str, Callable],
+    overrun_policy: str = OVERRUN_SKIP,
+    align: bool = True,
+    stats_cycles: int = DEFAULT_STATS_CYCLES,
+    periods: Optional[Dict[str, Callable[[], float]]] = None,
+) -> None:
+    """Run given functions periodically, until termination signal is received.
+
+    Each function is executed by its own worker thread with `PeriodicScheduler`.
+
+    Arguments:
+        period: execution period
+        jobs: functions to execute, by names of worker threads
+        overrun_policy: what to do when a job does not finish before the next tick, see `PeriodicScheduler`
+        align: if to align executions to wall-clock boundaries of the period
+        stats_cycles: number of executions after which scheduler statistics are logged
+        periods: variable periods of particular jobs, see `start_periodic_jobs`
 
     """
     stop_event = threading.Event()
@@ -131,16 +476,50 @@ def run_periodic_job(period: int, job: Callable) -> None:
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
 
-    while True:
-        thread = threading.Thread(target=job)
-        logger.debug('Start acquire and send thread')
-        thread.start()
+    threads = start_periodic_jobs(
+        period=period,
+        jobs=jobs,
+        stop_event=stop_event,
+        overrun_policy=overrun_policy,
+        align=align,
+        stats_cycles=stats_cycles,
+        periods=periods,
+    )
 
-        # wait the given time unless termination signal received
-        # if not continue looping, otherwise stop
-        if stop_event.wait(timeout=period):
-            logger.debug("Wait for the end of acquire and send thread")
-            thread.join()
-            break
+    # wait until termination signal received
+    while not stop_event.wait(timeout=1):
+        pass
+    logger.debug("Wait for the end of acquire and send threads")
+    for thread in threads:
+        thread.join()
 
     logger.info("Done looping messages")
+
+
+def run_periodic_job(
+    period: int,
+    job: Callable,
+    overrun_policy: str = OVERRUN_SKIP,
+    align: bool = True,
+    stats_cycles: int = DEFAULT_STATS_CYCLES,
+) -> None:
+    """Run given function periodically.
+
+    The function is executed by a single worker thread with `PeriodicScheduler`,
+    until termination signal is received.
+
+    Arguments:
+        period: execution period
+        job: function to execute
+        overrun_policy: what to do when the job does not finish before the next tick, see `PeriodicScheduler`
+        align: if to align executions to wall-clock boundaries of the period
+        stats_cycles: number of executions after which scheduler statistics are logged
+
+    """
+    run_periodic_jobs(
+        period=period,
+        jobs={'acquire_send': job},
+        overrun_policy=overrun_policy,
+        align=align,
+        stats_cycles=stats_cycles,
+    )
@@ -0,0 +1,290 @@
+"""Simulator of Hoymiles DTU (Modbus TCP).
+
+Emulates the register map of DTU read by `HoymilesModbusTCP` (DTU serial number and data of microinverter ports),
+with power following a diurnal curve. Latency of responses and dropped responses (DTU not responding, which
+results in "No response received" errors on the client side) can be injected, which is useful for load and
+latency testing without real hardware.
+
+Usage: python3 -m hoymiles_mqtt.simulator --port 5020 --inverters 4
+
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import random
+import struct
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+from hoymiles_mqtt import _main_logger
+
+logger = _main_logger.getChild('simulator')
+
+DEFAULT_DTU_SERIAL = '415012345678'
+DEFAULT_PEAK_POWER = 400.0
+DEFAULT_TOTAL_PRODUCTION = 1000000
+
+DTU_REGISTERS_START = 0x2000
+INVERTER_REGISTERS_START = 0x1000
+INVERTER_REGISTERS_STEP = 40
+INVERTER_REGISTERS_COUNT = 20
+
+SUNRISE_HOUR = 6.0
+SUNSET_HOUR = 18.0
+
+_READ_HOLDING_REGISTERS = 0x03
+_ILLEGAL_FUNCTION = 0x01
+_MBAP = struct.Struct('>HHHB')
+_INVERTER_RECORD = struct.Struct('>B6sBHHHHHHIhHHHB')
+
+
+class DtuSimulator:
+    """Simulated DTU with microinverters.
+
+    Each microinverter port produces power following a half-sine curve between `SUNRISE_HOUR` and
+    `SUNSET_HOUR` (local time). Today production is the integral of the curve, total production grows with it.
+
+    """
+
+    def __init__(
+        self,
+        inverters: int = 2,
+        ports: int = 4,
+        dtu_serial: str = DEFAULT_DTU_SERIAL,
+        peak_power: float = DEFAULT_PEAK_POWER,
+        latency: float = 0.0,
+        drop_rate: float = 0.0,
+        seed: Optional[int] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            inverters: number of microinverters
+            ports: number of ports of each microinverter
+            dtu_serial: serial number of DTU (12 hex digits)
+            peak_power: max power of each port [W]
+            latency: delay of each response in seconds
+            drop_rate: probability (0-1) that a request is not responded
+            seed: seed of random generator used for dropping responses and power noise
+            clock: source of current time (seconds since the epoch)
+
+        """
+        self.inverters = inverters
+        self.ports = ports
+        self.dtu_serial = dtu_serial
+        self.peak_power = peak_power
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self._clock = clock
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.requests = 0
+        self.dropped = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    @staticmethod
+    def inverter_serial(index: int) -> str:
+        """Serial number of microinverter with the given index."""
+        return f'1021628{index:05d}'
+
+    def _day_hour(self, now: float) -> float:
+        local = time.localtime(now)
+        return local.tm_hour + local.tm_min / 60 + local.tm_sec / 3600
+
+    def port_power(self, now: float) -> float:
+        """Power of a port at the given time [W]."""
+        hour = self._day_hour(now)
+        if not SUNRISE_HOUR < hour < SUNSET_HOUR:
+            return 0.0
+        return self.peak_power * math.sin(math.pi * (hour - SUNRISE_HOUR) / (SUNSET_HOUR - SUNRISE_HOUR))
+
+    def port_today_production(self, now: float) -> int:
+        """Production of a port since the beginning of the day [Wh]."""
+        hour = min(max(self._day_hour(now), SUNRISE_HOUR), SUNSET_HOUR)
+        daylight = SUNSET_HOUR - SUNRISE_HOUR
+        return int(self.peak_power * daylight / math.pi * (1 - math.cos(math.pi * (hour - SUNRISE_HOUR) / daylight)))
+
+    def _inverter_record(self, index: int, now: float) -> bytes:
+        inverter, port = divmod(index, self.ports)
+        power = self.port_power(now)
+        if power:
+            power = max(0.0, power * (1 + self._random.uniform(-0.02, 0.02)))
+        today_production = self.port_today_production(now)
+        pv_voltage = 30.0 if power else 0.0
+        record = _INVERTER_RECORD.pack(
+            0,
+            bytes.fromhex(self.inverter_serial(inverter)),
+            port + 1,
+            int(pv_voltage * 10),
+            int(power / pv_voltage * 10) if pv_voltage else 0,
+            2301,
+            5001,
+            int(power * 10),
+            today_production,
+            DEFAULT_TOTAL_PRODUCTION + today_production,
+            350 if power else 200,
+            3 if power else 0,
+            0,
+            0,
+            1,
+        )
+        return record.ljust(INVERTER_REGISTERS_STEP, b'\x00')
+
+    def read_registers(self, address: int, count: int) -> bytes:
+        """Content of holding registers.
+
+        Arguments:
+            address: address of the first register
+            count: number of registers
+
+        """
+        now = self._clock()
+        data = bytearray(2 * count)
+        if address == DTU_REGISTERS_START:
+            serial = bytes.fromhex(self.dtu_serial)[: 2 * count]
+            data[: len(serial)] = serial
+            return bytes(data)
+        offset = address - INVERTER_REGISTERS_START
+        index, register = divmod(offset, INVERTER_REGISTERS_STEP)
+        if offset >= 0 and register == 0 and index < self.inverters * self.ports:
+            record = self._inverter_record(index, now)[: 2 * min(count, INVERTER_REGISTERS_COUNT)]
+            data[: len(record)] = record
+        return bytes(data)
+
+    def _handle_pdu(self, pdu: bytes) -> bytes:
+        function_code = pdu[0]
+        if function_code != _READ_HOLDING_REGISTERS or len(pdu) < 5:
+            return bytes([function_code | 0x80, _ILLEGAL_FUNCTION])
+        address, count = struct.unpack('>HH', pdu[1:5])
+        data = self.read_registers(address, count)
+        return bytes([function_code, len(data)]) + data
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                header = await reader.readexactly(_MBAP.size)
+                transaction_id, protocol_id, length, unit_id = _MBAP.unpack(header)
+                pdu = await reader.readexactly(length - 1)
+                self.requests += 1
+                self.bytes_received += len(header) + len(pdu)
+                if self.drop_rate and self._random.random() < self.drop_rate:
+                    self.dropped += 1
+                    logger.debug('Dropped request %s', transaction_id)
+                    continue
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                response = self._handle_pdu(pdu)
+                frame = _MBAP.pack(transaction_id, protocol_id, len(response) + 1, unit_id) + response
+                self.bytes_sent += len(frame)
+                writer.write(frame)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> Tuple[str, int]:
+        """Start serving.
+
+        Arguments:
+            host: address to listen on
+            port: port to listen on, 0 means any free port
+
+        Returns:
+            address and port the simulator listens on
+
+        """
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        address = self._server.sockets[0].getsockname()
+        logger.info('DTU simulator listening on %s:%s', address[0], address[1])
+        return address[0], address[1]
+
+    async def stop(self) -> None:
+        """Stop serving."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+class SimulatorThread:
+    """Run `DtuSimulator` in a background thread with its own event loop (for synchronous code, like tests)."""
+
+    def __init__(self, simulator: DtuSimulator, host: str = '127.0.0.1', port: int = 0) -> None:
+        """Initialize the object.
+
+        Arguments:
+            simulator: the simulator
+            host: address to listen on
+            port: port to listen on, 0 means any free port
+
+        """
+        self.simulator = simulator
+        self.host = host
+        self.port = port
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='dtu_simulator', daemon=True)
+
+    def __enter__(self) -> 'SimulatorThread':
+        """Start the simulator."""
+        self._thread.start()
+        self.host, self.port = asyncio.run_coroutine_threadsafe(
+            self.simulator.start(self.host, self.port), self._loop
+        ).result()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Stop the simulator."""
+        asyncio.run_coroutine_threadsafe(self.simulator.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def main() -> None:
+    """Run the simulator until interrupted."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog='python3 -m hoymiles_mqtt.simulator',
+        description='Simulator of Hoymiles DTU (Modbus TCP)',
+    )
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=5020, help='Port to listen on')
+    parser.add_argument('--inverters', type=int, default=2, help='Number of microinverters')
+    parser.add_argument('--ports', type=int, default=4, help='Number of ports of each microinverter')
+    parser.add_argument('--dtu-serial', default=DEFAULT_DTU_SERIAL, help='Serial number of DTU')
+    parser.add_argument('--peak-power', type=float, default=DEFAULT_PEAK_POWER, help='Max power of each port [W]')
+    parser.add_argument('--latency', type=float, default=0.0, help='Delay of each response in seconds')
+    parser.add_argument(
+        '--drop-rate', type=float, default=0.0, help='Probability (0-1) that a request is not responded'
+    )
+    parser.add_argument('--seed', type=int, default=None, help='Seed of random generator')
+    options = parser.parse_args()
+    simulator = DtuSimulator(
+        inverters=options.inverters,
+        ports=options.ports,
+        dtu_serial=options.dtu_serial,
+        peak_power=options.peak_power,
+        latency=options.latency,
+        drop_rate=options.drop_rate,
+        seed=options.seed,
+    )
+
+    async def serve() -> None:
+        await simulator.start(options.host, options.port)
+        await asyncio.Event().wait()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)-5.5s]  [%(name)s] %(message)s', level=logging.INFO)
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Aggregated snapshot of plant data, published as a single message.
+
+Instead of one message per device (DTU, microinverter, port), the whole plant data is sent in one payload with
+columnar arrays - one array per entity, with values of all microinverters or ports. It reduces the number of
+messages (and broker fan-out) for large plants, for consumers like Telegraf or Node-RED.
+
+Payloads are encoded to JSON or MessagePack. MessagePack uses `msgpack` library when installed, otherwise
+a built-in packer of the types present in snapshots.
+
+"""
+
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+from hoymiles_mqtt import DEFAULT_SNAPSHOT_TOPIC, SNAPSHOT_FORMAT_JSON, SNAPSHOT_FORMATS
+from hoymiles_mqtt.encoding import Encoder, get_encoder
+
+
+def _pack_header(
+    pieces: List[bytes], length: int, fix_prefix: int, fix_limit: int, prefixes: Tuple[Optional[int], int, int]
+) -> None:
+    prefix8, prefix16, prefix32 = prefixes
+    if length < fix_limit:
+        pieces.append(bytes([fix_prefix | length]))
+    elif length < 0x100 and prefix8 is not None:
+        pieces.append(struct.pack('>BB', prefix8, length))
+    elif length < 0x10000:
+        pieces.append(struct.pack('>BH', prefix16, length))
+    else:
+        pieces.append(struct.pack('>BI', prefix32, length))
+
+
+def _pack_int(pieces: List[bytes], value: int) -> None:
+    if -0x20 <= value < 0x80:
+        pieces.append(struct.pack('b', value))
+    elif value >= 0:
+        for prefix, fmt, limit in ((0xCC, '>BB', 0x100), (0xCD, '>BH', 0x10000), (0xCE, '>BI', 0x100000000)):
+            if value < limit:
+                pieces.append(struct.pack(fmt, prefix, value))
+                return
+        pieces.append(struct.pack('>BQ', 0xCF, value))
+    else:
+        for prefix, fmt, limit in ((0xD0, '>Bb', -0x80), (0xD1, '>Bh', -0x8000), (0xD2, '>Bi', -0x80000000)):
+            if value >= limit:
+                pieces.append(struct.pack(fmt, prefix, value))
+                return
+        pieces.append(struct.pack('>Bq', 0xD3, value))
+
+
+def _pack(obj: Any, pieces: List[bytes]) -> None:
+    if obj is None:
+        pieces.append(b'\xc0')
+    elif obj is True:
+        pieces.append(b'\xc3')
+    elif obj is False:
+        pieces.append(b'\xc2')
+    elif isinstance(obj, int):
+        _pack_int(pieces, obj)
+    elif isinstance(obj, float):
+        pieces.append(struct.pack('>Bd', 0xCB, obj))
+    elif isinstance(obj, str):
+        data = obj.encode()
+        _pack_header(pieces, len(data), 0xA0, 32, (0xD9, 0xDA, 0xDB))
+        pieces.append(data)
+    elif isinstance(obj, (list, tuple)):
+        _pack_header(pieces, len(obj), 0x90, 16, (None, 0xDC, 0xDD))
+        for item in obj:
+            _pack(item, pieces)
+    elif isinstance(obj, dict):
+        _pack_header(pieces, len(obj), 0x80, 16, (None, 0xDE, 0xDF))
+        for key, value in obj.items():
+            _pack(key, pieces)
+            _pack(value, pieces)
+    else:
+        raise TypeError(f'Type {type(obj).__name__} is not supported by MessagePack packer')
+
+
+def packb(obj: Any) -> bytes:
+    """Encode an object (None, bool, int, float, str, list, tuple, dict) to MessagePack."""
+    pieces: List[bytes] = []
+    _pack(obj, pieces)
+    return b''.join(pieces)
+
+
+def _msgpack_encoder() -> Encoder:
+    try:
+        import msgpack
+    except ImportError:
+        return packb
+    packer: Encoder = msgpack.packb
+    return packer
+
+
+class SnapshotOutput:
+    """Topic and encoding of plant snapshots."""
+
+    def __init__(
+        self,
+        topic: str = DEFAULT_SNAPSHOT_TOPIC,
+        payload_format: str = SNAPSHOT_FORMAT_JSON,
+        encoder: Optional[Encoder] = None,
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            topic: topic of snapshots, `{dtu}` is replaced with DTU serial number
+            payload_format: one of `SNAPSHOT_FORMATS`
+            encoder: JSON encoder (see `hoymiles_mqtt.encoding`), the fastest installed one by default
+
+        """
+        if payload_format not in SNAPSHOT_FORMATS:
+            raise ValueError(f'Unknown snapshot format {payload_format}')
+        self._topic = topic
+        self._encode: Encoder = (
+            (encoder or get_encoder()) if payload_format == SNAPSHOT_FORMAT_JSON else _msgpack_encoder()
+        )
+
+    def get_topic(self, dtu_serial: str) -> str:
+        """Topic of snapshots of given DTU."""
+        return self._topic.format(dtu=dtu_serial)
+
+    def encode(self, snapshot: Dict[str, Any]) -> bytes:
+        """Encode a snapshot."""
+        return self._encode(snapshot)
@@ -0,0 +1,16 @@
+"""Common fixtures."""
+
+import pytest
+
+from hoymiles_mqtt.simulator import DtuSimulator, SimulatorThread
+
+
+@pytest.fixture
+def dtu_simulator():
+    """Simulated DTU listening on a free local port, running in a background thread.
+
+    The simulator (`DtuSimulator`) can be reconfigured by tests, for example to inject latency or dropped responses.
+
+    """
+    with SimulatorThread(DtuSimulator(inverters=2, ports=2, seed=0)) as simulator_thread:
+        yield simulator_thread
@@ -0,0 +1,69 @@
+"""Tests for adaptive query period."""
+
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from hoymiles_modbus.datatypes import PlantData
+
+from hoymiles_mqtt.adaptive import IDLE_CYCLES, AdaptivePeriod, sun_times
+
+WARSAW = (52.23, 21.01)
+# 2024-06-21 12:00 UTC
+SUMMER_NOON = 1718971200.0
+
+
+def _plant_data(power: float) -> PlantData:
+    inverter = SimpleNamespace(operating_status=3 if power else 0, pv_power=power)
+    return PlantData('dtu_serial', inverters=[inverter])
+
+
+class FakeClock:
+    """Wall clock advanced manually."""
+
+    def __init__(self, now: float) -> None:
+        """Initialize the clock."""
+        self.now = now
+
+    def __call__(self) -> float:
+        """Current time."""
+        return self.now
+
+
+def test_sun_times():
+    """Verify sunrise and sunset in Warsaw at summer solstice."""
+    sunrise, sunset = sun_times(SUMMER_NOON, *WARSAW)
+    assert sunrise == pytest.approx(datetime(2024, 6, 21, 2, 14, tzinfo=timezone.utc).timestamp(), abs=300)
+    assert sunset == pytest.approx(datetime(2024, 6, 21, 19, 1, tzinfo=timezone.utc).timestamp(), abs=300)
+
+
+def test_night_and_dawn_periods():
+    """Verify that night period is used after idle cycles and dawn period after inverters woke up."""
+    clock = FakeClock(SUMMER_NOON)
+    period = AdaptivePeriod(day_period=60, night_period=600, dawn_period=30, dawn_duration=3600, clock=clock)
+    assert period() == 60
+    for _ in range(IDLE_CYCLES - 1):
+        period.update(_plant_data(0))
+    assert period() == 60
+    period.update(_plant_data(0))
+    assert period.is_night
+    assert period() == 600
+
+    period.update(_plant_data(10.5))
+    assert not period.is_night
+    assert period() == 30
+    clock.now += 3600
+    assert period() == 60
+
+
+def test_night_period_only_when_sun_is_down():
+    """Verify that with a known location idle inverters at day do not switch to night period."""
+    clock = FakeClock(SUMMER_NOON)
+    period = AdaptivePeriod(day_period=60, night_period=600, dawn_period=30, location=WARSAW, clock=clock)
+    for _ in range(IDLE_CYCLES):
+        period.update(_plant_data(0))
+    assert period() == 60
+    clock.now = SUMMER_NOON - 11 * 3600  # 01:00 UTC
+    assert period() == 600
+    clock.now = SUMMER_NOON - 10 * 3600  # 02:00 UTC, around sunrise
+    assert period() == 30
@@ -0,0 +1,108 @@
+"""Tests for the asyncio runtime."""
+
+import asyncio
+import struct
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+from hoymiles_modbus.datatypes import PlantData
+
+from hoymiles_mqtt.aio import AsyncHoymilesModbusTCP, run_async
+
+
+def _inverter_registers(serial: str, port: int, pv_power: int = 405, link_status: int = 1) -> bytes:
+    """Raw inverter registers (as returned by DTU), preceded by data size byte."""
+    data = (
+        bytes([0])
+        + bytes.fromhex(serial)
+        + bytes([port])
+        + struct.pack('>HHHHHHIhHHHB', 300, 234, 2301, 5001, pv_power, 431, 8844, 204, 3, 0, 2, link_status)
+    )
+    data += bytes(40 - len(data))
+    return bytes([len(data)]) + data
+
+
+def _response(data: bytes) -> MagicMock:
+    response = MagicMock()
+    response.isError.return_value = False
+    response.encode.return_value = data
+    return response
+
+
+@patch('hoymiles_mqtt.aio.AsyncModbusTcpClient')
+def test_get_plant_data(client_mock):
+    """Verify reading plant data with asyncio Modbus client."""
+    registers = {
+        0x2000: bytes([6]) + bytes.fromhex('415012345678'),
+        0x1000: _inverter_registers('102162804827', 1),
+        0x1000 + 40: _inverter_registers('102162804827', 2, pv_power=100),
+        0x1000 + 80: _inverter_registers('000000000000', 0),
+    }
+
+    async def read_holding_registers(address, count, device_id):
+        return _response(registers[address])
+
+    client = client_mock.return_value
+    client.connect.side_effect = lambda: asyncio.sleep(0, True)
+    client.read_holding_registers.side_effect = read_holding_registers
+
+    plant_data = asyncio.run(AsyncHoymilesModbusTCP('some_host').get_plant_data())
+    assert plant_data.dtu == '415012345678'
+    assert [(inverter.serial_number, inverter.port_number) for inverter in plant_data.inverters] == [
+        ('102162804827', 1),
+        ('102162804827', 2),
+    ]
+    assert float(plant_data.pv_power) == pytest.approx(50.5)
+    assert plant_data.today_production == 862
+    client.close.assert_called_once()
+
+
+@patch('hoymiles_mqtt.aio.AsyncModbusTcpClient')
+def test_get_plant_data_not_connected(client_mock):
+    """Verify that connection failure is reported."""
+    client_mock.return_value.connect.side_effect = lambda: asyncio.sleep(0, False)
+    with pytest.raises(ConnectionError):
+        asyncio.run(AsyncHoymilesModbusTCP('some_host').get_plant_data())
+
+
+def test_slow_publishing_does_not_delay_reads():
+    """Verify that DTUs are read periodically even when publishing is slow."""
+    reads = {'dtu_1': 0, 'dtu_2': 0}
+    published = []
+
+    def make_client(name):
+        async def get_plant_data():
+            reads[name] += 1
+            if name == 'dtu_2' and reads[name] == 1:
+                raise RuntimeError('DTU failure')
+            return PlantData(name)
+
+        client = MagicMock()
+        client.get_plant_data.side_effect = get_plant_data
+        return client
+
+    def slow_publish(plant_data, acquired_at):
+        published.append((plant_data.dtu, threading.get_ident()))
+        time.sleep(0.2)
+
+    query_job = MagicMock(adaptive_period=None)
+    query_job.publish.side_effect = slow_publish
+
+    async def run():
+        stop_event = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.5, stop_event.set)
+        await run_async(
+            period=0.05,
+            dtus={name: (make_client(name), query_job) for name in reads},
+            queue_size=2,
+            stop_event=stop_event,
+        )
+
+    asyncio.run(run())
+    assert reads['dtu_1'] >= 8
+    assert reads['dtu_2'] >= 8
+    # publishing is done outside of the event loop thread and only the newest data is kept
+    assert 1 < len(published) < reads['dtu_1']
+    assert threading.get_ident() not in {thread for _, thread in published}
@@ -0,0 +1,157 @@
+"""Tests for blocks module."""
+
+import asyncio
+import json
+from unittest.mock import MagicMock
+
+import pytest
+from hoymiles_modbus.client import HoymilesModbusTCP
+from hoymiles_modbus.datatypes import InverterData
+from pymodbus.exceptions import ModbusIOException
+
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES
+from hoymiles_mqtt.aio import AsyncHoymilesModbusTCP
+from hoymiles_mqtt.blocks import BlockLayout, BlockModbusTCP, PartialPlantData, block_address, read_blocks
+from hoymiles_mqtt.ha import HassMqtt
+from hoymiles_mqtt.runners import HoymilesQueryJob
+
+
+def _port(index: int) -> InverterData:
+    return InverterData(
+        data_type=0,
+        serial_number=f'1021628{index // 2:05d}',
+        port_number=index % 2 + 1,
+        pv_voltage=30,
+        pv_current=1,
+        grid_voltage=230,
+        grid_frequency=50,
+        pv_power=30,
+        today_production=100,
+        total_production=1000,
+        temperature=30,
+        operating_status=3,
+        alarm_code=0,
+        alarm_count=0,
+        link_status=1,
+        reserved=[],
+    )
+
+
+class _FakeDtu:
+    """Reads of blocks of a DTU with the given number of ports, failing for the given blocks."""
+
+    def __init__(self, ports: int, failures: dict) -> None:
+        self.ports = ports
+        self.failures = failures
+        self.reads: list = []
+
+    def read_block(self, index: int):
+        self.reads.append(index)
+        if self.failures.get(index):
+            self.failures[index] -= 1
+            raise ModbusIOException('No response received')
+        return _port(index) if index < self.ports else None
+
+
+def test_read_all_blocks():
+    """Verify that blocks are read until the end of data."""
+    layout = BlockLayout()
+    dtu = _FakeDtu(ports=3, failures={})
+    inverters, missing_ports = read_blocks(layout, dtu.read_block)
+    assert [(inverter.serial_number, inverter.port_number) for inverter in inverters] == [
+        ('102162800000', 1),
+        ('102162800000', 2),
+        ('102162800001', 1),
+    ]
+    assert missing_ports == []
+    assert dtu.reads == [0, 1, 2, 3]
+    assert layout.count == 3
+
+
+def test_retry_failed_blocks_only():
+    """Verify that only failed blocks are retried, the reading continues after a failed block of known layout."""
+    layout = BlockLayout(retries=2)
+    read_blocks(layout, _FakeDtu(ports=3, failures={}).read_block)
+    dtu = _FakeDtu(ports=3, failures={1: 2})
+    inverters, missing_ports = read_blocks(layout, dtu.read_block)
+    assert len(inverters) == 3
+    assert missing_ports == []
+    assert dtu.reads == [0, 1, 2, 3, 1, 1]
+
+
+def test_partial_result():
+    """Verify that data of blocks which were read is returned together with ports which could not be read."""
+    layout = BlockLayout(retries=1)
+    read_blocks(layout, _FakeDtu(ports=3, failures={}).read_block)
+    inverters, missing_ports = read_blocks(layout, _FakeDtu(ports=3, failures={1: 2}).read_block)
+    assert [(inverter.serial_number, inverter.port_number) for inverter in inverters] == [
+        ('102162800000', 1),
+        ('102162800001', 1),
+    ]
+    assert missing_ports == [('102162800000', 2)]
+
+
+def test_unknown_layout():
+    """Verify that the reading stops at a failed block of unknown layout and continues when the retry succeeds."""
+    dtu = _FakeDtu(ports=3, failures={1: 1})
+    inverters, missing_ports = read_blocks(BlockLayout(retries=1), dtu.read_block)
+    assert len(inverters) == 3
+    assert dtu.reads == [0, 1, 1, 2, 3]
+
+    dtu = _FakeDtu(ports=3, failures={1: 1})
+    inverters, missing_ports = read_blocks(BlockLayout(retries=0), dtu.read_block)
+    assert len(inverters) == 1
+    # serial number of the block was never read
+    assert missing_ports == []
+    assert dtu.reads == [0, 1]
+
+
+def test_all_blocks_failed():
+    """Verify that the failure is raised when no block could be read."""
+    dtu = _FakeDtu(ports=3, failures={0: 3})
+    with pytest.raises(ModbusIOException):
+        read_blocks(BlockLayout(retries=2), dtu.read_block)
+
+
+def _block_client(dtu_simulator, failing_blocks: set) -> BlockModbusTCP:
+    modbus_client = BlockModbusTCP(host=dtu_simulator.host, port=dtu_simulator.port, retries=1)
+    read_registers = modbus_client._read_registers
+
+    def _read_registers(client, start_address, count, unit_id):
+        if start_address in {block_address(index) for index in failing_blocks}:
+            raise ModbusIOException('No response received')
+        return read_registers(client, start_address, count, unit_id)
+
+    modbus_client._read_registers = _read_registers  # type: ignore[method-assign]
+    return modbus_client
+
+
+def test_read_plant_data(dtu_simulator):
+    """Verify that block reads return the same data as the monolithic read."""
+    dtu_simulator.simulator.peak_power = 0
+    plant_data = BlockModbusTCP(dtu_simulator.host, dtu_simulator.port).plant_data
+    assert plant_data == HoymilesModbusTCP(dtu_simulator.host, dtu_simulator.port).plant_data
+    async_client = AsyncHoymilesModbusTCP(dtu_simulator.host, dtu_simulator.port, block_layout=BlockLayout())
+    assert asyncio.run(async_client.get_plant_data()) == plant_data
+
+
+def test_query_job_publishes_partial_data(dtu_simulator):
+    """Verify that data of the ports which were read is published and the missing port becomes unavailable."""
+    failing_blocks: set = set()
+    modbus_client = _block_client(dtu_simulator, failing_blocks)
+    # layout is learnt from the first read
+    modbus_client.plant_data
+    failing_blocks.add(1)
+    plant_data = modbus_client.plant_data
+    assert isinstance(plant_data, PartialPlantData)
+    assert plant_data.missing_ports == [('102162800000', 2)]
+    assert len(plant_data.inverters) == 3
+
+    publisher = MagicMock()
+    queue = publisher.schedule_publish.return_value.__enter__.return_value
+    mqtt_builder = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES)
+    HoymilesQueryJob(mqtt_builder, publisher, modbus_client).execute()
+    payloads = {call.kwargs['topic']: call.kwargs['payload'] for call in queue.add.call_args_list}
+    assert json.loads(payloads['homeassistant/hoymiles_mqtt/102162800000/2/state']) == {}
+    assert json.loads(payloads['homeassistant/hoymiles_mqtt/102162800000/1/state'])
+    assert json.loads(payloads['homeassistant/hoymiles_mqtt/102162800001/2/state'])
@@ -0,0 +1,110 @@
+"""Tests for the offline buffer."""
+
+from unittest.mock import MagicMock, Mock, patch
+
+import pytest
+
+from hoymiles_mqtt.buffer import BufferDrainer, OfflineBuffer
+from hoymiles_mqtt.mqtt import MqttPublisher
+from hoymiles_mqtt.runners import HoymilesQueryJob
+
+
+@pytest.fixture
+def offline_buffer(tmp_path):
+    """Creates an offline buffer in a temporary directory."""
+    buffer = OfflineBuffer(str(tmp_path / 'buffer.db'), max_messages=5)
+    yield buffer
+    buffer.close()
+
+
+def test_add_peek_remove(offline_buffer):
+    """Verify that messages are stored and returned in the original order."""
+    offline_buffer.add([('topic/1', 'payload 1'), ('topic/2', b'payload 2')], acquired_at=100.0)
+    offline_buffer.add([('topic/3', 'payload 3')], acquired_at=160.0, retain=True)
+    assert len(offline_buffer) == 3
+
+    messages = offline_buffer.peek(2)
+    assert [(message.topic, message.payload, message.acquired_at) for message in messages] == [
+        ('topic/1', b'payload 1', 100.0),
+        ('topic/2', b'payload 2', 100.0),
+    ]
+    offline_buffer.remove(messages[-1].id)
+    assert len(offline_buffer) == 1
+    (message,) = offline_buffer.peek(2)
+    assert (message.topic, message.acquired_at, message.retain) == ('topic/3', 160.0, True)
+
+
+def test_oldest_messages_evicted(offline_buffer):
+    """Verify that the oldest messages are evicted when the buffer is full."""
+    for i in range(4):
+        offline_buffer.add([(f'topic/{i}/a', 'a'), (f'topic/{i}/b', 'b')], acquired_at=i)
+    assert len(offline_buffer) == 5
+    assert [message.topic for message in offline_buffer.peek(10)] == [
+        'topic/1/b',
+        'topic/2/a',
+        'topic/2/b',
+        'topic/3/a',
+        'topic/3/b',
+    ]
+
+
+def test_messages_kept_across_restarts(tmp_path):
+    """Verify that stored messages survive closing the buffer."""
+    path = str(tmp_path / 'buffer.db')
+    buffer = OfflineBuffer(path)
+    buffer.add([('topic/1', 'payload 1')], acquired_at=100.0)
+    buffer.close()
+
+    buffer = OfflineBuffer(path)
+    assert len(buffer) == 1
+    assert buffer.peek(1)[0].payload == b'payload 1'
+    buffer.close()
+
+
+def test_drain_batch(offline_buffer):
+    """Verify that messages are published in batches and removed from the buffer only when published."""
+    publisher = MagicMock()
+    queue = publisher.schedule_publish.return_value.__enter__.return_value
+    offline_buffer.add([('topic/1', 'payload 1'), ('topic/2', 'payload 2'), ('topic/3', 'payload 3')], 100.0)
+    drainer = BufferDrainer(offline_buffer, publisher, batch_size=2)
+
+    publisher.schedule_publish.return_value.__exit__.side_effect = ConnectionError
+    with pytest.raises(ConnectionError):
+        drainer.drain_batch()
+    assert len(offline_buffer) == 3
+
+    publisher.schedule_publish.return_value.__exit__.side_effect = None
+    publisher.schedule_publish.return_value.__exit__.return_value = None
+    assert drainer.drain_batch() == 2
+    assert drainer.drain_batch() == 1
+    assert drainer.drain_batch() == 0
+    assert len(offline_buffer) == 0
+    assert [call.kwargs['topic'] for call in queue.add.call_args_list] == [
+        'topic/1',
+        'topic/2',
+        'topic/1',
+        'topic/2',
+        'topic/3',
+    ]
+
+
+@patch('hoymiles_mqtt.mqtt.PUBLISH_TIMEOUT_SEC', 0)
+@patch('hoymiles_mqtt.mqtt.mqtt_client.Client')
+def test_drain_with_publisher_qos(client_mock, offline_buffer):
+    """Verify that states which could not be published are buffered and drained with QoS of the publisher."""
+    publisher = MqttPublisher(mqtt_broker='some broker', mqtt_port=1234, qos=1)
+    publisher._connected.set()
+    client = client_mock.return_value
+    mqtt_builder = MagicMock()
+    mqtt_builder.get_states.return_value = [('topic/state', b'payload')]
+    mqtt_builder.get_configs.return_value = []
+    job = HoymilesQueryJob(mqtt_builder, publisher, offline_buffer=offline_buffer)
+
+    client.publish.return_value = Mock(mid=1, is_published=Mock(return_value=False))
+    job.publish(MagicMock(), acquired_at=100.0)
+    assert [message.qos for message in offline_buffer.peek(10)] == [1]
+
+    client.publish.return_value = Mock(mid=2, is_published=Mock(return_value=True))
+    assert BufferDrainer(offline_buffer, publisher).drain_batch() == 1
+    assert client.publish.call_args.args == ('topic/state', b'payload', 1, False)
+    assert (publisher.delivery_stats.published, publisher.delivery_stats.acked) == (2, 1)
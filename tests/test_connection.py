@@ -0,0 +1,132 @@
+"""Tests for connection module."""
+
+import socket
+
+import pytest
+from pymodbus.exceptions import ModbusIOException
+
+from hoymiles_mqtt.connection import DtuUnavailableError, ManagedModbusTCP, ReconnectPolicy, is_socket_usable
+from hoymiles_mqtt.metrics import MetricsRegistry
+
+
+class _Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_backoff():
+    """Verify that querying is paused with exponential backoff (with jitter) after failures."""
+    clock = _Clock()
+    policy = ReconnectPolicy('dtu', backoff_base=2, backoff_max=10, failure_threshold=0, clock=clock, jitter=lambda: 1)
+    policy.check()
+    pauses = []
+    for _ in range(5):
+        policy.failure()
+        with pytest.raises(DtuUnavailableError):
+            policy.check()
+        start = clock.now
+        while True:
+            clock.now += 0.5
+            try:
+                policy.check()
+            except DtuUnavailableError:
+                continue
+            break
+        pauses.append(clock.now - start)
+    assert pauses == [2, 4, 8, 10, 10]
+
+    policy = ReconnectPolicy('dtu', backoff_base=2, clock=clock, jitter=lambda: 0)
+    policy.failure()
+    clock.now += 1
+    policy.check()
+
+
+def test_circuit_breaker(caplog):
+    """Verify that DTU is not queried for the open period after consecutive failures."""
+    clock = _Clock()
+    registry = MetricsRegistry()
+    metrics = registry.for_dtu('dtu')
+    policy = ReconnectPolicy(
+        'dtu', backoff_base=1, failure_threshold=3, open_period=60, metrics=metrics, clock=clock, jitter=lambda: 0
+    )
+    for _ in range(3):
+        clock.now += 10
+        policy.check()
+        policy.failure()
+    assert policy.circuit_open
+    assert metrics.circuit_open.value == 1
+    assert 'DTU dtu failed 3 times in a row, pausing queries for 60s.' in caplog.messages
+    clock.now += 59
+    with pytest.raises(DtuUnavailableError, match='circuit open'):
+        policy.check()
+    clock.now += 1
+    # half-open - a single attempt, the circuit opens again after failure
+    policy.check()
+    policy.failure()
+    with pytest.raises(DtuUnavailableError):
+        policy.check()
+    clock.now += 60
+    policy.check()
+    policy.success()
+    assert not policy.circuit_open
+    assert policy.failures == 0
+    assert metrics.circuit_open.value == 0
+
+
+def test_latency():
+    """Verify moving average of latency of requests over a connection."""
+    policy = ReconnectPolicy('dtu')
+    policy.connected(0.01)
+    assert policy.latency is None
+    policy.record_latency(0.1)
+    policy.record_latency(0.2)
+    assert policy.latency == pytest.approx(0.12)
+    policy.connected(0.01)
+    assert policy.latency is None
+
+
+def test_is_socket_usable():
+    """Verify that closed sockets and sockets with unexpected data are detected without any traffic."""
+    assert not is_socket_usable(None)
+    local, remote = socket.socketpair()
+    try:
+        assert is_socket_usable(local)
+        remote.sendall(b'late response')
+        assert not is_socket_usable(local)
+        local.recv(100)
+        assert is_socket_usable(local)
+        remote.close()
+        assert not is_socket_usable(local)
+    finally:
+        local.close()
+        remote.close()
+    assert not is_socket_usable(local)
+
+
+def test_persistent_connection(dtu_simulator):
+    """Verify that one connection is used across queries and a failure pauses querying."""
+    registry = MetricsRegistry()
+    metrics = registry.for_dtu('dtu')
+    policy = ReconnectPolicy('dtu', backoff_base=60, metrics=metrics)
+    modbus_client = ManagedModbusTCP(dtu_simulator.host, dtu_simulator.port, policy=policy)
+    modbus_client.comm_params.timeout = 0.2
+    modbus_client.comm_params.retries = 0
+    first = modbus_client.plant_data
+    second = modbus_client.plant_data
+    assert len(first.inverters) == len(second.inverters) == 4
+    assert metrics.connects.value == 1
+    # DTU serial number once, 4 ports and the terminating record twice
+    assert sum(metrics.request_time.counts) == 11
+    assert policy.latency is not None
+
+    dtu_simulator.simulator.drop_rate = 1
+    with pytest.raises(ModbusIOException):
+        modbus_client.plant_data
+    requests = dtu_simulator.simulator.requests
+    with pytest.raises(DtuUnavailableError):
+        modbus_client.plant_data
+    assert dtu_simulator.simulator.requests == requests
+    modbus_client.close()
@@ -0,0 +1,129 @@
+"""Tests for downsampling module."""
+
+import copy
+import json
+from unittest.mock import MagicMock
+
+import pytest
+from hoymiles_modbus.datatypes import InverterData, PlantData
+
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES
+from hoymiles_mqtt.blocks import PartialPlantData
+from hoymiles_mqtt.downsampling import Aggregate, AggregatedPlantData, WindowAggregator
+from hoymiles_mqtt.ha import HassMqtt
+from hoymiles_mqtt.runners import HoymilesQueryJob
+
+
+def _plant_data(pv_power: float, today_production: int = 100, missing_port: bool = False) -> PlantData:
+    port_data = InverterData(
+        data_type=0,
+        serial_number='102162804827',
+        port_number=1,
+        pv_voltage=30,
+        pv_current=1,
+        grid_voltage=230,
+        grid_frequency=50,
+        pv_power=pv_power,
+        today_production=today_production,
+        total_production=1000,
+        temperature=30,
+        operating_status=3,
+        alarm_code=0,
+        alarm_count=0,
+        link_status=1,
+        reserved=[],
+    )
+    inverters = [port_data]
+    if missing_port:
+        return PartialPlantData(
+            '415012345678', pv_power=pv_power, inverters=inverters, missing_ports=[('102162804827', 2)]
+        )
+    inverters.append(copy.copy(port_data))
+    inverters[-1].port_number = 2
+    return PlantData('415012345678', pv_power=pv_power * 2, inverters=inverters)
+
+
+def test_aggregate():
+    """Verify running statistics."""
+    aggregate = Aggregate(2)
+    for value in (5, 1, 4):
+        aggregate.add(value)
+    assert (aggregate.minimum, aggregate.maximum, aggregate.mean, aggregate.first, aggregate.last) == (1, 5, 3, 2, 4)
+
+
+def test_window():
+    """Verify that data sets are aggregated per window aligned to wall-clock boundaries."""
+    aggregator = WindowAggregator(window=60)
+    assert aggregator.add(_plant_data(10, today_production=100), timestamp=1210) is None
+    assert aggregator.add(_plant_data(20, today_production=110), timestamp=1230) is None
+    assert aggregator.add(_plant_data(60, today_production=120), timestamp=1250) is None
+    result = aggregator.add(_plant_data(40, today_production=130), timestamp=1260)
+    assert isinstance(result, AggregatedPlantData)
+    assert result.samples == 3
+    assert aggregator.samples == 1
+    assert result.pv_power == 60
+    assert [port.pv_power for port in result.inverters] == [30, 30]
+    assert [port.today_production for port in result.inverters] == [120, 120]
+    assert result.statistics[('102162804827', 1)]['pv_power'] == {'min': 10, 'max': 60, 'mean': 30, 'last': 60}
+    assert result.statistics[('102162804827', 1)]['today_production'] == {'delta': 20}
+    assert result.statistics[('102162804827', None)]['temperature']['mean'] == 30
+
+    # the increase since the previous window, also after reset of the counter
+    aggregator.add(_plant_data(40, today_production=5), timestamp=1300)
+    result = aggregator.add(_plant_data(40, today_production=10), timestamp=1500)
+    assert result is not None
+    assert result.statistics[('102162804827', 1)]['today_production'] == {'delta': 5}
+    assert result.statistics[('102162804827', 1)]['total_production'] == {'delta': 0}
+
+
+def test_missing_ports():
+    """Verify that only ports not read in the whole window are missing."""
+    aggregator = WindowAggregator(window=60)
+    aggregator.add(_plant_data(10, missing_port=True), timestamp=0)
+    result = aggregator.add(_plant_data(10, missing_port=True), timestamp=60)
+    assert result is not None
+    assert result.missing_ports == [('102162804827', 2)]
+    aggregator.add(_plant_data(10), timestamp=90)
+    result = aggregator.add(_plant_data(10), timestamp=120)
+    assert result is not None
+    assert result.missing_ports == []
+    assert len(result.inverters) == 2
+
+
+def test_counters_of_gone_devices_forgotten():
+    """Verify that counters are kept only for devices present in the last window."""
+    aggregator = WindowAggregator(window=60)
+    aggregator.add(_plant_data(10), timestamp=0)
+    aggregator.add(_plant_data(10, missing_port=True), timestamp=60)
+    assert {key[:2] for key in aggregator._counters} == {
+        ('415012345678', None),
+        ('102162804827', 1),
+        ('102162804827', 2),
+    }
+    aggregator.add(_plant_data(10, missing_port=True), timestamp=120)
+    assert {key[:2] for key in aggregator._counters} == {('415012345678', None), ('102162804827', 1)}
+
+
+def test_invalid_window():
+    """Verify that the window must be positive."""
+    with pytest.raises(ValueError):
+        WindowAggregator(window=0)
+
+
+def test_query_job_publishes_aggregates():
+    """Verify that states are published once per window, with statistics of entities."""
+    publisher = MagicMock()
+    queue = publisher.schedule_publish.return_value.__enter__.return_value
+    mqtt_builder = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES)
+    query_job = HoymilesQueryJob(mqtt_builder, publisher, downsampler=WindowAggregator(window=60))
+    query_job.publish(_plant_data(10), acquired_at=1200)
+    query_job.publish(_plant_data(30), acquired_at=1230)
+    assert not queue.add.called
+    query_job.publish(_plant_data(50), acquired_at=1260)
+    payloads = {call.kwargs['topic']: call.kwargs['payload'] for call in queue.add.call_args_list}
+    state = json.loads(payloads['homeassistant/hoymiles_mqtt/102162804827/1/state'])
+    assert state['pv_power'] == 20
+    assert (state['pv_power_min'], state['pv_power_max'], state['pv_power_last']) == (10, 30, 30)
+    assert state['today_production_delta'] == 0
+    assert 'operating_status_last' not in json.loads(payloads['homeassistant/hoymiles_mqtt/102162804827/state'])
+    assert json.loads(payloads['homeassistant/hoymiles_mqtt/415012345678/state'])['pv_power_mean'] == 40
@@ -0,0 +1,48 @@
+"""Tests for JSON encoders of MQTT payloads."""
+
+import json
+from unittest.mock import Mock, patch
+
+import pytest
+
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES, encoding
+from hoymiles_mqtt.encoding import ENCODER_STDLIB, available_encoders, get_encoder
+from hoymiles_mqtt.ha import HassMqtt
+from tests.test_hoymiles_mqtt import get_example_data
+
+
+@pytest.mark.parametrize('name', available_encoders())
+def test_encoders_output_parses_identically(name):
+    """Verify that payloads built with each encoder are bytes which parse to the same values as with stdlib."""
+    reference = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES, encoder=get_encoder(ENCODER_STDLIB))
+    builder = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES, encoder=get_encoder(name))
+    for method in ('get_configs', 'get_states'):
+        expected = list(getattr(reference, method)(get_example_data()))
+        messages = list(getattr(builder, method)(get_example_data()))
+        assert all(isinstance(payload, bytes) for _, payload in messages)
+        assert [(topic, json.loads(payload)) for topic, payload in messages] == [
+            (topic, json.loads(payload)) for topic, payload in expected
+        ]
+
+
+def test_stdlib_encoder():
+    """Verify that the standard library encoder produces compact UTF-8 JSON."""
+    payload = get_encoder(ENCODER_STDLIB)({'temperature': 20.4, 'unit': '°C'})
+    assert payload == '{"temperature":20.4,"unit":"°C"}'.encode()
+
+
+def test_unknown_encoder():
+    """Verify that unknown encoder is rejected."""
+    with pytest.raises(ValueError):
+        get_encoder('unknown')
+
+
+def test_auto_encoder_imports_only_selected():
+    """Verify that the first encoder which can be imported is selected, without importing the other ones."""
+    selected = Mock(side_effect=ImportError)
+    fallback = Mock()
+    other = Mock()
+    with patch.dict(encoding._FACTORIES, {'a': selected, 'b': fallback, 'c': other}, clear=True):
+        assert get_encoder() is fallback.return_value
+    selected.assert_called_once()
+    other.assert_not_called()
@@ -0,0 +1,134 @@
+"""Tests for history module."""
+
+import copy
+import json
+import urllib.error
+import urllib.request
+from unittest.mock import MagicMock
+
+import pytest
+from hoymiles_modbus.datatypes import InverterData, PlantData
+
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES
+from hoymiles_mqtt.ha import HassMqtt
+from hoymiles_mqtt.history import HistoryServer, PlantHistory
+from hoymiles_mqtt.runners import HoymilesQueryJob
+
+
+def _plant_data(pv_power: float, ports: int = 1) -> PlantData:
+    port_data = InverterData(
+        data_type=0,
+        serial_number='102162804827',
+        port_number=1,
+        pv_voltage=30.5,
+        pv_current=2.5,
+        grid_voltage=230.1,
+        grid_frequency=50,
+        pv_power=pv_power,
+        today_production=100,
+        total_production=1000,
+        temperature=30,
+        operating_status=3,
+        alarm_code=0,
+        alarm_count=0,
+        link_status=1,
+        reserved=[],
+    )
+    inverters = [port_data]
+    for port_number in range(2, ports + 1):
+        inverters.append(copy.copy(port_data))
+        inverters[-1].port_number = port_number
+    return PlantData('415012345678', pv_power=pv_power * ports, inverters=inverters)
+
+
+def test_ring_buffer():
+    """Verify that the oldest queries are overwritten and values are returned from the oldest to the latest."""
+    history = PlantHistory(capacity=3)
+    for index in range(5):
+        history.record(_plant_data(pv_power=index), timestamp=100 + index)
+    assert len(history) == 3
+    result = history.query('102162804827', 1, entities=['pv_power'])
+    assert result == {'timestamps': [102, 103, 104], 'values': {'pv_power': [2, 3, 4]}}
+    assert history.query('415012345678', entities=['pv_power', 'alarm_flag']) == {
+        'timestamps': [102, 103, 104],
+        'values': {'pv_power': [2, 3, 4], 'alarm_flag': [0, 0, 0]},
+    }
+    assert set(history.query('102162804827')['values']) == set(MI_ENTITIES)
+
+
+def test_time_range_and_missing_values():
+    """Verify time range queries and missing values of devices which were not present in some queries."""
+    history = PlantHistory(capacity=10)
+    history.record(_plant_data(pv_power=1), timestamp=100)
+    history.record(_plant_data(pv_power=2, ports=2), timestamp=160)
+    history.record(_plant_data(pv_power=3), timestamp=220)
+    assert history.query('102162804827', 2, entities=['pv_power']) == {
+        'timestamps': [100, 160, 220],
+        'values': {'pv_power': [None, 2, None]},
+    }
+    assert history.query('102162804827', 1, entities=['pv_power'], start=150, end=220) == {
+        'timestamps': [160, 220],
+        'values': {'pv_power': [2, 3]},
+    }
+    assert history.query('102162804827', 1, start=300)['timestamps'] == []
+    assert history.has_device('102162804827', 2)
+    assert not history.has_device('102162804828')
+
+
+def test_stale_series_dropped():
+    """Verify that series of devices no longer reported are dropped once all their values are overwritten."""
+    history = PlantHistory(capacity=2)
+    history.record(_plant_data(pv_power=1, ports=2), timestamp=100)
+    history.record(_plant_data(pv_power=2), timestamp=160)
+    assert history.has_device('102162804827', 2)
+    history.record(_plant_data(pv_power=3), timestamp=220)
+    assert not history.has_device('102162804827', 2)
+    assert [device['port_number'] for device in history.devices() if device['serial_number'] == '102162804827'] == [
+        None,
+        1,
+    ]
+
+
+def test_query_job_records_history():
+    """Verify that data sets are recorded by the query job."""
+    history = PlantHistory(capacity=10)
+    mqtt_builder = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES)
+    query_job = HoymilesQueryJob(mqtt_builder, MagicMock(), history=history)
+    query_job.publish(_plant_data(pv_power=5), acquired_at=1000)
+    assert history.query('102162804827', 1, entities=['pv_power']) == {
+        'timestamps': [1000],
+        'values': {'pv_power': [5]},
+    }
+
+
+def test_server():
+    """Verify that history is served over HTTP."""
+    history = PlantHistory(capacity=10)
+    history.record(_plant_data(pv_power=1), timestamp=100)
+    history.record(_plant_data(pv_power=2), timestamp=160)
+    server = HistoryServer({'dtu_1': history}, host='127.0.0.1', port=0)
+    server.start()
+    url = f'http://127.0.0.1:{server.port}/history'
+    try:
+        with urllib.request.urlopen(url) as response:
+            assert response.headers['Content-Type'] == 'application/json'
+            dtus = json.loads(response.read())['dtus']
+        assert dtus['dtu_1']['queries'] == 2
+        assert {'serial_number': '102162804827', 'port_number': 1, 'entities': PORT_ENTITIES} in dtus['dtu_1'][
+            'devices'
+        ]
+        with urllib.request.urlopen(f'{url}/102162804827/1?entity=pv_power&entity=pv_voltage&start=150') as response:
+            assert json.loads(response.read()) == {
+                'serial_number': '102162804827',
+                'port_number': 1,
+                'timestamps': [160],
+                'values': {'pv_voltage': [30.5], 'pv_power': [2]},
+            }
+        with pytest.raises(urllib.error.HTTPError, match='404'):
+            urllib.request.urlopen(f'{url}/102162804828')
+        with pytest.raises(urllib.error.HTTPError, match='400'):
+            urllib.request.urlopen(f'{url}/102162804827/x')
+        with pytest.raises(urllib.error.HTTPError, match='404'):
+            urllib.request.urlopen(f'http://127.0.0.1:{server.port}/other')
+    finally:
+        server.stop()
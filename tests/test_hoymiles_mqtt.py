@@ -1,13 +1,21 @@
 #!/usr/bin/env python
 """Tests for `hoymiles_mqtt` package."""
+import copy
 import json
+from unittest.mock import patch
 
 from hoymiles_modbus.datatypes import InverterData, PlantData
 
 from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES
+from hoymiles_mqtt.blocks import PartialPlantData
 from hoymiles_mqtt.ha import HassMqtt
 
 
+def _parse(message):
+    topic, payload = message
+    return topic, json.loads(payload)
+
+
 def get_example_data() -> PlantData:
     """Create example PlantData."""
     example_inverters = InverterData(
@@ -35,129 +43,117 @@ def test_config_payload():
     """Test HassMqtt.config_payload."""
     ha = HassMqtt(mi_entities=['grid_voltage'], port_entities=['pv_voltage'])
     payload = list(ha.get_configs(get_example_data()))
-    assert payload[0] == (
+    assert _parse(payload[0]) == (
         'homeassistant/sensor/dtu_serial/DTU_pv_power/config',
-        json.dumps(
-            {
-                'device': {
-                    'name': 'DTU_dtu_serial',
-                    'identifiers': ['hoymiles_mqtt_dtu_serial'],
-                    'manufacturer': 'Hoymiles',
-                },
-                'name': 'pv_power',
-                'unique_id': 'hoymiles_mqtt_DTU_dtu_serial_pv_power',
-                'state_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
-                'value_template': "{{ iif(value_json.pv_power is defined, value_json.pv_power, '') }}",
-                'availability_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
-                'availability_template': "{{ iif(value_json.pv_power is defined, 'online', 'offline') }}",
-                'device_class': 'power',
-                'unit_of_measurement': 'W',
-                'state_class': 'measurement',
-            }
-        ),
-    )
-    assert payload[1] == (
+        {
+            'device': {
+                'name': 'DTU_dtu_serial',
+                'identifiers': ['hoymiles_mqtt_dtu_serial'],
+                'manufacturer': 'Hoymiles',
+            },
+            'name': 'pv_power',
+            'unique_id': 'hoymiles_mqtt_DTU_dtu_serial_pv_power',
+            'state_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
+            'value_template': "{{ iif(value_json.pv_power is defined, value_json.pv_power, '') }}",
+            'availability_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
+            'availability_template': "{{ iif(value_json.pv_power is defined, 'online', 'offline') }}",
+            'device_class': 'power',
+            'unit_of_measurement': 'W',
+            'state_class': 'measurement',
+        },
+    )
+    assert _parse(payload[1]) == (
         'homeassistant/sensor/dtu_serial/DTU_today_production/config',
-        json.dumps(
-            {
-                'device': {
-                    'name': 'DTU_dtu_serial',
-                    'identifiers': ['hoymiles_mqtt_dtu_serial'],
-                    'manufacturer': 'Hoymiles',
-                },
-                'name': 'today_production',
-                'unique_id': 'hoymiles_mqtt_DTU_dtu_serial_today_production',
-                'state_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
-                'value_template': "{{ iif(value_json.today_production is defined, value_json.today_production, '') }}",
-                'availability_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
-                'availability_template': "{{ iif(value_json.today_production is defined, 'online', 'offline') }}",
-                'device_class': 'energy',
-                'unit_of_measurement': 'Wh',
-                'state_class': 'total_increasing',
-            }
-        ),
-    )
-    assert payload[2] == (
+        {
+            'device': {
+                'name': 'DTU_dtu_serial',
+                'identifiers': ['hoymiles_mqtt_dtu_serial'],
+                'manufacturer': 'Hoymiles',
+            },
+            'name': 'today_production',
+            'unique_id': 'hoymiles_mqtt_DTU_dtu_serial_today_production',
+            'state_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
+            'value_template': "{{ iif(value_json.today_production is defined, value_json.today_production, '') }}",
+            'availability_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
+            'availability_template': "{{ iif(value_json.today_production is defined, 'online', 'offline') }}",
+            'device_class': 'energy',
+            'unit_of_measurement': 'Wh',
+            'state_class': 'total_increasing',
+        },
+    )
+    assert _parse(payload[2]) == (
         'homeassistant/sensor/dtu_serial/DTU_total_production/config',
-        json.dumps(
-            {
-                'device': {
-                    'name': 'DTU_dtu_serial',
-                    'identifiers': ['hoymiles_mqtt_dtu_serial'],
-                    'manufacturer': 'Hoymiles',
-                },
-                'name': 'total_production',
-                'unique_id': 'hoymiles_mqtt_DTU_dtu_serial_total_production',
-                'state_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
-                'value_template': "{{ iif(value_json.total_production is defined, value_json.total_production, '') }}",
-                'availability_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
-                'availability_template': "{{ iif(value_json.total_production is defined, 'online', 'offline') }}",
-                'device_class': 'energy',
-                'unit_of_measurement': 'Wh',
-                'state_class': 'total_increasing',
-            }
-        ),
-    )
-    assert payload[3] == (
+        {
+            'device': {
+                'name': 'DTU_dtu_serial',
+                'identifiers': ['hoymiles_mqtt_dtu_serial'],
+                'manufacturer': 'Hoymiles',
+            },
+            'name': 'total_production',
+            'unique_id': 'hoymiles_mqtt_DTU_dtu_serial_total_production',
+            'state_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
+            'value_template': "{{ iif(value_json.total_production is defined, value_json.total_production, '') }}",
+            'availability_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
+            'availability_template': "{{ iif(value_json.total_production is defined, 'online', 'offline') }}",
+            'device_class': 'energy',
+            'unit_of_measurement': 'Wh',
+            'state_class': 'total_increasing',
+        },
+    )
+    assert _parse(payload[3]) == (
         'homeassistant/binary_sensor/dtu_serial/DTU_alarm_flag/config',
-        json.dumps(
-            {
-                'device': {
-                    'name': 'DTU_dtu_serial',
-                    'identifiers': ['hoymiles_mqtt_dtu_serial'],
-                    'manufacturer': 'Hoymiles',
-                },
-                'name': 'alarm_flag',
-                'unique_id': 'hoymiles_mqtt_DTU_dtu_serial_alarm_flag',
-                'state_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
-                'value_template': "{{ iif(value_json.alarm_flag is defined, value_json.alarm_flag, '') }}",
-                'availability_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
-                'availability_template': "{{ iif(value_json.alarm_flag is defined, 'online', 'offline') }}",
-                'device_class': 'problem',
-            }
-        ),
-    )
-    assert payload[4] == (
+        {
+            'device': {
+                'name': 'DTU_dtu_serial',
+                'identifiers': ['hoymiles_mqtt_dtu_serial'],
+                'manufacturer': 'Hoymiles',
+            },
+            'name': 'alarm_flag',
+            'unique_id': 'hoymiles_mqtt_DTU_dtu_serial_alarm_flag',
+            'state_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
+            'value_template': "{{ iif(value_json.alarm_flag is defined, value_json.alarm_flag, '') }}",
+            'availability_topic': 'homeassistant/hoymiles_mqtt/dtu_serial/state',
+            'availability_template': "{{ iif(value_json.alarm_flag is defined, 'online', 'offline') }}",
+            'device_class': 'problem',
+        },
+    )
+    assert _parse(payload[4]) == (
         'homeassistant/sensor/102162804827/inv_grid_voltage/config',
-        json.dumps(
-            {
-                'device': {
-                    'name': 'inv_102162804827',
-                    'identifiers': ['hoymiles_mqtt_102162804827'],
-                    'manufacturer': 'Hoymiles',
-                },
-                'name': 'grid_voltage',
-                'unique_id': 'hoymiles_mqtt_inv_102162804827_grid_voltage',
-                'state_topic': 'homeassistant/hoymiles_mqtt/102162804827/state',
-                'value_template': "{{ iif(value_json.grid_voltage is defined, value_json.grid_voltage, '') }}",
-                'availability_topic': 'homeassistant/hoymiles_mqtt/102162804827/state',
-                'availability_template': "{{ iif(value_json.grid_voltage is defined, 'online', 'offline') }}",
-                'device_class': 'voltage',
-                'unit_of_measurement': 'V',
-                'state_class': 'measurement',
-            }
-        ),
-    )
-    assert payload[5] == (
+        {
+            'device': {
+                'name': 'inv_102162804827',
+                'identifiers': ['hoymiles_mqtt_102162804827'],
+                'manufacturer': 'Hoymiles',
+            },
+            'name': 'grid_voltage',
+            'unique_id': 'hoymiles_mqtt_inv_102162804827_grid_voltage',
+            'state_topic': 'homeassistant/hoymiles_mqtt/102162804827/state',
+            'value_template': "{{ iif(value_json.grid_voltage is defined, value_json.grid_voltage, '') }}",
+            'availability_topic': 'homeassistant/hoymiles_mqtt/102162804827/state',
+            'availability_template': "{{ iif(value_json.grid_voltage is defined, 'online', 'offline') }}",
+            'device_class': 'voltage',
+            'unit_of_measurement': 'V',
+            'state_class': 'measurement',
+        },
+    )
+    assert _parse(payload[5]) == (
         'homeassistant/sensor/102162804827/port_3_pv_voltage/config',
-        json.dumps(
-            {
-                'device': {
-                    'name': 'inv_102162804827',
-                    'identifiers': ['hoymiles_mqtt_102162804827'],
-                    'manufacturer': 'Hoymiles',
-                },
-                'name': 'port_3_pv_voltage',
-                'unique_id': 'hoymiles_mqtt_port_3_102162804827_pv_voltage',
-                'state_topic': 'homeassistant/hoymiles_mqtt/102162804827/3/state',
-                'value_template': "{{ iif(value_json.pv_voltage is defined, value_json.pv_voltage, '') }}",
-                'availability_topic': 'homeassistant/hoymiles_mqtt/102162804827/3/state',
-                'availability_template': "{{ iif(value_json.pv_voltage is defined, 'online', 'offline') }}",
-                'device_class': 'voltage',
-                'unit_of_measurement': 'V',
-                'state_class': 'measurement',
-            }
-        ),
+        {
+            'device': {
+                'name': 'inv_102162804827',
+                'identifiers': ['hoymiles_mqtt_102162804827'],
+                'manufacturer': 'Hoymiles',
+            },
+            'name': 'port_3_pv_voltage',
+            'unique_id': 'hoymiles_mqtt_port_3_102162804827_pv_voltage',
+            'state_topic': 'homeassistant/hoymiles_mqtt/102162804827/3/state',
+            'value_template': "{{ iif(value_json.pv_voltage is defined, value_json.pv_voltage, '') }}",
+            'availability_topic': 'homeassistant/hoymiles_mqtt/102162804827/3/state',
+            'availability_template': "{{ iif(value_json.pv_voltage is defined, 'online', 'offline') }}",
+            'device_class': 'voltage',
+            'unit_of_measurement': 'V',
+            'state_class': 'measurement',
+        },
     )
 
 
@@ -166,31 +162,36 @@ def test_get_states():
     ha = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES)
     example_data = get_example_data()
     states = list(ha.get_states(example_data))
-    assert states[0] == (
+    assert _parse(states[0]) == (
         'homeassistant/hoymiles_mqtt/dtu_serial/state',
-        '{"pv_power": 0.0, "today_production": 431, "total_production": 8844, "alarm_flag": "OFF"}',
+        {'pv_power': 0.0, 'today_production': 431, 'total_production': 8844, 'alarm_flag': 'OFF'},
     )
-    assert states[1] == (
+    assert _parse(states[1]) == (
         'homeassistant/hoymiles_mqtt/102162804827/state',
-        '{"grid_voltage": 22.33, "grid_frequency": 32.12, "temperature": 20.4, "operating_status": 3, '
-        '"alarm_code": 0, "alarm_count": 2, "link_status": 1}',
+        {
+            'grid_voltage': 22.33,
+            'grid_frequency': 32.12,
+            'temperature': 20.4,
+            'operating_status': 3,
+            'alarm_code': 0,
+            'alarm_count': 2,
+            'link_status': 1,
+        },
     )
-    assert states[2] == (
+    assert _parse(states[2]) == (
         'homeassistant/hoymiles_mqtt/102162804827/3/state',
-        '{"pv_voltage": 1.234, "pv_current": 2.34, "pv_power": 40.31, "today_production": 431, '
-        '"total_production": 8844}',
+        {'pv_voltage': 1.234, 'pv_current': 2.34, 'pv_power': 40.31, 'today_production': 431, 'total_production': 8844},
     )
     example_data.inverters[0].today_production += 1
     example_data.inverters[0].total_production += 2
     states = list(ha.get_states(example_data))
-    assert states[0] == (
+    assert _parse(states[0]) == (
         'homeassistant/hoymiles_mqtt/dtu_serial/state',
-        '{"pv_power": 0.0, "today_production": 432, "total_production": 8846, "alarm_flag": "OFF"}',
+        {'pv_power': 0.0, 'today_production': 432, 'total_production': 8846, 'alarm_flag': 'OFF'},
     )
-    assert states[2] == (
+    assert _parse(states[2]) == (
         'homeassistant/hoymiles_mqtt/102162804827/3/state',
-        '{"pv_voltage": 1.234, "pv_current": 2.34, "pv_power": 40.31, "today_production": 432, '
-        '"total_production": 8846}',
+        {'pv_voltage': 1.234, 'pv_current': 2.34, 'pv_power': 40.31, 'today_production': 432, 'total_production': 8846},
     )
 
 
@@ -204,9 +205,9 @@ def test_zero_operating_status():
     example_data.inverters[0].today_production += 1
     example_data.inverters[0].total_production += 2
     states = list(ha.get_states(example_data))
-    assert states[0] == (
+    assert _parse(states[0]) == (
         'homeassistant/hoymiles_mqtt/dtu_serial/state',
-        '{"pv_power": 0.0, "today_production": 431, "total_production": 8844, "alarm_flag": "OFF"}',
+        {'pv_power': 0.0, 'today_production': 431, 'total_production': 8844, 'alarm_flag': 'OFF'},
     )
 
 
@@ -218,12 +219,200 @@ def test_production_drop():
     example_data.inverters[0].today_production -= 1
     example_data.inverters[0].total_production -= 2
     states = list(ha.get_states(example_data))
-    assert states[0] == (
+    assert _parse(states[0]) == (
+        'homeassistant/hoymiles_mqtt/dtu_serial/state',
+        {'pv_power': 0.0, 'today_production': 431, 'total_production': 8844, 'alarm_flag': 'OFF'},
+    )
+    assert _parse(states[2]) == (
+        'homeassistant/hoymiles_mqtt/102162804827/3/state',
+        {'pv_voltage': 1.234, 'pv_current': 2.34, 'pv_power': 40.31, 'today_production': 431, 'total_production': 8844},
+    )
+
+
+def test_delta_states():
+    """Verify that unchanged states are skipped in delta mode."""
+    ha = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES, delta=True)
+    example_data = get_example_data()
+    assert len(list(ha.get_states(example_data))) == 3
+    assert ha.skipped_states == 0
+
+    assert list(ha.get_states(example_data)) == []
+    assert ha.skipped_states == 3
+
+    example_data.inverters[0].pv_power += 1
+    states = list(ha.get_states(example_data))
+    assert [topic for topic, _ in states] == ['homeassistant/hoymiles_mqtt/102162804827/3/state']
+    assert ha.skipped_states == 2
+
+    ha.clear_states()
+    assert len(list(ha.get_states(example_data))) == 3
+
+
+def test_delta_states_full_refresh():
+    """Verify that all states are periodically sent in delta mode."""
+    ha = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES, delta=True, full_refresh_cycles=2)
+    example_data = get_example_data()
+    sent = [len(list(ha.get_states(example_data))) for _ in range(5)]
+    assert sent == [3, 0, 3, 0, 3]
+
+
+def test_delta_states_full_refresh_period():
+    """Verify that all states are sent in delta mode when entities would otherwise expire."""
+    ha = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES, delta=True, expire_after=120)
+    example_data = get_example_data()
+    with patch('hoymiles_mqtt.ha.time.monotonic') as monotonic_mock:
+        monotonic_mock.return_value = 1000
+        assert len(list(ha.get_states(example_data))) == 3
+        monotonic_mock.return_value = 1059
+        assert len(list(ha.get_states(example_data))) == 0
+        monotonic_mock.return_value = 1060
+        assert len(list(ha.get_states(example_data))) == 3
+
+
+def test_config_payload_cache():
+    """Verify that config payloads are built once and rebuilt after change of expire_after."""
+    ha = HassMqtt(mi_entities=['grid_voltage'], port_entities=['pv_voltage'])
+    first = list(ha.get_configs(get_example_data()))
+    ha.clear_configs()
+    second = list(ha.get_configs(get_example_data()))
+    assert all(a[1] is b[1] for a, b in zip(first, second))
+
+    ha.expire_after = 120
+    ha.clear_configs()
+    third = list(ha.get_configs(get_example_data()))
+    assert json.loads(third[4][1])['expire_after'] == '120'
+    assert 'expire_after' not in json.loads(first[4][1])
+
+
+def test_config_payload_new_devices_only():
+    """Verify that configs are returned only for devices not seen before."""
+    ha = HassMqtt(mi_entities=['grid_voltage'], port_entities=['pv_voltage'])
+    example_data = get_example_data()
+    assert len(list(ha.get_configs(example_data))) == 6
+    assert list(ha.get_configs(example_data)) == []
+
+    new_port = copy.copy(example_data.inverters[0])
+    new_port.port_number = 4
+    example_data.inverters.append(new_port)
+    assert [topic for topic, _ in ha.get_configs(example_data)] == [
+        'homeassistant/sensor/102162804827/port_4_pv_voltage/config'
+    ]
+
+    ha.clear_configs()
+    assert len(list(ha.get_configs(example_data))) == 7
+
+
+def test_states_of_idle_inverter():
+    """Verify that values ignored when operating status is zero are not included in states."""
+    ha = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES, post_process=False)
+    example_data = get_example_data()
+    example_data.inverters[0].operating_status = 0
+    states = list(ha.get_states(example_data))
+    assert _parse(states[0]) == (
         'homeassistant/hoymiles_mqtt/dtu_serial/state',
-        '{"pv_power": 0.0, "today_production": 431, "total_production": 8844, "alarm_flag": "OFF"}',
+        {'pv_power': 0.0, 'alarm_flag': 'OFF'},
+    )
+    assert _parse(states[1]) == (
+        'homeassistant/hoymiles_mqtt/102162804827/state',
+        {'operating_status': 0, 'alarm_code': 0, 'alarm_count': 2, 'link_status': 1},
     )
-    assert states[2] == (
+    assert _parse(states[2]) == (
+        'homeassistant/hoymiles_mqtt/102162804827/3/state',
+        {'today_production': 431, 'total_production': 8844},
+    )
+
+
+def test_multi_port_inverter_grouped():
+    """Verify that microinverter level messages are generated once, also when records of ports are interleaved."""
+    ha = HassMqtt(mi_entities=['grid_voltage'], port_entities=['pv_power'])
+    example_data = get_example_data()
+    first_port = example_data.inverters[0]
+    other_inverter = copy.copy(first_port)
+    other_inverter.serial_number = '102162804828'
+    second_port = copy.copy(first_port)
+    second_port.port_number = 4
+    example_data.inverters = [first_port, other_inverter, second_port]
+    assert [topic for topic, _ in ha.get_states(example_data)] == [
+        'homeassistant/hoymiles_mqtt/dtu_serial/state',
+        'homeassistant/hoymiles_mqtt/102162804827/state',
         'homeassistant/hoymiles_mqtt/102162804827/3/state',
-        '{"pv_voltage": 1.234, "pv_current": 2.34, "pv_power": 40.31, "today_production": 431, '
-        '"total_production": 8844}',
+        'homeassistant/hoymiles_mqtt/102162804827/4/state',
+        'homeassistant/hoymiles_mqtt/102162804828/state',
+        'homeassistant/hoymiles_mqtt/102162804828/3/state',
+    ]
+    config_topics = [topic for topic, _ in ha.get_configs(example_data)]
+    assert config_topics.count('homeassistant/sensor/102162804827/inv_grid_voltage/config') == 1
+    # 4 DTU entities, microinverter entity of 2 microinverters, 3 ports
+    assert len(config_topics) == 4 + 2 + 3
+
+
+def test_missing_ports_unavailable():
+    """Verify that states without values are generated for ports (and microinverters) which could not be read."""
+    ha = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES)
+    example_data = get_example_data()
+    plant_data = PartialPlantData(
+        'dtu_serial',
+        inverters=example_data.inverters,
+        missing_ports=[('102162804827', 4), ('102162804828', 1), ('102162804828', 2)],
     )
+    states = [_parse(state) for state in ha.get_states(plant_data)]
+    assert states[3:] == [
+        ('homeassistant/hoymiles_mqtt/102162804827/4/state', {}),
+        ('homeassistant/hoymiles_mqtt/102162804828/state', {}),
+        ('homeassistant/hoymiles_mqtt/102162804828/1/state', {}),
+        ('homeassistant/hoymiles_mqtt/102162804828/2/state', {}),
+    ]
+
+
+def test_stale_devices_evicted():
+    """Verify that devices not seen for device_ttl are removed from caches and DTU totals, with configs cleared."""
+    ha = HassMqtt(
+        mi_entities=['grid_voltage'], port_entities=['pv_voltage'], device_ttl=3600, clear_evicted_configs=True
+    )
+    replaced = get_example_data()
+    replacement = get_example_data()
+    replacement.inverters[0].serial_number = '102162804828'
+    replacement.inverters[0].today_production = 100
+    with patch('hoymiles_mqtt.ha.time.monotonic') as monotonic_mock:
+        monotonic_mock.return_value = 1000
+        list(ha.get_states(replaced))
+        assert len(list(ha.get_configs(replaced))) == 6
+
+        monotonic_mock.return_value = 2000
+        states = dict(map(_parse, ha.get_states(replacement)))
+        assert states['homeassistant/hoymiles_mqtt/dtu_serial/state']['today_production'] == 531
+        assert len(list(ha.get_configs(replacement))) == 2
+
+        monotonic_mock.return_value = 4600
+        states = dict(map(_parse, ha.get_states(replacement)))
+        assert states['homeassistant/hoymiles_mqtt/dtu_serial/state']['today_production'] == 100
+        assert ha.get_production_cache() == ({('102162804828', 3): 100}, {('102162804828', 3): 8844})
+        assert list(ha.get_configs(replacement)) == [
+            ('homeassistant/sensor/102162804827/inv_grid_voltage/config', b''),
+            ('homeassistant/sensor/102162804827/port_3_pv_voltage/config', b''),
+        ]
+        # publishing failed, empty configs are returned again
+        ha.clear_configs()
+        assert [topic for topic, payload in ha.get_configs(replacement) if not payload] == [
+            'homeassistant/sensor/102162804827/inv_grid_voltage/config',
+            'homeassistant/sensor/102162804827/port_3_pv_voltage/config',
+        ]
+        assert list(ha.get_configs(replacement)) == []
+
+        # the device is configured again when it comes back
+        assert len(list(ha.get_configs(replaced))) == 2
+
+
+def test_restored_devices_evicted():
+    """Verify that devices restored from the production cache are forgotten when they are not seen again."""
+    ha = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES, device_ttl=3600)
+    with patch('hoymiles_mqtt.ha.time.monotonic') as monotonic_mock:
+        monotonic_mock.return_value = 1000
+        ha.restore_production_cache({('102162800000', 1): 50}, {('102162800000', 1): 5000})
+        list(ha.get_states(get_example_data()))
+        assert len(ha.get_production_cache()[0]) == 2
+        assert ('inv', '102162800000', None) in ha._last_seen
+        monotonic_mock.return_value = 4600
+        list(ha.get_states(get_example_data()))
+    assert ha.get_production_cache()[0] == {('102162804827', 3): 431}
+    assert not any(serial_number == '102162800000' for _, serial_number, _ in ha._last_seen)
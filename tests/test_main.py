@@ -1,14 +1,237 @@
 #!/usr/bin/env python
 """Tests for __main__ module."""
 
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
+import pytest
+
+from benchmarks.bench_startup import DEFAULT_MODULE, best_import_time, heavy_imports
 from hoymiles_mqtt.__main__ import main
 
+# import time of the entry point, without MQTT and Modbus libraries it is well below it
+STARTUP_BUDGET_MS = 200
+
 
 def test_main_happy_path(monkeypatch):
     """Happy path verification for main() function."""
     monkeypatch.setattr('sys.argv', ['hoymiles_mqtt', '--mqtt-broker', 'some_broker', '--dtu-host', 'some_dtu_host'])
-    with patch('hoymiles_mqtt.__main__.run_periodic_job') as mock_run_periodic_job:
+    with patch('hoymiles_mqtt.app.run_periodic_jobs') as mock_run_periodic_jobs:
+        main()
+    mock_run_periodic_jobs.assert_called_once()
+
+
+def test_main_multiple_dtus(monkeypatch):
+    """Verify that a job is created for each DTU, all of them with the same MQTT publisher."""
+    monkeypatch.setattr(
+        'sys.argv',
+        [
+            'hoymiles_mqtt',
+            '--mqtt-broker',
+            'some_broker',
+            '--dtu-host',
+            'dtu_1',
+            'dtu_2:5020',
+            'dtu_3:5021:2',
+            '--dtu-port',
+            '503',
+        ],
+    )
+    with (
+        patch('hoymiles_mqtt.app.run_periodic_jobs') as mock_run_periodic_jobs,
+        patch('hoymiles_mqtt.app.HoymilesQueryJob') as mock_query_job,
+    ):
+        main()
+    jobs = mock_run_periodic_jobs.call_args.kwargs['jobs']
+    assert list(jobs) == ['dtu_dtu_1:503:1', 'dtu_dtu_2:5020:1', 'dtu_dtu_3:5021:2']
+    publishers = {call.kwargs['mqtt_publisher'] for call in mock_query_job.call_args_list}
+    builders = {call.kwargs['mqtt_builder'] for call in mock_query_job.call_args_list}
+    assert len(publishers) == 1
+    assert len(builders) == 3
+
+
+def test_main_invalid_dtu(monkeypatch):
+    """Verify that invalid DTU address is rejected."""
+    monkeypatch.setattr('sys.argv', ['hoymiles_mqtt', '--mqtt-broker', 'some_broker', '--dtu-host', 'dtu:port'])
+    with pytest.raises(SystemExit):
+        main()
+
+
+def test_main_asyncio_runtime(monkeypatch):
+    """Verify that asyncio runtime is started with a client and a job for each DTU."""
+    monkeypatch.setattr(
+        'sys.argv',
+        ['hoymiles_mqtt', '--mqtt-broker', 'some_broker', '--dtu-host', 'dtu_1', 'dtu_2', '--runtime', 'asyncio'],
+    )
+    with (
+        patch('hoymiles_mqtt.aio.run_async', new_callable=Mock) as mock_run_async,
+        patch('hoymiles_mqtt.app.asyncio.run') as mock_asyncio_run,
+        patch('hoymiles_mqtt.app.run_periodic_jobs') as mock_run_periodic_jobs,
+    ):
+        main()
+    mock_run_periodic_jobs.assert_not_called()
+    mock_asyncio_run.assert_called_once_with(mock_run_async.return_value)
+    dtus = mock_run_async.call_args.kwargs['dtus']
+    assert list(dtus) == ['dtu_dtu_1:502:1', 'dtu_dtu_2:502:1']
+    assert [modbus_client.host for modbus_client, _ in dtus.values()] == ['dtu_1', 'dtu_2']
+
+
+def test_main_offline_buffer(monkeypatch, tmp_path):
+    """Verify that the offline buffer is given to the jobs and drained while running."""
+    path = str(tmp_path / 'buffer.db')
+    monkeypatch.setattr(
+        'sys.argv',
+        ['hoymiles_mqtt', '--mqtt-broker', 'some_broker', '--dtu-host', 'dtu_1', '--offline-buffer', path],
+    )
+    with (
+        patch('hoymiles_mqtt.app.run_periodic_jobs'),
+        patch('hoymiles_mqtt.app.HoymilesQueryJob') as mock_query_job,
+        patch('hoymiles_mqtt.app.BufferDrainer') as mock_drainer,
+    ):
+        main()
+    assert mock_query_job.call_args.kwargs['offline_buffer'] is mock_drainer.call_args.kwargs['buffer']
+    mock_drainer.return_value.start.assert_called_once()
+    mock_drainer.return_value.stop.assert_called_once()
+
+
+def test_main_production_cache(monkeypatch, tmp_path):
+    """Verify that production caches are restored at startup and saved at exit."""
+    path = str(tmp_path / 'production.json')
+    monkeypatch.setattr(
+        'sys.argv',
+        ['hoymiles_mqtt', '--mqtt-broker', 'some_broker', '--dtu-host', 'dtu_1', '--production-cache', path],
+    )
+    with (
+        patch('hoymiles_mqtt.app.run_periodic_jobs'),
+        patch('hoymiles_mqtt.app.HoymilesQueryJob') as mock_query_job,
+        patch('hoymiles_mqtt.app.ProductionCacheStore') as mock_store,
+    ):
+        main()
+    assert list(mock_store.call_args.kwargs['builders']) == ['dtu_dtu_1:502:1']
+    assert mock_query_job.call_args.kwargs['production_store'] is mock_store.return_value
+    mock_store.return_value.load.assert_called_once()
+    mock_store.return_value.save.assert_called_once_with(force=True)
+
+
+def test_main_night_query_period(monkeypatch):
+    """Verify that jobs are scheduled with adaptive period when night query period is given."""
+    monkeypatch.setattr(
+        'sys.argv',
+        [
+            'hoymiles_mqtt',
+            '--mqtt-broker',
+            'some_broker',
+            '--dtu-host',
+            'dtu_1',
+            '--night-query-period',
+            '600',
+            '--latitude',
+            '52.23',
+            '--longitude',
+            '21.01',
+        ],
+    )
+    with patch('hoymiles_mqtt.app.run_periodic_jobs') as mock_run_periodic_jobs:
         main()
-    mock_run_periodic_job.assert_called_once()
+    periods = mock_run_periodic_jobs.call_args.kwargs['periods']
+    assert list(periods) == ['dtu_dtu_1:502:1']
+    assert periods['dtu_dtu_1:502:1']() in (60, 600)
+
+
+def test_main_latitude_without_longitude(monkeypatch):
+    """Verify that location must be given completely."""
+    monkeypatch.setattr(
+        'sys.argv', ['hoymiles_mqtt', '--mqtt-broker', 'some_broker', '--dtu-host', 'dtu_1', '--latitude', '52.23']
+    )
+    with pytest.raises(SystemExit):
+        main()
+
+
+def test_main_snapshot_output(monkeypatch):
+    """Verify that builders publish only snapshots in snapshot output mode."""
+    monkeypatch.setattr(
+        'sys.argv',
+        ['hoymiles_mqtt', '--mqtt-broker', 'some_broker', '--dtu-host', 'dtu_1', '--output-mode', 'snapshot'],
+    )
+    with (
+        patch('hoymiles_mqtt.app.run_periodic_jobs'),
+        patch('hoymiles_mqtt.app.HassMqtt') as mock_builder,
+    ):
+        main()
+    assert mock_builder.call_args.kwargs['snapshot'].get_topic('dtu_serial') == 'hoymiles_mqtt/dtu_serial/snapshot'
+    assert mock_builder.call_args.kwargs['device_topics'] is False
+
+
+def test_main_modbus_connection(monkeypatch):
+    """Verify communication parameters and persistent connection of Modbus clients."""
+    monkeypatch.setattr(
+        'sys.argv',
+        [
+            'hoymiles_mqtt',
+            '--mqtt-broker',
+            'some_broker',
+            '--dtu-host',
+            'dtu_1',
+            '--comm-reconnect-delay',
+            '2',
+            '--comm-reconnect-delay-max',
+            '30',
+        ],
+    )
+    with (
+        patch('hoymiles_mqtt.app.run_periodic_jobs'),
+        patch('hoymiles_mqtt.app.HoymilesQueryJob') as mock_query_job,
+    ):
+        main()
+    modbus_client = mock_query_job.call_args.kwargs['modbus_client']
+    assert modbus_client.comm_params.reconnect_delay == 2
+    assert modbus_client.comm_params.reconnect_delay_max == 30
+    assert modbus_client._connection is not None
+
+    monkeypatch.setattr(
+        'sys.argv', ['hoymiles_mqtt', '--mqtt-broker', 'b', '--dtu-host', 'd', '--modbus-connect-per-cycle']
+    )
+    with (
+        patch('hoymiles_mqtt.app.run_periodic_jobs'),
+        patch('hoymiles_mqtt.app.HoymilesQueryJob') as mock_query_job,
+    ):
+        main()
+    assert mock_query_job.call_args.kwargs['modbus_client']._connection is None
+
+
+def test_main_print_config(monkeypatch, capsys):
+    """Verify that the effective configuration is printed in config file format, without running the tool."""
+    monkeypatch.setenv('MQTT_PASSWORD', 'secret')
+    monkeypatch.setattr(
+        'sys.argv',
+        ['hoymiles_mqtt', '--mqtt-broker', 'some_broker', '--dtu-host', 'dtu_1', 'dtu_2:5020', '--print-config'],
+    )
+    with patch('hoymiles_mqtt.app.run') as mock_run:
+        main()
+    mock_run.assert_not_called()
+    lines = capsys.readouterr().out.splitlines()
+    assert 'mqtt-broker = some_broker' in lines
+    assert 'mqtt-password = ***' in lines
+    assert 'dtu-host = [dtu_1, dtu_2:5020]' in lines
+    assert 'delta-publish = false' in lines
+    assert not [line for line in lines if line.startswith(('print-config', 'config ', 'mqtt-user'))]
+
+
+def test_main_check_config(monkeypatch, capsys):
+    """Verify that the configuration is checked without running the tool."""
+    monkeypatch.setattr(
+        'sys.argv', ['hoymiles_mqtt', '--mqtt-broker', 'some_broker', '--dtu-host', 'dtu_1', '--check-config']
+    )
+    with patch('hoymiles_mqtt.app.run') as mock_run:
+        main()
+    mock_run.assert_not_called()
+    assert capsys.readouterr().out == 'Configuration is valid.\n'
+    monkeypatch.setattr('sys.argv', ['hoymiles_mqtt', '--mqtt-broker', 'some_broker', '--check-config'])
+    with pytest.raises(SystemExit):
+        main()
+
+
+def test_startup_import_time():
+    """Verify that the entry point does not import MQTT and Modbus libraries and is imported within the budget."""
+    total, times = best_import_time(DEFAULT_MODULE, repeat=3)
+    assert heavy_imports(times) == []
+    assert total / 1000 < STARTUP_BUDGET_MS
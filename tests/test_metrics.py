@@ -0,0 +1,46 @@
+"""Tests for metrics."""
+
+import urllib.error
+import urllib.request
+
+import pytest
+
+from hoymiles_mqtt.metrics import MetricsRegistry, MetricsServer
+
+
+def test_render():
+    """Verify text representation of metrics."""
+    registry = MetricsRegistry()
+    metrics = registry.for_dtu('192.168.1.100:502:1')
+    metrics.read_time.observe(0.3)
+    metrics.read_time.observe(0.004)
+    metrics.read_error(TimeoutError())
+    metrics.messages_sent.inc(3)
+    metrics.last_poll.set(1700000000)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE hoymiles_mqtt_modbus_read_seconds histogram' in lines
+    assert 'hoymiles_mqtt_modbus_read_seconds_bucket{dtu="192.168.1.100:502:1",le="0.005"} 1' in lines
+    assert 'hoymiles_mqtt_modbus_read_seconds_bucket{dtu="192.168.1.100:502:1",le="0.25"} 1' in lines
+    assert 'hoymiles_mqtt_modbus_read_seconds_bucket{dtu="192.168.1.100:502:1",le="0.5"} 2' in lines
+    assert 'hoymiles_mqtt_modbus_read_seconds_bucket{dtu="192.168.1.100:502:1",le="+Inf"} 2' in lines
+    assert 'hoymiles_mqtt_modbus_read_seconds_count{dtu="192.168.1.100:502:1"} 2' in lines
+    assert 'hoymiles_mqtt_modbus_errors_total{dtu="192.168.1.100:502:1",type="TimeoutError"} 1.0' in lines
+    assert 'hoymiles_mqtt_messages_sent_total{dtu="192.168.1.100:502:1"} 3.0' in lines
+    assert 'hoymiles_mqtt_last_successful_poll_timestamp_seconds{dtu="192.168.1.100:502:1"} 1700000000.0' in lines
+
+
+def test_server():
+    """Verify that metrics are served over HTTP."""
+    registry = MetricsRegistry()
+    registry.for_dtu('dtu').skipped_cycles.inc()
+    server = MetricsServer(registry, host='127.0.0.1', port=0)
+    server.start()
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/metrics') as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert 'hoymiles_mqtt_skipped_cycles_total{dtu="dtu"} 1.0' in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f'http://127.0.0.1:{server.port}/other')
+    finally:
+        server.stop()
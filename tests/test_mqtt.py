@@ -1,7 +1,16 @@
 """Tests for MqttPublisher."""
 
+import threading
+import time
 from unittest.mock import Mock, patch
 
+import pytest
+from paho.mqtt import client as mqtt_client
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCode
+
+from hoymiles_mqtt.metrics import MetricsRegistry
 from hoymiles_mqtt.mqtt import MqttPublisher
 
 
@@ -11,7 +20,7 @@ def test_publish(publish_multiple_mock: Mock):
     mqtt_broker = "some broker"
     mqtt_port = 1234
 
-    publisher = MqttPublisher(mqtt_broker=mqtt_broker, mqtt_port=mqtt_port)
+    publisher = MqttPublisher(mqtt_broker=mqtt_broker, mqtt_port=mqtt_port, persistent_session=False)
     with publisher.schedule_publish() as queue:
         queue.add("some topic 1", "some payload 1")
         queue.add("some topic 2", "some payload 2")
@@ -23,3 +32,243 @@ def test_publish(publish_multiple_mock: Mock):
         auth=None,
         tls=None,
     )
+
+
+@patch("hoymiles_mqtt.mqtt.publish_multiple")
+@patch("hoymiles_mqtt.mqtt.mqtt_client.Client")
+def test_publish_persistent(client_mock: Mock, publish_multiple_mock: Mock):
+    """Verify that messages are sent through one long-lived connection."""
+    publisher = MqttPublisher(mqtt_broker="some broker", mqtt_port=1234, mqtt_user='user', mqtt_password='pass')
+    publisher._connected.set()
+    client_mock.return_value.publish.return_value.is_published.return_value = True
+    for _ in range(2):
+        with publisher.schedule_publish() as queue:
+            queue.add("some topic 1", "some payload 1")
+            queue.add("some topic 2", "some payload 2", retain=True)
+
+    client_mock.assert_called_once()
+    client = client_mock.return_value
+    client.username_pw_set.assert_called_once_with('user', 'pass')
+    client.connect_async.assert_called_once()
+    client.loop_start.assert_called_once()
+    assert client.publish.call_count == 4
+    client.publish.assert_called_with('some topic 2', 'some payload 2', 0, True)
+    publish_multiple_mock.assert_not_called()
+
+    publisher.close()
+    client.disconnect.assert_called_once()
+    client.loop_stop.assert_called_once()
+
+
+@patch("hoymiles_mqtt.mqtt.CONNECT_TIMEOUT_SEC", 0)
+@patch("hoymiles_mqtt.mqtt.mqtt_client.Client")
+def test_publish_persistent_not_connected(client_mock: Mock):
+    """Verify that an error is raised when the broker is not reachable."""
+    publisher = MqttPublisher(mqtt_broker="some broker", mqtt_port=1234)
+    with pytest.raises(ConnectionError):
+        with publisher.schedule_publish() as queue:
+            queue.add("some topic 1", "some payload 1")
+    client_mock.return_value.publish.assert_not_called()
+
+
+@patch("hoymiles_mqtt.mqtt.mqtt_client.Client")
+def test_subscribe(client_mock: Mock):
+    """Verify that subscriptions are made on (re)connection and messages are dispatched to callbacks."""
+    callback = Mock()
+    other_callback = Mock()
+    publisher = MqttPublisher(mqtt_broker="some broker", mqtt_port=1234)
+    publisher.subscribe('some/topic', callback)
+    publisher.subscribe('some/topic', other_callback)
+    client_mock.assert_not_called()
+
+    client = client_mock.return_value
+    publisher._get_client()
+    publisher._on_connect(client, None, None, ReasonCode(PacketTypes.CONNACK, identifier=0), None)
+    client.subscribe.assert_called_once_with('some/topic')
+
+    publisher._on_message(client, None, Mock(topic='some/topic', payload=b'online'))
+    publisher._on_message(client, None, Mock(topic='other/topic', payload=b'online'))
+    callback.assert_called_once_with(b'online')
+    other_callback.assert_called_once_with(b'online')
+
+
+def test_subscribe_not_persistent():
+    """Verify that subscribing is ignored without persistent session."""
+    publisher = MqttPublisher(mqtt_broker="some broker", mqtt_port=1234, persistent_session=False)
+    publisher.subscribe('some/topic', Mock())
+    assert publisher._subscriptions == {}
+
+
+@patch("hoymiles_mqtt.mqtt.PUBLISH_TIMEOUT_SEC", 0)
+@patch("hoymiles_mqtt.mqtt.mqtt_client.Client")
+def test_publish_persistent_not_published(client_mock: Mock):
+    """Verify that an error is raised when messages were not published in time."""
+    client_mock.return_value.publish.return_value.is_published.return_value = False
+    publisher = MqttPublisher(mqtt_broker="some broker", mqtt_port=1234)
+    publisher._connected.set()
+    with pytest.raises(ConnectionError):
+        with publisher.schedule_publish() as queue:
+            queue.add("some topic 1", "some payload 1")
+
+
+@patch("hoymiles_mqtt.mqtt.mqtt_client.Client")
+def test_publish_mqtt5_topic_aliases(client_mock: Mock):
+    """Verify that states are published with topic aliases and expiry, within the limit announced by the broker."""
+    publisher = MqttPublisher(mqtt_broker="some broker", mqtt_port=1234, mqtt_version='5', message_expiry=120)
+    publisher._get_client()
+    client = client_mock.return_value
+    assert client_mock.call_args.kwargs['protocol'] == mqtt_client.MQTTv5
+    connack_properties = Properties(PacketTypes.CONNACK)
+    connack_properties.TopicAliasMaximum = 1
+    publisher._on_connect(client, None, None, ReasonCode(PacketTypes.CONNACK, identifier=0), connack_properties)
+    client.publish.return_value.is_published.return_value = True
+    for _ in range(2):
+        with publisher.schedule_publish() as queue:
+            queue.add("config", b"config payload", retain=True)
+            queue.add("state 1", b"payload 1")
+            queue.add("state 2", b"payload 2")
+
+    calls = client.publish.call_args_list
+    assert [call.args for call in calls if call.args[3]] == [("config", b"config payload", 0, True)] * 2
+    states = [call for call in calls if not call.args[3]]
+    assert [(call.args[0], getattr(call.kwargs['properties'], 'TopicAlias', None)) for call in states] == [
+        ("state 1", 1),
+        ("state 2", None),
+        ("", 1),
+        ("state 2", None),
+    ]
+    assert all(call.kwargs['properties'].MessageExpiryInterval == 120 for call in states)
+
+    # aliases are assigned again after reconnection
+    publisher._on_connect(client, None, None, ReasonCode(PacketTypes.CONNACK, identifier=0), connack_properties)
+    with publisher.schedule_publish() as queue:
+        queue.add("state 1", b"payload 1")
+    assert client.publish.call_args.args[0] == "state 1"
+
+
+@patch("hoymiles_mqtt.mqtt.mqtt_client.Client")
+def test_publish_mqtt5_fallback(client_mock: Mock):
+    """Verify that the publisher falls back to MQTT 3.1.1 when MQTT 5 is not supported by the broker."""
+    old_client, new_client = Mock(), Mock()
+    client_mock.side_effect = [old_client, new_client]
+    publisher = MqttPublisher(mqtt_broker="some broker", mqtt_port=1234, mqtt_version='5')
+    publisher._get_client()
+    publisher._on_connect(
+        old_client, None, None, ReasonCode(PacketTypes.CONNACK, aName='Unsupported protocol version'), None
+    )
+    assert publisher.mqtt_version == '3.1.1'
+    assert publisher._get_client() is new_client
+    old_client.loop_stop.assert_called_once()
+    assert client_mock.call_args.kwargs['protocol'] == mqtt_client.MQTTv311
+
+
+def _ack(publisher: MqttPublisher, mid: int, identifier: int = 0) -> None:
+    publisher._on_publish(None, None, mid, ReasonCode(PacketTypes.PUBACK, identifier=identifier), None)
+
+
+@patch("hoymiles_mqtt.mqtt.mqtt_client.Client")
+def test_publish_qos1_window(client_mock: Mock):
+    """Verify that messages with QoS 1 are pipelined within the in-flight window and acknowledgements are tracked."""
+    registry = MetricsRegistry()
+    publisher = MqttPublisher(mqtt_broker="some broker", mqtt_port=1234, qos=1, max_inflight=2, metrics=registry)
+    publisher._connected.set()
+    client = client_mock.return_value
+    in_flight = []
+
+    def publish(topic, payload, qos, retain, **kwargs):
+        in_flight.append(len(publisher._window))
+        mid = len(in_flight)
+        # the broker acknowledges messages with a delay
+        threading.Timer(0.05, _ack, (publisher, mid)).start()
+        return Mock(mid=mid, is_published=Mock(return_value=False))
+
+    client.publish.side_effect = publish
+    with publisher.schedule_publish() as queue:
+        for index in range(5):
+            queue.add(f"topic {index}", "payload")
+
+    client.max_inflight_messages_set.assert_called_once_with(2)
+    assert {call.args[2] for call in client.publish.call_args_list} == {1}
+    assert max(in_flight) == 1
+    assert len(publisher._window) == 0
+    stats = publisher.delivery_stats
+    assert (stats.published, stats.acked, stats.delivery_ratio) == (5, 5, 1.0)
+    assert 0 < stats.mean_latency <= stats.latency_max
+    assert 'hoymiles_mqtt_mqtt_acked_total 5.0' in registry.render()
+
+
+@patch("hoymiles_mqtt.mqtt.PUBLISH_TIMEOUT_SEC", 0)
+@patch("hoymiles_mqtt.mqtt.mqtt_client.Client")
+def test_publish_qos1_not_acked(client_mock: Mock):
+    """Verify that messages not acknowledged are reported, counted as resent after reconnection or rejected."""
+    publisher = MqttPublisher(mqtt_broker="some broker", mqtt_port=1234, qos=1)
+    publisher._connected.set()
+    client = client_mock.return_value
+    client.publish.side_effect = [Mock(mid=mid, is_published=Mock(return_value=False)) for mid in (1, 2)]
+    with pytest.raises(ConnectionError, match='2 of 2 messages'):
+        with publisher.schedule_publish() as queue:
+            queue.add("topic 1", "payload")
+            queue.add("topic 2", "payload")
+    assert publisher.delivery_stats.delivery_ratio == 0
+
+    publisher._on_connect(client, None, None, ReasonCode(PacketTypes.CONNACK, identifier=0), None)
+    _ack(publisher, 1)
+    _ack(publisher, 2, identifier=135)
+    stats = publisher.delivery_stats
+    assert (stats.published, stats.acked, stats.rejected, stats.retried) == (2, 1, 1, 2)
+    assert stats.delivery_ratio == 0.5
+
+
+def test_invalid_qos():
+    """Verify that only supported QoS levels and positive windows are accepted."""
+    with pytest.raises(ValueError):
+        MqttPublisher(mqtt_broker="some broker", mqtt_port=1234, qos=2)
+    with pytest.raises(ValueError):
+        MqttPublisher(mqtt_broker="some broker", mqtt_port=1234, qos=1, max_inflight=0)
+
+
+@patch("hoymiles_mqtt.mqtt.mqtt_client.Client")
+def test_publish_mqtt5_reconnect_during_publish(client_mock: Mock):
+    """Verify that topic aliases are not reset by reconnection between their lookup and publishing."""
+    publisher = MqttPublisher(mqtt_broker="some broker", mqtt_port=1234, mqtt_version='5')
+    publisher._get_client()
+    client = client_mock.return_value
+    connack_properties = Properties(PacketTypes.CONNACK)
+    connack_properties.TopicAliasMaximum = 1
+    connack = ReasonCode(PacketTypes.CONNACK, identifier=0)
+    publisher._on_connect(client, None, None, connack, connack_properties)
+    client.publish.return_value.is_published.return_value = True
+    with publisher.schedule_publish() as queue:
+        queue.add("state 1", b"payload 1")
+
+    events = []
+
+    def reconnect():
+        publisher._on_connect(client, None, None, connack, connack_properties)
+        events.append('connect')
+
+    def publish(*args, **kwargs):
+        events.append('publish')
+        return client.publish.return_value
+
+    reconnection = threading.Thread(target=reconnect)
+    get_topic_alias = publisher._get_topic_alias
+
+    def get_topic_alias_and_reconnect(topic):
+        result = get_topic_alias(topic)
+        reconnection.start()
+        time.sleep(0.05)
+        return result
+
+    client.publish.side_effect = publish
+    with patch.object(publisher, '_get_topic_alias', get_topic_alias_and_reconnect):
+        with publisher.schedule_publish() as queue:
+            queue.add("state 1", b"payload 1")
+    reconnection.join()
+    assert events == ['publish', 'connect']
+    assert client.publish.call_args.args[0] == ''
+
+    # the alias is assigned again within the new connection
+    with publisher.schedule_publish() as queue:
+        queue.add("state 1", b"payload 1")
+    assert client.publish.call_args.args[0] == 'state 1'
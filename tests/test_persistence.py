@@ -0,0 +1,60 @@
+"""Tests for persistence of production caches."""
+
+import os
+from unittest.mock import patch
+
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES
+from hoymiles_mqtt.ha import HassMqtt
+from hoymiles_mqtt.persistence import ProductionCacheStore
+
+TODAY = {('102162804827', 1): 862, ('102162804827', 2): 430}
+TOTAL = {('102162804827', 1): 8844, ('102162804827', 2): 5120}
+
+
+def _builder() -> HassMqtt:
+    return HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES)
+
+
+def test_save_and_load(tmp_path):
+    """Verify that production caches are restored from the snapshot."""
+    path = str(tmp_path / 'production.json')
+    builder = _builder()
+    builder.restore_production_cache(today=TODAY, total=TOTAL)
+    assert ProductionCacheStore(path, {'dtu_1': builder}).save()
+    assert os.listdir(tmp_path) == ['production.json']
+
+    restored_builder = _builder()
+    ProductionCacheStore(path, {'dtu_1': restored_builder, 'dtu_2': _builder()}).load()
+    assert restored_builder.get_production_cache() == (TODAY, TOTAL)
+
+
+def test_today_production_not_restored_next_day(tmp_path):
+    """Verify that only total production is restored when the snapshot was taken on a previous day."""
+    path = str(tmp_path / 'production.json')
+    builder = _builder()
+    builder.restore_production_cache(today=TODAY, total=TOTAL)
+    with patch('hoymiles_mqtt.persistence.time.time', return_value=1700000000.0):
+        ProductionCacheStore(path, {'dtu_1': builder}).save()
+
+    restored_builder = _builder()
+    with patch('hoymiles_mqtt.persistence.time.time', return_value=1700000000.0 + 24 * 3600):
+        ProductionCacheStore(path, {'dtu_1': restored_builder}).load()
+    assert restored_builder.get_production_cache() == ({}, TOTAL)
+
+
+def test_save_throttled(tmp_path):
+    """Verify that the snapshot is written at most once per save interval, unless forced."""
+    store = ProductionCacheStore(str(tmp_path / 'production.json'), {'dtu_1': _builder()}, save_interval=300)
+    assert store.save()
+    assert not store.save()
+    assert store.save(force=True)
+
+
+def test_invalid_snapshot_ignored(tmp_path):
+    """Verify that a missing or damaged snapshot does not prevent starting."""
+    path = tmp_path / 'production.json'
+    builder = _builder()
+    ProductionCacheStore(str(path), {'dtu_1': builder}).load()
+    path.write_text('{"version": 1, "timestamp"')
+    ProductionCacheStore(str(path), {'dtu_1': builder}).load()
+    assert builder.get_production_cache() == ({}, {})
@@ -1,11 +1,19 @@
 """Tests for the runners module."""
 
-from unittest.mock import MagicMock, PropertyMock, patch
+import logging
+import threading
+import time
+from unittest.mock import ANY, MagicMock, PropertyMock, patch
 
 import pytest
+from hoymiles_modbus.datatypes import PlantData
 from pymodbus.exceptions import ModbusIOException
 
-from hoymiles_mqtt.runners import RESET_HOUR, HoymilesQueryJob
+from hoymiles_mqtt import MI_ENTITIES, OVERRUN_CATCH_UP, OVERRUN_COALESCE, OVERRUN_SKIP, PORT_ENTITIES
+from hoymiles_mqtt.buffer import OfflineBuffer
+from hoymiles_mqtt.ha import HA_STATUS_TOPIC, HassMqtt
+from hoymiles_mqtt.metrics import MetricsRegistry
+from hoymiles_mqtt.runners import RESET_HOUR, HoymilesQueryJob, PeriodicScheduler, start_periodic_jobs
 
 
 @pytest.fixture
@@ -24,6 +32,7 @@ def mqtt_publisher():
     publisher = MagicMock()
     publisher.broker = "localhost"
     publisher.broker_port = 1883
+    publisher.qos = 0
     schedule_ctx = MagicMock()
     schedule_ctx.__enter__.return_value = MagicMock()
     schedule_ctx.__exit__.return_value = None
@@ -104,3 +113,257 @@ def test_execute_does_not_call_clear_production_today_outside_reset_hour(mqtt_bu
         job = HoymilesQueryJob(mqtt_builder, mqtt_publisher, modbus_client)
         job.execute()
         mqtt_builder.clear_production_today.assert_not_called()
+
+
+def test_execute_publish_failure_clears_states(mqtt_builder, mqtt_publisher, modbus_client):
+    """Tests that states are forgotten by the builder when publishing fails, so they are sent next time."""
+    mqtt_publisher.schedule_publish.return_value.__exit__.side_effect = ConnectionError
+    job = HoymilesQueryJob(mqtt_builder, mqtt_publisher, modbus_client)
+    job.execute()
+    mqtt_builder.clear_states.assert_called_once()
+
+
+def test_execute_publish_failure_stores_states(mqtt_builder, mqtt_publisher, modbus_client, tmp_path):
+    """Tests that states which could not be published are stored in the offline buffer, in the original order."""
+    offline_buffer = OfflineBuffer(str(tmp_path / 'buffer.db'))
+    job = HoymilesQueryJob(mqtt_builder, mqtt_publisher, modbus_client, offline_buffer=offline_buffer)
+    mqtt_publisher.schedule_publish.return_value.__exit__.side_effect = ConnectionError
+    with patch('hoymiles_mqtt.runners.time.time', return_value=100.0):
+        job.execute()
+    assert [(message.topic, message.acquired_at) for message in offline_buffer.peek(10)] == [('topic/state', 100.0)]
+
+    # the broker is back, but the buffer is not drained yet - current states are appended to the buffer
+    mqtt_publisher.schedule_publish.return_value.__exit__.side_effect = None
+    mqtt_publisher.schedule_publish.reset_mock()
+    mqtt_builder.get_configs.return_value = []
+    with patch('hoymiles_mqtt.runners.time.time', return_value=160.0):
+        job.execute()
+    mqtt_publisher.schedule_publish.assert_not_called()
+    assert [message.acquired_at for message in offline_buffer.peek(10)] == [100.0, 160.0]
+
+    offline_buffer.remove(offline_buffer.peek(10)[-1].id)
+    job.execute()
+    mqtt_publisher.schedule_publish.assert_called_once()
+    assert len(offline_buffer) == 0
+    offline_buffer.close()
+
+
+def test_execute_records_metrics(mqtt_builder, mqtt_publisher, modbus_client):
+    """Tests that timings, sent messages, errors and skipped cycles are recorded."""
+    registry = MetricsRegistry()
+    metrics = registry.for_dtu('dtu')
+    job = HoymilesQueryJob(mqtt_builder, mqtt_publisher, modbus_client, metrics=metrics)
+    job.execute()
+    assert metrics.read_time.counts[0] == 1
+    assert sum(metrics.build_time.counts) == 1
+    assert sum(metrics.publish_time.counts) == 1
+    assert metrics.messages_sent.value == 2
+    assert metrics.bytes_sent.value == len('topic/config' 'payload/config' 'topic/state' 'payload/state')
+    assert metrics.last_poll.value > 0
+
+    mqtt_publisher.schedule_publish.return_value.__exit__.side_effect = ConnectionError
+    job.execute()
+    assert metrics.publish_failures.value == 1
+
+    type(modbus_client).plant_data = PropertyMock(side_effect=TimeoutError)
+    job.execute()
+    with job._lock:
+        job.execute()
+    assert 'hoymiles_mqtt_modbus_errors_total{dtu="dtu",type="TimeoutError"} 1.0' in registry.render()
+    assert metrics.skipped_cycles.value == 1
+
+
+def test_execute_publishes_only_new_configs(mqtt_builder, mqtt_publisher, modbus_client):
+    """Tests that configs are published only when the builder returns configs for new devices."""
+    job = HoymilesQueryJob(mqtt_builder, mqtt_publisher, modbus_client)
+    job.execute()
+    assert mqtt_publisher.schedule_publish.call_count == 2
+    mqtt_builder.get_configs.return_value = []
+    job.execute()
+    assert mqtt_builder.get_configs.call_count == 2
+    assert mqtt_publisher.schedule_publish.call_count == 3
+
+
+def test_execute_republishes_on_ha_birth(mqtt_builder, mqtt_publisher, modbus_client):
+    """Tests that Home Assistant birth message immediately republishes configs and states of the last data."""
+    job = HoymilesQueryJob(mqtt_builder, mqtt_publisher, modbus_client)
+    mqtt_publisher.subscribe.assert_called_once_with(HA_STATUS_TOPIC, ANY)
+    on_ha_status = mqtt_publisher.subscribe.call_args.args[1]
+    job.execute()
+    mqtt_builder.clear_configs.assert_not_called()
+
+    on_ha_status(b'offline')
+    assert job._republish_thread is None
+
+    on_ha_status(b'online')
+    assert job._republish_thread is not None
+    job._republish_thread.join()
+    mqtt_builder.clear_configs.assert_called_once()
+    mqtt_builder.clear_states.assert_called_once()
+    assert mqtt_builder.get_configs.call_count == 2
+    assert mqtt_builder.get_states.call_count == 2
+    mqtt_builder.get_states.assert_called_with(plant_data=modbus_client.plant_data)
+
+
+def test_ha_birth_before_data(mqtt_builder, mqtt_publisher, modbus_client):
+    """Tests that Home Assistant birth message before any data only resets the builder."""
+    job = HoymilesQueryJob(mqtt_builder, mqtt_publisher, modbus_client)
+    on_ha_status = mqtt_publisher.subscribe.call_args.args[1]
+    on_ha_status(b'online')
+    assert job._republish_thread is not None
+    job._republish_thread.join()
+    mqtt_builder.clear_configs.assert_called_once()
+    mqtt_publisher.schedule_publish.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    'overrun_policy, expected_tick',
+    [(OVERRUN_SKIP, 140.0), (OVERRUN_COALESCE, 130.0), (OVERRUN_CATCH_UP, 110.0)],
+)
+def test_scheduler_overrun_policy(overrun_policy, expected_tick):
+    """Tests next tick calculation when the job took longer than 2 periods."""
+    scheduler = PeriodicScheduler(period=10, job=MagicMock(), overrun_policy=overrun_policy)
+    with patch('time.monotonic', return_value=135.0):
+        assert scheduler._next_tick(100.0) == expected_tick
+    with patch('time.monotonic', return_value=105.0):
+        assert scheduler._next_tick(100.0) == 110.0
+
+
+def test_scheduler_aligned_first_tick():
+    """Tests that the first tick is aligned to wall-clock boundary of the period."""
+    scheduler = PeriodicScheduler(period=60, job=MagicMock())
+    with patch('time.monotonic', return_value=1000.0), patch('time.time', return_value=1_699_999_995.0):
+        assert scheduler._first_tick() == 1045.0
+
+
+class FakeClock:
+    """Monotonic clock advanced only by waiting and by the executed job."""
+
+    def __init__(self) -> None:
+        """Initialize the clock."""
+        self.now = 100.0
+
+    def monotonic(self) -> float:
+        """Current time."""
+        return self.now
+
+
+class FakeStopEvent(threading.Event):
+    """Stop event which advances the fake clock instead of sleeping."""
+
+    def __init__(self, clock: FakeClock) -> None:
+        """Initialize the event."""
+        super().__init__()
+        self._clock = clock
+
+    def wait(self, timeout=None):
+        """Advance the clock by the timeout."""
+        self._clock.now += timeout
+        return self.is_set()
+
+
+def test_scheduler_runs_job_at_fixed_rate():
+    """Tests that the job is executed periodically in one thread, regardless of exceptions and execution time."""
+    period = 10
+    clock = FakeClock()
+    stop_event = FakeStopEvent(clock)
+    threads = set()
+    calls: list[float] = []
+
+    def job():
+        threads.add(threading.get_ident())
+        calls.append(clock.now)
+        clock.now += 3
+        if len(calls) == 5:
+            stop_event.set()
+        if len(calls) == 2:
+            raise RuntimeError
+
+    scheduler = PeriodicScheduler(period=period, job=job, align=False, stats_cycles=2)
+    with patch('time.monotonic', clock.monotonic):
+        scheduler.run(stop_event)
+    assert threads == {threading.get_ident()}
+    # drift-free: the schedule is not shifted by job execution time
+    assert calls == [100.0, 110.0, 120.0, 130.0, 140.0]
+    assert calls[-1] - calls[0] == 4 * period
+
+
+def test_scheduler_catch_up_reports_overrun_once(caplog):
+    """Tests that catch-up replays missed ticks and reports the overrun once."""
+    clock = FakeClock()
+    stop_event = FakeStopEvent(clock)
+    calls: list[float] = []
+
+    def job():
+        calls.append(clock.now)
+        clock.now += 25 if len(calls) == 1 else 1
+        if len(calls) == 5:
+            stop_event.set()
+
+    scheduler = PeriodicScheduler(period=10, job=job, overrun_policy=OVERRUN_CATCH_UP, align=False, stats_cycles=5)
+    with patch('time.monotonic', clock.monotonic), caplog.at_level(logging.INFO, logger='hoymiles_mqtt'):
+        scheduler.run(stop_event)
+    assert calls == [100.0, 125.0, 126.0, 130.0, 140.0]
+    assert len([r for r in caplog.records if 'took longer' in r.message]) == 1
+    assert 'replayed ticks 2' in caplog.records[-1].message
+
+
+def test_scheduler_variable_period(caplog):
+    """Tests that the schedule follows changes of a variable period."""
+    clock = FakeClock()
+    stop_event = FakeStopEvent(clock)
+    periods = iter([10, 10, 10, 30, 30, 30])
+    calls: list[float] = []
+
+    def job():
+        calls.append(clock.now)
+        if len(calls) == 4:
+            stop_event.set()
+
+    scheduler = PeriodicScheduler(period=lambda: next(periods), job=job, align=False, stats_cycles=0)
+    with patch('time.monotonic', clock.monotonic), caplog.at_level(logging.INFO, logger='hoymiles_mqtt'):
+        scheduler.run(stop_event)
+    assert calls == [100.0, 110.0, 120.0, 150.0]
+    assert 'Query period changed from 10s to 30s.' in caplog.text
+
+
+def test_scheduler_unknown_policy():
+    """Tests that unknown overrun policy is rejected."""
+    with pytest.raises(ValueError):
+        PeriodicScheduler(period=10, job=MagicMock(), overrun_policy='unknown')
+
+
+class FakeDtu:
+    """Fake DTU Modbus client, returning data after given delay."""
+
+    def __init__(self, serial: str, delay: float) -> None:
+        """Initialize the fake DTU."""
+        self._serial = serial
+        self._delay = delay
+        self.reads = 0
+
+    @property
+    def plant_data(self) -> PlantData:
+        """Plant data, returned after the delay."""
+        time.sleep(self._delay)
+        self.reads += 1
+        return PlantData(self._serial)
+
+
+def test_multiple_dtus_polled_concurrently(mqtt_publisher):
+    """Tests that a slow DTU does not delay queries of other DTUs."""
+    dtus = {'fast_1': FakeDtu('fast_1', 0), 'fast_2': FakeDtu('fast_2', 0), 'slow': FakeDtu('slow', 0.5)}
+    jobs = {}
+    for name, dtu in dtus.items():
+        builder = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES)
+        jobs[name] = HoymilesQueryJob(builder, mqtt_publisher, dtu).execute  # type: ignore[arg-type]
+    stop_event = threading.Event()
+    threads = start_periodic_jobs(period=0.05, jobs=jobs, stop_event=stop_event, align=False, stats_cycles=0)
+    time.sleep(0.4)
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    assert [thread.name for thread in threads] == list(dtus)
+    assert dtus['fast_1'].reads >= 5
+    assert dtus['fast_2'].reads >= 5
+    assert dtus['slow'].reads == 1
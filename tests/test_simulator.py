@@ -0,0 +1,91 @@
+"""Tests with the simulated DTU."""
+
+import asyncio
+import logging
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from hoymiles_modbus.client import HoymilesModbusTCP
+from pymodbus.exceptions import ModbusIOException
+
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES
+from hoymiles_mqtt.aio import AsyncHoymilesModbusTCP
+from hoymiles_mqtt.ha import HassMqtt
+from hoymiles_mqtt.runners import HoymilesQueryJob
+from hoymiles_mqtt.simulator import DtuSimulator
+
+NOON = time.mktime((2025, 6, 1, 12, 0, 0, 0, 0, -1))
+MIDNIGHT = time.mktime((2025, 6, 1, 0, 0, 0, 0, 0, -1))
+
+
+def _modbus_client(dtu_simulator) -> HoymilesModbusTCP:
+    modbus_client = HoymilesModbusTCP(host=dtu_simulator.host, port=dtu_simulator.port)
+    modbus_client.comm_params.timeout = 0.2
+    modbus_client.comm_params.retries = 0
+    return modbus_client
+
+
+def test_diurnal_curve():
+    """Verify that power follows the diurnal curve and production grows during the day."""
+    simulator = DtuSimulator()
+    assert simulator.port_power(MIDNIGHT) == 0
+    assert simulator.port_power(NOON) == pytest.approx(simulator.peak_power)
+    assert simulator.port_today_production(MIDNIGHT) == 0
+    assert 0 < simulator.port_today_production(NOON) < simulator.port_today_production(NOON + 6 * 3600)
+
+
+def test_read_plant_data(dtu_simulator):
+    """Verify that data of all microinverter ports is read from the simulator."""
+    plant_data = _modbus_client(dtu_simulator).plant_data
+    assert plant_data.dtu == '415012345678'
+    assert [(inverter.serial_number, inverter.port_number) for inverter in plant_data.inverters] == [
+        ('102162800000', 1),
+        ('102162800000', 2),
+        ('102162800001', 1),
+        ('102162800001', 2),
+    ]
+
+
+def test_read_plant_data_async(dtu_simulator):
+    """Verify that the asyncio client reads the same data as the synchronous one."""
+    dtu_simulator.simulator.peak_power = 0
+    plant_data = asyncio.run(AsyncHoymilesModbusTCP(dtu_simulator.host, dtu_simulator.port).get_plant_data())
+    assert plant_data == _modbus_client(dtu_simulator).plant_data
+
+
+def test_latency(dtu_simulator):
+    """Verify that the injected latency delays responses."""
+    dtu_simulator.simulator.latency = 0.05
+    start = time.monotonic()
+    _modbus_client(dtu_simulator).plant_data
+    # DTU serial number, 4 ports and the terminating (empty) record
+    assert time.monotonic() - start >= 6 * 0.05
+
+
+def test_no_response(dtu_simulator, caplog):
+    """Verify that dropped responses are reported by the client and logged as a warning by the job."""
+    dtu_simulator.simulator.drop_rate = 1
+    modbus_client = _modbus_client(dtu_simulator)
+    with pytest.raises(ModbusIOException):
+        modbus_client.plant_data
+
+    mqtt_builder = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES)
+    publisher = MagicMock()
+    with caplog.at_level(logging.WARNING, logger='hoymiles_mqtt'):
+        HoymilesQueryJob(mqtt_builder, publisher, modbus_client).execute()
+    assert 'Failed to read data from DTU via Modbus. Will retry.' in caplog.messages
+    assert not any(record.exc_info for record in caplog.records)
+    assert dtu_simulator.simulator.dropped >= 2
+    publisher.schedule_publish.assert_not_called()
+
+
+def test_query_job_publishes_simulated_data(dtu_simulator):
+    """Verify a full query cycle, from Modbus frames to MQTT messages."""
+    mqtt_builder = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES)
+    publisher = MagicMock()
+    queue = publisher.schedule_publish.return_value.__enter__.return_value
+    HoymilesQueryJob(mqtt_builder, publisher, _modbus_client(dtu_simulator)).execute()
+    topics = {call.kwargs['topic'] for call in queue.add.call_args_list}
+    assert 'homeassistant/hoymiles_mqtt/415012345678/state' in topics
+    assert 'homeassistant/hoymiles_mqtt/102162800001/2/state' in topics
@@ -0,0 +1,80 @@
+"""Tests for aggregated snapshots of plant data."""
+
+import copy
+import json
+
+import pytest
+
+from hoymiles_mqtt import MI_ENTITIES, PORT_ENTITIES, SNAPSHOT_FORMAT_MSGPACK
+from hoymiles_mqtt.ha import HassMqtt
+from hoymiles_mqtt.snapshot import SnapshotOutput, packb
+from tests.test_hoymiles_mqtt import get_example_data
+
+
+def test_snapshot_columns():
+    """Verify that the snapshot contains arrays of values of all microinverters and ports."""
+    ha = HassMqtt(
+        mi_entities=['temperature'],
+        port_entities=['pv_power', 'today_production'],
+        snapshot=SnapshotOutput(topic='plant/{dtu}'),
+        device_topics=False,
+    )
+    example_data = get_example_data()
+    idle_port = copy.copy(example_data.inverters[0])
+    idle_port.serial_number = '102162804828'
+    idle_port.operating_status = 0
+    example_data.inverters.append(idle_port)
+    assert list(ha.get_configs(example_data)) == []
+    [(topic, payload)] = ha.get_states(example_data)
+    assert topic == 'plant/dtu_serial'
+    assert json.loads(payload) == {
+        'dtu': 'dtu_serial',
+        'pv_power': 0.0,
+        'today_production': 431,
+        'total_production': 8844,
+        'alarm_flag': 'OFF',
+        'inverters': {'serial_number': ['102162804827', '102162804828'], 'temperature': [20.4, None]},
+        'ports': {
+            'serial_number': ['102162804827', '102162804828'],
+            'port_number': [3, 3],
+            'pv_power': [40.31, None],
+            'today_production': [431, 431],
+        },
+    }
+
+
+def test_snapshot_with_device_topics():
+    """Verify that the snapshot is published after states of devices."""
+    ha = HassMqtt(mi_entities=MI_ENTITIES, port_entities=PORT_ENTITIES, snapshot=SnapshotOutput())
+    topics = [topic for topic, _ in ha.get_states(get_example_data())]
+    assert len(topics) == 4
+    assert topics[-1] == 'hoymiles_mqtt/dtu_serial/snapshot'
+
+
+@pytest.mark.parametrize(
+    'value, expected',
+    [
+        (None, 'c0'),
+        (True, 'c3'),
+        (5, '05'),
+        (-3, 'fd'),
+        (200, 'ccc8'),
+        (8844, 'cd228c'),
+        (-200, 'd1ff38'),
+        (2.5, 'cb4004000000000000'),
+        ('OFF', 'a34f4646'),
+        ([1, None], '9201c0'),
+        ({'a': 1}, '81a16101'),
+        ('x' * 40, 'd928' + '78' * 40),
+        (list(range(16)), 'dc0010' + ''.join(f'{i:02x}' for i in range(16))),
+    ],
+)
+def test_packb(value, expected):
+    """Verify MessagePack encoding."""
+    assert packb(value).hex() == expected
+
+
+def test_msgpack_snapshot():
+    """Verify that snapshots can be encoded to MessagePack."""
+    output = SnapshotOutput(payload_format=SNAPSHOT_FORMAT_MSGPACK)
+    assert output.encode({'dtu': 'dtu_serial'}) == bytes.fromhex('81a3647475aa6474755f73657269616c')